@@ -4,17 +4,139 @@ Modal deployment for LLM4Decompile model with GPU acceleration.
 This runs LLM4Decompile 9B Q8_0 (higher precision quantization) on Modal's cloud GPUs.
 Deploy with: modal deploy modal_app.py
 
+The GGUF build can be swapped via LLM4D_MODEL_REPO / LLM4D_MODEL_FILE.
+
+LLM4DecompileVLLM serves the full-precision HF checkpoint with vLLM on an L4
+using FP8 (W8A8) quantization; point MODAL_ENDPOINT_URL at its endpoints to
+use it from the server.
+
+LLM4DecompileTRTLLM serves the same checkpoint as a compiled TensorRT-LLM
+engine (INT8 weight-only, paged KV, in-flight batching) on an A100.
+
 Endpoint: https://<your-workspace>--llm4decompile-decompile.modal.run
 """
 
+import os
+import re
+from typing import Iterable, Iterator, Optional
+
 import modal
 
 # Create the Modal app
 app = modal.App("llm4decompile")
 
-# GGUF model from HuggingFace - Q8_0 for higher precision
-MODEL_REPO = "tensorblock/llm4decompile-9b-v2-GGUF"
-MODEL_FILE = "llm4decompile-9b-v2-Q8_0.gguf"
+# GGUF model from HuggingFace - Q8_0 for higher precision by default.
+# Override at deploy time to swap in a calibrated K-quant build (e.g. a
+# GPTQ/GSQ-optimized Q4_K_M): the block layout is identical, so llama.cpp
+# loads it unchanged.
+#   LLM4D_MODEL_REPO=<org>/<repo> LLM4D_MODEL_FILE=<file>.gguf modal deploy modal_app.py
+MODEL_REPO = os.environ.get("LLM4D_MODEL_REPO", "tensorblock/llm4decompile-9b-v2-GGUF")
+MODEL_FILE = os.environ.get("LLM4D_MODEL_FILE", "llm4decompile-9b-v2-Q8_0.gguf")
+# Quantization tag parsed from the file name (e.g. "Q8_0", "Q4_K_M")
+MODEL_QUANT = MODEL_FILE.rsplit("-", 1)[-1].removesuffix(".gguf")
+
+# Output cleanup patterns (compiled once per container)
+# Preprocessor line directives: # 123 "path" or # 123
+_LINE_DIRECTIVE = re.compile(r'#\s*\d+\s*"[^"]*"?')
+_LINE_DIRECTIVE_EOL = re.compile(r'#\s*\d+\s*$', re.MULTILINE)
+_EXTRA_BLANK_LINES = re.compile(r'\n{3,}')
+
+# Stop sequences shared by every backend
+STOP_SEQUENCES = [
+    "# This is the assembly code:",
+    "\n\n\n",
+    "/scratch/",  # Training data path leak
+    "/home/",     # Training data path leak
+    "/repos/",    # Training data path leak
+    '# "',        # Preprocessor line directive start
+    "\n# 1",      # Line directives (# followed by digit)
+    "\n# 2",
+    "\n# 3",
+    "\n# 4",
+    "\n# 5",
+    "\n# 6",
+    "\n# 7",
+    "\n# 8",
+    "\n# 9",
+]
+
+# All stop sequences as one compiled scanner (the "\n# <digit>" family
+# collapses to a single character class). llama-cpp-python re-searches the
+# whole completion for every stop string on every token; the llama.cpp
+# backend instead scans only the newly appended tail with this pattern.
+_STOP_PATTERN = re.compile(
+    "|".join(re.escape(stop) for stop in STOP_SEQUENCES if not re.fullmatch(r"\n# \d", stop))
+    + r"|\n# [1-9]"
+)
+_STOP_MAX_LEN = max(len(stop) for stop in STOP_SEQUENCES)
+
+
+def build_prompt(ghidra_code: str) -> str:
+    """Build the decompile prompt - explicit instruction for clean output."""
+    return f"""# This is the assembly code:
+{ghidra_code}
+# Decompile to clean, readable C source code. Do NOT include:
+# - Line number directives (# followed by numbers)
+# - File path comments
+# - Training data artifacts
+# Output only the C function implementation:
+"""
+
+
+def clean_output(refined_code: str) -> str:
+    """Clean up the model output - remove any remaining artifacts."""
+    refined_code = refined_code.strip()
+    # Remove preprocessor line directives: # 123 "path" or # 123
+    refined_code = _LINE_DIRECTIVE.sub('', refined_code)
+    refined_code = _LINE_DIRECTIVE_EOL.sub('', refined_code)
+    # Clean up markdown code fences
+    refined_code = refined_code.removeprefix("```c").removeprefix("```").removesuffix("```")
+    # Clean up multiple blank lines
+    refined_code = _EXTRA_BLANK_LINES.sub('\n\n', refined_code)
+    return refined_code.strip()
+
+
+def stream_clean_output(chunks: Iterable[str]) -> Iterator[str]:
+    """
+    Line-buffered streaming counterpart of clean_output().
+    
+    Each completed line is cleaned and yielded as soon as it arrives; blank
+    lines are held back so leading/trailing blanks are dropped and runs of
+    them collapse to one.
+    """
+    pending = ""
+    started = False
+    blank_lines = 0
+    
+    def _emit(line: str) -> Iterator[str]:
+        nonlocal started, blank_lines
+        line = _LINE_DIRECTIVE.sub('', line)
+        line = _LINE_DIRECTIVE_EOL.sub('', line)
+        if not started:
+            line = line.lstrip().removeprefix("```c").removeprefix("```")
+        if line.strip() == "```":
+            return
+        if not line.strip():
+            blank_lines += 1
+            return
+        if started and blank_lines:
+            yield "\n"
+        started = True
+        blank_lines = 0
+        yield line + "\n"
+    
+    for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield from _emit(line)
+    if pending:
+        yield from _emit(pending.rstrip().removesuffix("```"))
+
+
+# Persistent volume for the GGUF weights so cold starts skip the HF download
+MODEL_DIR = "/models"
+weights_volume = modal.Volume.from_name("llm4d-weights", create_if_missing=True)
 
 # Define the container image with CUDA support for llama-cpp-python
 image = (
@@ -25,6 +147,7 @@ image = (
     .apt_install("libgomp1")  # OpenMP library required by llama-cpp-python
     .pip_install(
         "huggingface_hub",
+        "hf_transfer",  # Parallel Rust downloader for the multi-GB GGUF
         "fastapi[standard]",
         "pydantic>=2.0",
     )
@@ -33,6 +156,12 @@ image = (
         "llama-cpp-python",
         extra_options="--extra-index-url https://abetlen.github.io/llama-cpp-python/whl/cu121"
     )
+    # Pin the model selection inside the container so it matches the deploy
+    .env({"LLM4D_MODEL_REPO": MODEL_REPO, "LLM4D_MODEL_FILE": MODEL_FILE})
+    .env({"HF_HUB_ENABLE_HF_TRANSFER": "1"})
+    # Fused CUDA kernels + concurrent streams for token generation
+    # (leave GGML_CUDA_DISABLE_FUSION unset so fusion stays on)
+    .env({"GGML_CUDA_GRAPH_OPT": "1"})
 )
 
 
@@ -42,32 +171,121 @@ image = (
     memory=32768,  # 32GB RAM for larger model
     timeout=600,
     scaledown_window=300,  # Keep warm for 5 minutes between requests
+    volumes={MODEL_DIR: weights_volume},
 )
 class LLM4Decompile:
-    """LLM4Decompile 9B Q4_K_M model class with GPU acceleration."""
+    """
+    LLM4Decompile 9B GGUF model class with GPU acceleration.
+    
+    llama-cpp-python's Llama decodes a single sequence and is not thread-safe,
+    so this class takes one input at a time; use LLM4DecompileVLLM or
+    LLM4DecompileTRTLLM for concurrent requests.
+    """
     
     @modal.enter()
     def load_model(self):
-        """Download and load GGUF model on container start."""
-        from huggingface_hub import hf_hub_download
+        """Load GGUF model on container start, downloading it to the volume once."""
         from llama_cpp import Llama
         
-        print(f"Downloading {MODEL_FILE} from {MODEL_REPO}...")
-        model_path = hf_hub_download(
-            repo_id=MODEL_REPO,
-            filename=MODEL_FILE,
-        )
-        print(f"Model downloaded to: {model_path}")
+        model_path = os.path.join(MODEL_DIR, MODEL_FILE)
+        if os.path.exists(model_path):
+            print(f"Using cached model from volume: {model_path}")
+        else:
+            from huggingface_hub import hf_hub_download
+            
+            print(f"Downloading {MODEL_FILE} from {MODEL_REPO}...")
+            model_path = hf_hub_download(
+                repo_id=MODEL_REPO,
+                filename=MODEL_FILE,
+                local_dir=MODEL_DIR,
+            )
+            weights_volume.commit()
+            print(f"Model downloaded to: {model_path}")
         
         print("Loading model with CUDA...")
         self.llm = Llama(
             model_path=model_path,
             n_gpu_layers=-1,  # Offload all layers to GPU
             n_ctx=16384,      # Context window (16K tokens)
+            use_mmap=True,    # Memory-map straight from the volume
+            use_mlock=False,
+            flash_attn=True,  # Fused FlashAttention kernel for long prefills
             verbose=True,
         )
         print("Model loaded on GPU!")
     
+    def _generate(
+        self,
+        prompt: str,
+        max_tokens: int,
+        temperature: float,
+        usage: Optional[dict] = None,
+    ) -> Iterator[str]:
+        """
+        Stream completion text with the shared sampling settings, cutting
+        generation at the first stop sequence.
+        
+        Text that could still be the start of a stop sequence is held back
+        until it is known not to be one. If given, usage["completion_tokens"]
+        is updated as tokens arrive.
+        """
+        chunks = self.llm(
+            prompt,
+            max_tokens=max_tokens,
+            temperature=max(temperature, 0.01),
+            top_p=0.9,  # Nucleus sampling - more natural output
+            repeat_penalty=1.15,  # Penalize repetition
+            frequency_penalty=0.1,  # Additional frequency-based penalty
+            echo=False,
+            stream=True,
+        )
+        text = ""
+        emitted = 0
+        for chunk in chunks:
+            piece = chunk["choices"][0]["text"]
+            text += piece
+            if usage is not None:
+                usage["completion_tokens"] = usage.get("completion_tokens", 0) + 1
+            
+            # Only the new piece plus a stop-length overlap can hold a new match
+            match = _STOP_PATTERN.search(text, max(0, len(text) - len(piece) - _STOP_MAX_LEN))
+            if match:
+                chunks.close()  # Stop decoding
+                yield text[emitted:match.start()]
+                return
+            
+            safe = len(text) - (_STOP_MAX_LEN - 1)
+            if safe > emitted:
+                yield text[emitted:safe]
+                emitted = safe
+        yield text[emitted:]
+    
+    def _refine_stream(self, ghidra_code: str, max_tokens: int, temperature: float) -> Iterator[str]:
+        """Yield cleaned C code line by line as llama.cpp generates it."""
+        yield from stream_clean_output(self._generate(build_prompt(ghidra_code), max_tokens, temperature))
+    
+    def _refine(self, ghidra_code: str, max_tokens: int, temperature: float) -> dict:
+        """Run one Ghidra pseudo-C snippet through the model and clean the output."""
+        import time
+        
+        prompt = build_prompt(ghidra_code)
+        
+        # Generate with llama.cpp
+        start = time.time()
+        usage = {"completion_tokens": 0}
+        text = "".join(self._generate(prompt, max_tokens, temperature, usage))
+        inference_time = (time.time() - start) * 1000
+        
+        refined_code = clean_output(text)
+
+        return {
+            "refined_code": refined_code,
+            "inference_time_ms": round(inference_time, 2),
+            "tokens_generated": usage["completion_tokens"],
+            "device": "cuda",
+            "model": f"{MODEL_REPO}/{MODEL_FILE}",
+        }
+    
     @modal.fastapi_endpoint(method="POST")
     def decompile(self, request: dict):
         """
@@ -77,90 +295,363 @@ class LLM4Decompile:
         {
             "ghidra_code": "...",
             "max_tokens": 512,
+            "temperature": 0.0,
+            "stream": false
+        }
+        
+        With "stream": true the cleaned code is returned as a text/plain
+        stream, line by line as it is generated, instead of a JSON object.
+        """
+        ghidra_code = request.get("ghidra_code", "")
+        max_tokens = request.get("max_tokens", 2048)
+        temperature = request.get("temperature", 0.01)  # Slightly higher to reduce repetition
+        
+        if not ghidra_code:
+            return {"error": "ghidra_code is required"}
+        
+        if request.get("stream"):
+            from fastapi.responses import StreamingResponse
+            return StreamingResponse(
+                self._refine_stream(ghidra_code, max_tokens, temperature),
+                media_type="text/plain",
+            )
+        
+        return self._refine(ghidra_code, max_tokens, temperature)
+    
+    @modal.fastapi_endpoint(method="POST")
+    def decompile_batch(self, request: dict):
+        """
+        Refine several Ghidra pseudo-C functions in a single request.
+        
+        Saves one HTTP round trip (and potential cold start) per function
+        compared to calling /decompile in a loop.
+        
+        Request body:
+        {
+            "functions": [{"name": "main", "ghidra_code": "..."}, ...],
+            "max_tokens": 512,
             "temperature": 0.0
         }
         """
+        functions = request.get("functions", [])
+        max_tokens = request.get("max_tokens", 2048)
+        temperature = request.get("temperature", 0.01)
+        
+        if not functions:
+            return {"error": "functions is required"}
+        
+        # Single-sequence model: run critical functions (main/entry) first
+        functions = sorted(functions, key=lambda func: func.get("priority") != "critical")
+        
+        results = []
+        for func in functions:
+            name = func.get("name")
+            ghidra_code = func.get("ghidra_code", "")
+            if not ghidra_code:
+                results.append({"name": name, "error": "ghidra_code is required"})
+                continue
+            result = self._refine(ghidra_code, max_tokens, temperature)
+            result["name"] = name
+            results.append(result)
+        
+        return {"results": results}
+    
+    @modal.fastapi_endpoint(method="GET")
+    def health(self):
+        """Health check endpoint."""
+        return {
+            "status": "healthy",
+            "model": f"{MODEL_REPO}/{MODEL_FILE}",
+            "quantization": MODEL_QUANT,
+            "device": "cuda",
+        }
+
+
+# ============================================================================
+# vLLM backend (L4, FP8 W8A8)
+# ============================================================================
+
+# Unquantized HF checkpoint - vLLM quantizes it to FP8 on load
+VLLM_MODEL_ID = os.environ.get("LLM4D_VLLM_MODEL_ID", "LLM4Binary/llm4decompile-9b-v2")
+VLLM_QUANTIZATION = os.environ.get("LLM4D_VLLM_QUANTIZATION", "fp8")
+
+# Pinned: LLM4DecompileVLLM uses the V0 AsyncLLMEngine API with
+# scheduling_policy="priority" and generate(priority=...)
+VLLM_VERSION = "0.6.6.post1"
+
+vllm_image = (
+    modal.Image.from_registry("nvidia/cuda:12.4.1-devel-ubuntu22.04", add_python="3.11")
+    .entrypoint([])
+    .pip_install(f"vllm=={VLLM_VERSION}")
+    .pip_install("fastapi[standard]", "pydantic>=2.0", "hf_transfer")
+    .env({"LLM4D_VLLM_MODEL_ID": VLLM_MODEL_ID, "LLM4D_VLLM_QUANTIZATION": VLLM_QUANTIZATION})
+    .env({"HF_HUB_ENABLE_HF_TRANSFER": "1"})
+)
+
+
+# One container serves up to 8 requests at once; vLLM's continuous
+# batching and paged KV cache interleave their decode steps
+@app.cls(
+    image=vllm_image,
+    gpu="L4",  # Ada - native FP8 tensor cores
+    memory=32768,
+    timeout=600,
+    scaledown_window=300,  # Keep warm for 5 minutes between requests
+    volumes={MODEL_DIR: weights_volume},
+)
+@modal.concurrent(max_inputs=8)
+class LLM4DecompileVLLM:
+    """LLM4Decompile 9B served by vLLM with FP8 quantization."""
+    
+    @modal.enter()
+    def load_model(self):
+        """Start the vLLM engine, caching the HF checkpoint on the volume."""
+        from vllm import AsyncEngineArgs, AsyncLLMEngine
+        
+        print(f"Loading {VLLM_MODEL_ID} with vLLM ({VLLM_QUANTIZATION})...")
+        engine_args = AsyncEngineArgs(
+            model=VLLM_MODEL_ID,
+            quantization=VLLM_QUANTIZATION,
+            max_model_len=16384,
+            gpu_memory_utilization=0.9,
+            download_dir=MODEL_DIR,
+            scheduling_policy="priority",  # Let critical requests jump the queue
+        )
+        self.engine = AsyncLLMEngine.from_engine_args(engine_args)
+        print("vLLM engine ready!")
+    
+    async def _refine(
+        self,
+        ghidra_code: str,
+        max_tokens: int,
+        temperature: float,
+        priority: str = "standard",
+    ) -> dict:
+        """Run one Ghidra pseudo-C snippet through the engine and clean the output."""
         import time
+        import uuid
+        from vllm import SamplingParams
+        
+        sampling_params = SamplingParams(
+            max_tokens=max_tokens,
+            temperature=max(temperature, 0.01),
+            top_p=0.9,
+            repetition_penalty=1.15,
+            frequency_penalty=0.1,
+            stop=STOP_SEQUENCES,
+        )
+        
+        start = time.time()
+        final_output = None
+        async for request_output in self.engine.generate(
+            build_prompt(ghidra_code),
+            sampling_params,
+            str(uuid.uuid4()),
+            priority=0 if priority == "critical" else 1,  # Lower runs first
+        ):
+            final_output = request_output
+        inference_time = (time.time() - start) * 1000
         
+        completion = final_output.outputs[0]
+        return {
+            "refined_code": clean_output(completion.text),
+            "inference_time_ms": round(inference_time, 2),
+            "tokens_generated": len(completion.token_ids),
+            "device": "cuda",
+            "model": VLLM_MODEL_ID,
+        }
+    
+    @modal.fastapi_endpoint(method="POST")
+    async def decompile(self, request: dict):
+        """Refine Ghidra pseudo-C code to readable C (same contract as LLM4Decompile)."""
         ghidra_code = request.get("ghidra_code", "")
         max_tokens = request.get("max_tokens", 2048)
-        temperature = request.get("temperature", 0.01)  # Slightly higher to reduce repetition
+        temperature = request.get("temperature", 0.01)
         
         if not ghidra_code:
             return {"error": "ghidra_code is required"}
         
-        # Build prompt - explicit instruction for clean output
-        prompt = f"""# This is the assembly code:
-{ghidra_code}
-# Decompile to clean, readable C source code. Do NOT include:
-# - Line number directives (# followed by numbers)
-# - File path comments
-# - Training data artifacts
-# Output only the C function implementation:
-"""
+        priority = request.get("priority", "standard")
+        return await self._refine(ghidra_code, max_tokens, temperature, priority)
+    
+    @modal.fastapi_endpoint(method="POST")
+    async def decompile_batch(self, request: dict):
+        """Refine several functions in one request (same contract as LLM4Decompile)."""
+        import asyncio
         
-        # Generate with llama.cpp
-        start = time.time()
-        output = self.llm(
-            prompt,
+        functions = request.get("functions", [])
+        max_tokens = request.get("max_tokens", 2048)
+        temperature = request.get("temperature", 0.01)
+        
+        if not functions:
+            return {"error": "functions is required"}
+        
+        async def _one(func: dict) -> dict:
+            name = func.get("name")
+            ghidra_code = func.get("ghidra_code", "")
+            if not ghidra_code:
+                return {"name": name, "error": "ghidra_code is required"}
+            priority = func.get("priority", "standard")
+            result = await self._refine(ghidra_code, max_tokens, temperature, priority)
+            result["name"] = name
+            return result
+        
+        # vLLM batches concurrently submitted requests on the GPU
+        results = await asyncio.gather(*[_one(func) for func in functions])
+        return {"results": list(results)}
+    
+    @modal.fastapi_endpoint(method="GET")
+    def health(self):
+        """Health check endpoint."""
+        return {
+            "status": "healthy",
+            "model": VLLM_MODEL_ID,
+            "quantization": VLLM_QUANTIZATION,
+            "device": "cuda",
+        }
+
+
+# ============================================================================
+# TensorRT-LLM backend (A100, INT8 weight-only)
+# ============================================================================
+
+# Pinned: 0.18 is the last line whose LLM API builds and saves TensorRT
+# engines by default (later releases switch tensorrt_llm.LLM to PyTorch)
+TRTLLM_VERSION = "0.18.0"
+TRTLLM_ENGINE_DIR = os.path.join(
+    MODEL_DIR, "trtllm-engines", f"{VLLM_MODEL_ID.replace('/', '--')}-{TRTLLM_VERSION}"
+)
+
+trtllm_image = (
+    modal.Image.from_registry("nvidia/cuda:12.8.1-devel-ubuntu22.04", add_python="3.12")
+    .entrypoint([])
+    .apt_install("openmpi-bin", "libopenmpi-dev", "git", "git-lfs", "wget")
+    .pip_install(
+        f"tensorrt-llm=={TRTLLM_VERSION}",
+        "pynvml<12",
+        pre=True,
+        extra_index_url="https://pypi.nvidia.com",
+    )
+    .pip_install("fastapi[standard]", "pydantic>=2.0", "hf_transfer")
+    .env({"LLM4D_VLLM_MODEL_ID": VLLM_MODEL_ID})
+    .env({"HF_HUB_ENABLE_HF_TRANSFER": "1"})
+)
+
+
+# One container serves up to 8 requests at once via in-flight batching
+@app.cls(
+    image=trtllm_image,
+    gpu="A100-80GB",  # Ampere has no FP8, so use INT8 weights
+    memory=32768,
+    timeout=1800,  # First start compiles the engine
+    scaledown_window=300,  # Keep warm for 5 minutes between requests
+    volumes={MODEL_DIR: weights_volume},
+)
+@modal.concurrent(max_inputs=8)
+class LLM4DecompileTRTLLM:
+    """LLM4Decompile 9B served as a compiled TensorRT-LLM engine."""
+    
+    @modal.enter()
+    def load_model(self):
+        """Load the cached engine from the volume, building it on first start."""
+        # The TensorRT-engine LLM class, not the PyTorch-backend one
+        from tensorrt_llm.llmapi.llm import LLM
+        from tensorrt_llm.llmapi import BuildConfig, KvCacheConfig, QuantAlgo, QuantConfig
+        
+        kv_cache_config = KvCacheConfig(free_gpu_memory_fraction=0.9)
+        
+        if os.path.exists(TRTLLM_ENGINE_DIR):
+            print(f"Using cached TensorRT-LLM engine: {TRTLLM_ENGINE_DIR}")
+            self.llm = LLM(model=TRTLLM_ENGINE_DIR, kv_cache_config=kv_cache_config)
+        else:
+            print(f"Building TensorRT-LLM engine for {VLLM_MODEL_ID}...")
+            self.llm = LLM(
+                model=VLLM_MODEL_ID,
+                quant_config=QuantConfig(quant_algo=QuantAlgo.W8A16),
+                build_config=BuildConfig(
+                    max_batch_size=16,
+                    max_input_len=15000,
+                    max_seq_len=16384,
+                ),
+                kv_cache_config=kv_cache_config,
+            )
+            self.llm.save(TRTLLM_ENGINE_DIR)
+            weights_volume.commit()
+            print(f"Engine saved to: {TRTLLM_ENGINE_DIR}")
+        print("TensorRT-LLM engine ready!")
+    
+    async def _refine(self, ghidra_code: str, max_tokens: int, temperature: float) -> dict:
+        """Run one Ghidra pseudo-C snippet through the engine and clean the output."""
+        import time
+        from tensorrt_llm import SamplingParams
+        
+        sampling_params = SamplingParams(
             max_tokens=max_tokens,
             temperature=max(temperature, 0.01),
-            top_p=0.9,  # Nucleus sampling - more natural output
-            repeat_penalty=1.15,  # Penalize repetition
-            frequency_penalty=0.1,  # Additional frequency-based penalty
-            stop=[
-                "# This is the assembly code:",
-                "\n\n\n",
-                "/scratch/",  # Training data path leak
-                "/home/",     # Training data path leak
-                "/repos/",    # Training data path leak
-                '# "',        # Preprocessor line directive start
-                "\n# 1",      # Line directives (# followed by digit)
-                "\n# 2",
-                "\n# 3",
-                "\n# 4",
-                "\n# 5",
-                "\n# 6",
-                "\n# 7",
-                "\n# 8",
-                "\n# 9",
-            ],
-            echo=False,
+            top_p=0.9,
+            repetition_penalty=1.15,
+            frequency_penalty=0.1,
+            stop=STOP_SEQUENCES,
         )
+        
+        start = time.time()
+        request_output = await self.llm.generate_async(
+            build_prompt(ghidra_code), sampling_params
+        ).aresult()
         inference_time = (time.time() - start) * 1000
         
-        refined_code = output["choices"][0]["text"].strip()
-        
-        # Clean up the output - remove any remaining artifacts
-        import re
-        # Remove preprocessor line directives: # 123 "path" or # 123
-        refined_code = re.sub(r'#\s*\d+\s*"[^"]*"?', '', refined_code)
-        refined_code = re.sub(r'#\s*\d+\s*$', '', refined_code, flags=re.MULTILINE)
-        # Clean up markdown code fences
-        if refined_code.startswith("```c"):
-            refined_code = refined_code[4:]
-        if refined_code.startswith("```"):
-            refined_code = refined_code[3:]
-        if refined_code.endswith("```"):
-            refined_code = refined_code[:-3]
-        # Clean up multiple blank lines
-        refined_code = re.sub(r'\n{3,}', '\n\n', refined_code)
-        refined_code = refined_code.strip()
-
+        completion = request_output.outputs[0]
         return {
-            "refined_code": refined_code,
+            "refined_code": clean_output(completion.text),
             "inference_time_ms": round(inference_time, 2),
-            "tokens_generated": output["usage"]["completion_tokens"],
+            "tokens_generated": len(completion.token_ids),
             "device": "cuda",
-            "model": f"{MODEL_REPO}/{MODEL_FILE}",
+            "model": VLLM_MODEL_ID,
         }
     
+    @modal.fastapi_endpoint(method="POST")
+    async def decompile(self, request: dict):
+        """Refine Ghidra pseudo-C code to readable C (same contract as LLM4Decompile)."""
+        ghidra_code = request.get("ghidra_code", "")
+        max_tokens = request.get("max_tokens", 2048)
+        temperature = request.get("temperature", 0.01)
+        
+        if not ghidra_code:
+            return {"error": "ghidra_code is required"}
+        
+        return await self._refine(ghidra_code, max_tokens, temperature)
+    
+    @modal.fastapi_endpoint(method="POST")
+    async def decompile_batch(self, request: dict):
+        """Refine several functions in one request (same contract as LLM4Decompile)."""
+        import asyncio
+        
+        functions = request.get("functions", [])
+        max_tokens = request.get("max_tokens", 2048)
+        temperature = request.get("temperature", 0.01)
+        
+        if not functions:
+            return {"error": "functions is required"}
+        
+        async def _one(func: dict) -> dict:
+            name = func.get("name")
+            ghidra_code = func.get("ghidra_code", "")
+            if not ghidra_code:
+                return {"name": name, "error": "ghidra_code is required"}
+            result = await self._refine(ghidra_code, max_tokens, temperature)
+            result["name"] = name
+            return result
+        
+        # In-flight batching merges the concurrent requests on the GPU
+        results = await asyncio.gather(*[_one(func) for func in functions])
+        return {"results": list(results)}
+    
     @modal.fastapi_endpoint(method="GET")
     def health(self):
         """Health check endpoint."""
         return {
             "status": "healthy",
-            "model": f"{MODEL_REPO}/{MODEL_FILE}",
-            "quantization": "Q4_K_M",
+            "model": VLLM_MODEL_ID,
+            "quantization": "int8_weight_only",
             "device": "cuda",
         }
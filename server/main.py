@@ -1,4 +1,10 @@
+import asyncio
+import atexit
+import importlib.util
+import logging
+import logging.handlers
 import os
+import queue
 import sys
 
 # Add server directory to path for imports
@@ -6,16 +12,38 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse
 from dotenv import load_dotenv
 
+# orjson renders the large code strings in job results several times
+# faster than the stdlib json encoder behind the default JSONResponse
+DefaultResponse = ORJSONResponse if importlib.util.find_spec("orjson") else JSONResponse
+
 # Load environment variables
 load_dotenv()
 
+# Decompile and refactor progress is logged per function from many concurrent
+# tasks/threads; hand records to a listener thread so the event loop never
+# blocks on stdout. LOG_LEVEL=WARNING drops the per-function lines entirely.
+_log_queue = queue.SimpleQueue()
+_stdout_handler = logging.StreamHandler(sys.stdout)
+_stdout_handler.setFormatter(logging.Formatter("%(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _stdout_handler)
+for _name in ("refactor", "decompile"):
+    _progress_log = logging.getLogger(_name)
+    _progress_log.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+    _progress_log.addHandler(logging.handlers.QueueHandler(_log_queue))
+    _progress_log.propagate = False
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 # Create FastAPI app
 app = FastAPI(
     title="Decompiler API",
     description="AI-powered binary decompiler that converts executables to readable C code",
     version="1.0.0",
+    default_response_class=DefaultResponse,
 )
 
 # CORS middleware for frontend and chrome extension communication
@@ -27,11 +55,50 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Job results carry whole decompiled programs, which gzip several times over
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 # Import and include routers (absolute imports)
 from routers import decompile
+from services import gemini_service, modal_client
+from services.http_pool import close_http_client, get_http_client, warm_up
 
 app.include_router(decompile.router)
 
+_warm_up_task = None
+_modal_keep_warm_task = None
+
+
+@app.on_event("startup")
+async def startup():
+    # Build the shared HTTP pool and the Modal client now rather than on the
+    # first request. Modal endpoints are only contacted with MODAL_WARMUP
+    # set: any request to them can start a container.
+    global _modal_keep_warm_task
+    get_http_client()
+    if modal_client.is_modal_available():
+        modal_client.get_modal_client()
+        if modal_client.MODAL_WARMUP:
+            _modal_keep_warm_task = asyncio.create_task(modal_client.keep_warm())
+    
+    # Open the Gemini connection and create its prompt caches in the
+    # background so the first job reuses them
+    global _warm_up_task
+    if gemini_service.is_available():
+        _warm_up_task = asyncio.gather(
+            warm_up(gemini_service.GEMINI_API_ORIGIN),
+            gemini_service.warm_prompt_caches(),
+        )
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if _modal_keep_warm_task is not None:
+        _modal_keep_warm_task.cancel()
+    if _warm_up_task is not None:
+        _warm_up_task.cancel()
+    await close_http_client()
+
 
 @app.get("/")
 async def root():
@@ -1,14 +1,21 @@
+import asyncio
 import os
 import sys
 import uuid
 import tempfile
 import shutil
-from typing import Dict, List, Any
+from typing import Dict, List
+import aiofiles
 from fastapi import APIRouter, UploadFile, File, HTTPException, BackgroundTasks
 
 # Add server directory to path for imports
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from services import gemini_service, llm_cache, llm_service, semantic_cache
+from services.ai_service import refactor_batch, refactor_stats
+from services.ghidra_service import decompile_binary, file_hasher
+from services.modal_client import PRIORITY_CRITICAL, PRIORITY_STANDARD
+from services.job_store import create_job, get_job, update_job, append_log
 from models.schemas import (
     JobStatus,
     JobResponse,
@@ -20,11 +27,14 @@ from models.schemas import (
 
 router = APIRouter(prefix="/api", tags=["decompile"])
 
-# In-memory job store
-jobs: Dict[str, Dict[str, Any]] = {}
+# Gemini availability only depends on env (loaded by main.py before this
+# import), so probe it once instead of per request. LLM4Decompile's
+# is_available() memoizes its own (torch-importing) probe on first call.
+GEMINI_AVAILABLE = gemini_service.is_available()
 
 # Constants
 MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
+UPLOAD_CHUNK_SIZE = 64 * 1024  # 64KB
 TEMP_DIR = tempfile.mkdtemp(prefix="decompiler_")
 
 # PE magic bytes: MZ
@@ -48,70 +58,70 @@ def validate_binary(content: bytes) -> bool:
     return False
 
 
-def add_log(job_id: str, message: str):
-    """Add a log message to a job."""
-    if job_id in jobs:
-        jobs[job_id]["logs"].append(message)
+def combine_functions(functions: Dict[str, str]) -> str:
+    """Join per-function code into one listing (built on demand, not stored)."""
+    return "\n\n".join(
+        f"// Function: {name}\n{code}"
+        for name, code in functions.items()
+    )
+
 
+async def add_log(job_id: str, *messages: str):
+    """Add one or more log messages to a job."""
+    await append_log(job_id, *messages)
 
-def update_job_status(job_id: str, status: JobStatus, stage: str, progress: int):
+
+async def update_job_status(job_id: str, status: JobStatus, stage: str, progress: int):
     """Update job status."""
-    if job_id in jobs:
-        jobs[job_id]["status"] = status
-        jobs[job_id]["stage"] = stage
-        jobs[job_id]["progress"] = progress
+    await update_job(job_id, status=status, stage=stage, progress=progress)
 
 
-async def process_binary(job_id: str, file_path: str, gemini_mode: bool = False):
+async def process_binary(job_id: str, file_path: str, gemini_mode: bool = False, digest: str = None):
     """Background task to process the binary file."""
-    from services.ghidra_service import decompile_binary
-    from services.ai_service import refactor_code
     
     try:
         # Stage 1: Disassembling
-        update_job_status(job_id, JobStatus.DISASSEMBLING, "Disassembling binary...", 10)
-        add_log(job_id, "[*] Starting Ghidra analysis...")
-        add_log(job_id, f"[*] Loading binary: {os.path.basename(file_path)}")
+        await update_job_status(job_id, JobStatus.DISASSEMBLING, "Disassembling binary...", 10)
+        await add_log(
+            job_id,
+            "[*] Starting Ghidra analysis...",
+            f"[*] Loading binary: {os.path.basename(file_path)}",
+        )
         
         # Log mode being used
         if gemini_mode:
-            add_log(job_id, "[*] Using Gemini Mode (Gemini Pro + Flash)")
+            await add_log(job_id, "[*] Using Gemini Mode (Gemini Pro + Flash)")
         else:
-            add_log(job_id, "[*] Using Modal (Cloud LLM4Decompile) + Gemini Flash")
+            await add_log(job_id, "[*] Using Modal (Cloud LLM4Decompile) + Gemini Flash")
         
         # Decompile the binary
-        add_log(job_id, "[*] Initializing decompiler interface...")
-        functions = decompile_binary(file_path, job_id)
+        await add_log(job_id, "[*] Initializing decompiler interface...")
+        # Ghidra analysis is blocking (JVM); keep the event loop serving other requests
+        functions = await asyncio.to_thread(decompile_binary, file_path, job_id, digest)
         
-        add_log(job_id, f"[+] Found {len(functions)} functions")
-        for func_name in list(functions.keys())[:10]:  # Log first 10 functions
-            add_log(job_id, f"    - {func_name}")
+        found_logs = [f"[+] Found {len(functions)} functions"]
+        found_logs += [f"    - {func_name}" for func_name in list(functions)[:10]]  # Log first 10 functions
         if len(functions) > 10:
-            add_log(job_id, f"    ... and {len(functions) - 10} more")
+            found_logs.append(f"    ... and {len(functions) - 10} more")
+        await add_log(job_id, *found_logs)
         
         # Stage 2: Analyzing
-        update_job_status(job_id, JobStatus.ANALYZING, "Analyzing control flow...", 40)
-        add_log(job_id, "[*] Analyzing control flow graphs...")
-        add_log(job_id, "[*] Identifying function boundaries...")
+        await update_job_status(job_id, JobStatus.ANALYZING, "Analyzing control flow...", 40)
+        await add_log(job_id, "[*] Analyzing control flow graphs...", "[*] Identifying function boundaries...")
         
         # Store raw decompiled code
-        jobs[job_id]["raw_functions"] = functions
-        raw_combined = "\n\n".join([
-            f"// Function: {name}\n{code}" 
-            for name, code in functions.items()
-        ])
-        jobs[job_id]["raw_combined"] = raw_combined
+        await update_job(job_id, raw_functions=functions)
         
         # Stage 3: AI Refactoring with Modal (LLM4Decompile) or Gemini
         if gemini_mode:
             stage_name = "Gemini refactoring code..."
         else:
             stage_name = "Modal (Cloud LLM4Decompile) refactoring..."
-        update_job_status(job_id, JobStatus.AI_REFACTORING, stage_name, 60)
+        await update_job_status(job_id, JobStatus.AI_REFACTORING, stage_name, 60)
         if gemini_mode:
-            add_log(job_id, "[*] Starting Gemini Pro refactoring...")
+            await add_log(job_id, "[*] Starting Gemini Pro refactoring...")
         else:
-            add_log(job_id, "[*] Starting Modal inference (LLM4Decompile)...")
+            await add_log(job_id, "[*] Starting Modal inference (LLM4Decompile)...")
         
         # Limit functions to process (CPU inference is slow)
         # Prioritize: entry, main, and first few functions
@@ -119,49 +129,59 @@ async def process_binary(job_id: str, file_path: str, gemini_mode: bool = False)
         priority_names = ["entry", "main", "_main", "WinMain", "_start"]
         
         # Sort functions: priority first, then others
+        # Entry points are tagged critical so they jump the inference queue
         sorted_funcs = []
         other_funcs = []
+        priorities = {}
         for name, code in functions.items():
             if any(p in name.lower() for p in ["entry", "main", "start"]):
                 sorted_funcs.append((name, code))
+                priorities[name] = PRIORITY_CRITICAL
             else:
                 other_funcs.append((name, code))
+                priorities[name] = PRIORITY_STANDARD
         sorted_funcs.extend(other_funcs)
         
         # Limit to MAX_FUNCTIONS
         funcs_to_process = sorted_funcs[:MAX_FUNCTIONS]
         skipped = len(functions) - len(funcs_to_process)
         if skipped > 0:
-            add_log(job_id, f"[*] Processing {len(funcs_to_process)} functions (skipping {skipped} for speed)")
+            await add_log(job_id, f"[*] Processing {len(funcs_to_process)} functions (skipping {skipped} for speed)")
         
-        refactored_functions = {}
         total_functions = len(funcs_to_process)
-        for i, (func_name, func_code) in enumerate(funcs_to_process):
-            add_log(job_id, f"[*] Processing function: {func_name}")
-            progress = 60 + int((i / total_functions) * 35)
-            update_job_status(job_id, JobStatus.AI_REFACTORING, f"Refactoring {func_name}...", progress)
-            
-            refactored = await refactor_code(func_name, func_code, gemini_mode=gemini_mode)
-            refactored_functions[func_name] = refactored
-            add_log(job_id, f"[+] Completed: {func_name}")
+        completed = 0
+        
+        async def on_function_complete(func_name: str):
+            nonlocal completed
+            completed += 1
+            progress = 60 + int((completed / total_functions) * 35)
+            await asyncio.gather(
+                update_job_status(job_id, JobStatus.AI_REFACTORING, f"Refactored {func_name}", progress),
+                add_log(job_id, f"[+] Completed: {func_name}"),
+            )
+        
+        await add_log(job_id, f"[*] Submitting {total_functions} functions for refactoring...")
+        refactored_functions = await refactor_batch(
+            dict(funcs_to_process),
+            gemini_mode=gemini_mode,
+            on_complete=on_function_complete,
+            priorities=priorities,
+        )
         
         # Store refactored code
-        jobs[job_id]["refactored_functions"] = refactored_functions
-        refactored_combined = "\n\n".join([
-            f"// Function: {name}\n{code}" 
-            for name, code in refactored_functions.items()
-        ])
-        jobs[job_id]["refactored_combined"] = refactored_combined
+        await update_job(job_id, refactored_functions=refactored_functions)
         
         # Stage 4: Complete
-        update_job_status(job_id, JobStatus.COMPLETED, "Completed!", 100)
-        add_log(job_id, "[+] Decompilation and refactoring complete!")
-        add_log(job_id, f"[+] Processed {len(functions)} functions successfully")
+        await update_job_status(job_id, JobStatus.COMPLETED, "Completed!", 100)
+        await add_log(
+            job_id,
+            "[+] Decompilation and refactoring complete!",
+            f"[+] Processed {len(functions)} functions successfully",
+        )
         
     except Exception as e:
-        jobs[job_id]["status"] = JobStatus.FAILED
-        jobs[job_id]["error"] = str(e)
-        add_log(job_id, f"[!] Error: {str(e)}")
+        await update_job(job_id, status=JobStatus.FAILED, error=str(e))
+        await add_log(job_id, f"[!] Error: {str(e)}")
     finally:
         # Cleanup temp file
         if os.path.exists(file_path):
@@ -180,18 +200,9 @@ async def upload_binary(
         file: The binary file to decompile
         gemini_mode: If True, use Gemini ONLY. If False, uses Modal (Cloud LLM4Decompile) + Gemini cleanup.
     """
-    # Read file content
-    content = await file.read()
-    
-    # Validate file size
-    if len(content) > MAX_FILE_SIZE:
-        raise HTTPException(
-            status_code=413,
-            detail=f"File too large. Maximum size is {MAX_FILE_SIZE // (1024*1024)}MB"
-        )
-    
-    # Validate file type
-    if not validate_binary(content):
+    # Validate file type from the magic bytes before reading the rest
+    head = await file.read(len(ELF_MAGIC))
+    if not validate_binary(head):
         raise HTTPException(
             status_code=400,
             detail="Invalid file type. Only PE (.exe) and ELF binaries are supported."
@@ -200,10 +211,33 @@ async def upload_binary(
     # Generate job ID
     job_id = str(uuid.uuid4())
     
-    # Save file to temp directory
+    # Stream the upload to the temp directory, enforcing the size limit as we go
+    # and hashing chunks as they arrive (the decompile cache key), so the
+    # binary never has to be read back just to hash it
     file_path = os.path.join(TEMP_DIR, f"{job_id}_{file.filename}")
-    with open(file_path, "wb") as f:
-        f.write(content)
+    size = len(head)
+    digest = file_hasher(head)
+    async with aiofiles.open(file_path, "wb") as f:
+        await f.write(head)
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > MAX_FILE_SIZE:
+                break
+            digest.update(chunk)
+            await f.write(chunk)
+    
+    # Release the spooled upload buffer now that the binary is on disk,
+    # rather than holding it until the response is sent
+    del head, chunk
+    await file.close()
+    
+    # Validate file size
+    if size > MAX_FILE_SIZE:
+        os.remove(file_path)
+        raise HTTPException(
+            status_code=413,
+            detail=f"File too large. Maximum size is {MAX_FILE_SIZE // (1024*1024)}MB"
+        )
     
     # Determine mode string for logging
     if gemini_mode:
@@ -212,22 +246,20 @@ async def upload_binary(
         mode_str = "Modal (LLM4Decompile) + Gemini"
     
     # Initialize job
-    jobs[job_id] = {
+    await create_job(job_id, {
         "status": JobStatus.PENDING,
         "stage": "Queued",
         "progress": 0,
-        "logs": [f"[*] File received: {file.filename}", f"[*] Size: {len(content)} bytes", f"[*] Mode: {mode_str}"],
+        "logs": [f"[*] File received: {file.filename}", f"[*] Size: {size} bytes", f"[*] Mode: {mode_str}"],
         "file_path": file_path,
         "raw_functions": {},
         "refactored_functions": {},
-        "raw_combined": "",
-        "refactored_combined": "",
         "error": None,
         "gemini_mode": gemini_mode,
-    }
+    })
     
     # Start background processing
-    background_tasks.add_task(process_binary, job_id, file_path, gemini_mode)
+    background_tasks.add_task(process_binary, job_id, file_path, gemini_mode, digest.hexdigest())
     
     return UploadResponse(
         job_id=job_id,
@@ -238,10 +270,9 @@ async def upload_binary(
 @router.get("/job/{job_id}", response_model=JobStatusResponse)
 async def get_job_status(job_id: str):
     """Get the status of a decompilation job."""
-    if job_id not in jobs:
+    job = await get_job(job_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
-    
-    job = jobs[job_id]
     return JobStatusResponse(
         job_id=job_id,
         status=job["status"],
@@ -255,11 +286,10 @@ async def get_job_status(job_id: str):
 @router.get("/job/{job_id}/result", response_model=JobResultResponse)
 async def get_job_result(job_id: str):
     """Get the result of a completed decompilation job."""
-    if job_id not in jobs:
+    job = await get_job(job_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
     
-    job = jobs[job_id]
-    
     if job["status"] not in [JobStatus.COMPLETED, JobStatus.FAILED]:
         raise HTTPException(
             status_code=400,
@@ -281,8 +311,8 @@ async def get_job_result(job_id: str):
         job_id=job_id,
         status=job["status"],
         functions=functions,
-        raw_combined=job.get("raw_combined", ""),
-        refactored_combined=job.get("refactored_combined", ""),
+        raw_combined=combine_functions(raw_funcs),
+        refactored_combined=combine_functions(refactored_funcs),
         error=job["error"],
     )
 
@@ -295,16 +325,14 @@ async def warmup_model():
     Call this endpoint before your demo to ensure the first upload
     doesn't have a 1-2 minute model loading delay.
     """
-    from services.llm_service import get_model, is_available
-    
-    if not is_available():
+    if not llm_service.is_available():
         return {
             "status": "unavailable",
             "message": "LLM4Decompile dependencies not installed. Install with: pip install torch transformers accelerate bitsandbytes"
         }
     
     try:
-        model, tokenizer = get_model()
+        model, tokenizer = await asyncio.to_thread(llm_service.get_model)
         if model is not None:
             return {
                 "status": "ready",
@@ -325,14 +353,15 @@ async def warmup_model():
 @router.get("/model-status")
 async def get_model_status():
     """Check the status of the LLM4Decompile model."""
-    from services.llm_service import is_available, _model
-    from services.gemini_service import is_available as gemini_available
-    
     return {
-        "llm4decompile_available": is_available(),
-        "model_loaded": _model is not None,
-        "gemini_available": gemini_available(),
+        "llm4decompile_available": llm_service.is_available(),
+        "model_loaded": llm_service._model is not None,
+        "gemini_available": GEMINI_AVAILABLE,
         "openai_configured": bool(os.environ.get("OPENAI_API_KEY")),
+        "llm_cache": llm_cache.stats,
+        "semantic_cache": semantic_cache.stats,
+        "gemini_cleanup": gemini_service.cleanup_stats,
+        "refactor_queue": refactor_stats,
     }
 
 
@@ -344,9 +373,7 @@ async def cleanup_code(request: dict):
     This endpoint removes unused variables, simplifies variable names,
     and cleans up redundant code patterns.
     """
-    from services.gemini_service import cleanup_decompiled_code_async, is_available
-    
-    if not is_available():
+    if not GEMINI_AVAILABLE:
         raise HTTPException(
             status_code=503,
             detail="Gemini API not configured. Set GEMINI_API_KEY environment variable."
@@ -359,7 +386,7 @@ async def cleanup_code(request: dict):
         raise HTTPException(status_code=400, detail="No code provided")
     
     try:
-        cleaned_code = await cleanup_decompiled_code_async(code, function_name)
+        cleaned_code = await gemini_service.cleanup_decompiled_code_async(code, function_name)
         return {
             "original_code": code,
             "cleaned_code": cleaned_code,
@@ -377,9 +404,7 @@ async def analyze_malware(request: dict):
     This endpoint examines the combined decompiled code and looks for
     malicious patterns like keyloggers, backdoors, ransomware, etc.
     """
-    from services.gemini_service import analyze_for_malware_async, is_available
-    
-    if not is_available():
+    if not GEMINI_AVAILABLE:
         raise HTTPException(
             status_code=503,
             detail="Gemini API not configured. Set GEMINI_API_KEY environment variable."
@@ -391,7 +416,7 @@ async def analyze_malware(request: dict):
         raise HTTPException(status_code=400, detail="No code provided")
     
     try:
-        result = await analyze_for_malware_async(code)
+        result = await gemini_service.analyze_for_malware_async(code)
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Malware analysis failed: {str(e)}")
@@ -405,35 +430,32 @@ async def get_job_malware_analysis(job_id: str):
     This runs Gemini Flash analysis on the combined refactored code
     from a completed job.
     """
-    from services.gemini_service import analyze_for_malware_async, is_available
-    
-    if job_id not in jobs:
+    job = await get_job(job_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
     
-    job = jobs[job_id]
-    
     if job["status"] != JobStatus.COMPLETED:
         raise HTTPException(
             status_code=400,
             detail="Job must be completed before malware analysis"
         )
     
-    if not is_available():
+    if not GEMINI_AVAILABLE:
         raise HTTPException(
             status_code=503,
             detail="Gemini API not configured. Set GEMINI_API_KEY environment variable."
         )
     
     # Get the combined refactored code
-    combined_code = job.get("refactored_combined", "")
+    combined_code = combine_functions(job.get("refactored_functions", {}))
     if not combined_code:
-        combined_code = job.get("raw_combined", "")
+        combined_code = combine_functions(job.get("raw_functions", {}))
     
     if not combined_code:
         raise HTTPException(status_code=400, detail="No code available for analysis")
     
     try:
-        result = await analyze_for_malware_async(combined_code)
+        result = await gemini_service.analyze_for_malware_async(combined_code)
         return {
             "job_id": job_id,
             "analysis": result
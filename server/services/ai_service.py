@@ -10,14 +10,33 @@ Supports multiple modes:
 - Default (Gemini Mode OFF): Modal LLM4Decompile + Gemini cleanup
 """
 
-from typing import Dict, Optional
+import asyncio
+import logging
+import os
+import re
+import weakref
+from enum import Enum
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
 
 # Import LLM4Decompile service (local fallback)
-from services.llm_service import decompile_to_c, is_available as llm4decompile_available, mock_decompile_to_c
+from services.llm_service import (
+    EARLY_STOP as LOCAL_EARLY_STOP,
+    FAST_PATH as LOCAL_FAST_PATH,
+    MAX_INPUT_TOKENS as LOCAL_MAX_INPUT_TOKENS,
+    MAX_NEW_TOKENS as LOCAL_MAX_NEW_TOKENS,
+    MODEL_ID as LOCAL_MODEL_ID,
+    QUANTIZED_MODEL_ID as LOCAL_QUANTIZED_MODEL_ID,
+    REPETITION_PENALTY as LOCAL_REPETITION_PENALTY,
+    decompile_to_c_batch,
+    is_available as llm4decompile_available,
+    mock_decompile_to_c,
+)
 
 # Import Gemini service for code cleanup and refactoring
 from services.gemini_service import (
+    GEMINI_REFACTOR_FAST_MODEL,
     cleanup_decompiled_code_async,
+    refactor_batch_with_gemini_async,
     refactor_with_gemini_async,
     is_available as gemini_available
 )
@@ -25,15 +44,319 @@ from services.gemini_service import (
 # Import Modal client for cloud GPU inference
 from services.modal_client import (
     decompile_with_modal,
+    decompile_batch_with_modal,
+    stream_decompile_with_modal,
     is_modal_available,
+    PRIORITY_CRITICAL,
+    PRIORITY_STANDARD,
 )
 
+from services import llm_cache
+from services.http_pool import per_loop
+
+# Per-function progress goes through logging (queued, see main.py) instead of
+# print(), so concurrent refactors don't contend on a blocking stdout write
+log = logging.getLogger("refactor")
+
+# Max concurrent per-function refactor/cleanup calls (each is remote I/O).
+# Shared by every job on the event loop so concurrent uploads don't trigger
+# 429s; one semaphore per loop (see http_pool.per_loop).
+REFACTOR_CONCURRENCY = int(os.environ.get("REFACTOR_CONCURRENCY", "4"))
+_refactor_semaphores = weakref.WeakKeyDictionary()
+
+# Queue depth / in-flight refactor calls across all jobs, for /model-status
+refactor_stats = {"queued": 0, "in_flight": 0}
+
+# Minimum number of functions before an opted-in offline refactor goes
+# through the (half-price, up-to-24h) Gemini Batch API
+BATCH_API_MIN_FUNCTIONS = int(os.environ.get("BATCH_API_MIN_FUNCTIONS", "32"))
+
+# Gemini-mode functions estimated under this many tokens (and without gotos
+# to untangle) are refactored by the fast model instead of Pro
+SMALL_FUNCTION_TOKENS = int(os.environ.get("SMALL_FUNCTION_TOKENS", "300"))
+
+# Signatures of this many functions are shared with Gemini as binary-wide context
+CONTEXT_MAX_SIGNATURES = int(os.environ.get("CONTEXT_MAX_SIGNATURES", "10"))
+
+# Functions longer than this stream Modal output straight into Gemini cleanup
+STREAM_PIPELINE_MIN_CHARS = int(os.environ.get("STREAM_PIPELINE_MIN_CHARS", "2048"))
+
+# Closing brace of a top-level declaration in streamed Modal output
+_TOP_LEVEL_END = re.compile(r'^\}[^\n]*\n', re.MULTILINE)
+
+_BLOCK_COMMENT = re.compile(r'/\*.*?\*/', re.DOTALL)
+
+# Function body that is empty, a single bare `return [value];`, or a single
+# forwarding call (`[return] FUN_00401000(param_1, 0x10);`, optionally
+# followed by `return;`)
+_TRIVIAL_BODY = re.compile(
+    r'\s*(?:(?:return\s+)?(?!(?:if|while|for|switch)\b)[\w.>-]+\s*\([^;{}]*\)\s*;\s*)?'
+    r'(?:return(?:\s+[\w()]*)?\s*;)?\s*'
+)
+
+
+def is_trivial_function(code: str) -> bool:
+    """
+    Check if a function is too small to be worth an LLM round trip
+    (thunks like `return FUN_00401000(param_1);`, empty stubs, one-liners).
+    """
+    stripped = code.strip()
+    if stripped.count('\n') < 2 or len(stripped) < 64:
+        return True
+    body_start = stripped.find('{')
+    body_end = stripped.rfind('}')
+    if body_start != -1 and body_end > body_start:
+        return _TRIVIAL_BODY.fullmatch(stripped[body_start + 1:body_end]) is not None
+    return False
+
+
+async def bounded_map(
+    func: Callable[[Any], Awaitable[Any]],
+    items: Sequence[Any],
+    concurrency: int = REFACTOR_CONCURRENCY,
+) -> List[Any]:
+    """
+    Await func(item) for every item with a rolling window of `concurrency`
+    workers, each call also holding the process-wide refactor semaphore.
+    
+    Unlike gather() over every item, only the window's calls exist at a
+    time, so a binary with thousands of functions keeps a steady request
+    pressure instead of queueing thousands of tasks.
+    
+    Returns:
+        Results in input order; a raised exception is returned in place of
+        its result (like gather(return_exceptions=True))
+    """
+    results: List[Any] = [None] * len(items)
+    pending = iter(enumerate(items))
+    refactor_stats["queued"] += len(items)
+    started = 0
+    
+    async def _worker():
+        nonlocal started
+        for index, item in pending:
+            started += 1
+            refactor_stats["queued"] -= 1
+            async with per_loop(_refactor_semaphores, lambda: asyncio.Semaphore(REFACTOR_CONCURRENCY)):
+                refactor_stats["in_flight"] += 1
+                try:
+                    results[index] = await func(item)
+                except Exception as e:
+                    results[index] = e
+                finally:
+                    refactor_stats["in_flight"] -= 1
+    
+    try:
+        await asyncio.gather(*[_worker() for _ in range(min(concurrency, len(items)))])
+    finally:
+        refactor_stats["queued"] -= len(items) - started
+    return results
+
+
+def estimate_tokens(code: str) -> int:
+    """Rough token count for routing decisions (~4 characters per token)."""
+    return len(code) // 4
+
+
+def is_simple_function(code: str) -> bool:
+    """Check if a function is short and goto-free enough for the fast refactor model."""
+    return estimate_tokens(code) < SMALL_FUNCTION_TOKENS and "goto" not in code
+
+
+def build_signature_context(functions: Dict[str, str]) -> str:
+    """
+    Build the binary-wide context (one prototype per line) once per binary.
+    
+    The same string is passed to every per-function call so the prompt
+    prefix stays byte-identical across the binary.
+    """
+    signatures = []
+    for code in list(functions.values())[:CONTEXT_MAX_SIGNATURES]:
+        header = _BLOCK_COMMENT.sub("", code.partition("{")[0])
+        signatures.append(" ".join(header.split()) + ";")
+    return "\n".join(signatures)
+
+
+def group_identical_functions(functions: Dict[str, str]) -> Dict[str, List[str]]:
+    """
+    Group functions whose code is byte-identical (shared thunks, statically
+    linked helpers) so each distinct body is sent to the LLM only once.
+    
+    Returns:
+        Dict mapping the first name of each group to every name in the group
+    """
+    by_code: Dict[str, List[str]] = {}
+    for name, code in functions.items():
+        by_code.setdefault(code, []).append(name)
+    return {names[0]: names for names in by_code.values()}
+
+
+async def _refine_and_cleanup_streaming(function_name: str, raw_code: str, priority: str) -> str:
+    """
+    Modal refinement + Gemini cleanup with the two stages overlapped.
+    
+    Each top-level declaration is handed to Gemini as soon as its closing
+    brace streams in, so cleanup of earlier declarations runs while Modal is
+    still decoding the rest. If the stream breaks off partway, the cleanups
+    already started are cancelled and the function is refined unstreamed.
+    """
+    cleanups: List[asyncio.Task] = []
+    buffer = ""
+    cleaned = None
+    try:
+        async for chunk in stream_decompile_with_modal(raw_code, priority=priority):
+            buffer += chunk
+            match = _TOP_LEVEL_END.search(buffer)
+            while match:
+                segment, buffer = buffer[:match.end()], buffer[match.end():]
+                cleanups.append(asyncio.create_task(cleanup_decompiled_code_async(segment, function_name)))
+                match = _TOP_LEVEL_END.search(buffer)
+        if buffer.strip():
+            cleanups.append(asyncio.create_task(cleanup_decompiled_code_async(buffer, function_name)))
+        cleaned = await asyncio.gather(*cleanups)
+    except Exception as e:
+        log.warning("[!] Streamed refinement failed for %s, retrying unstreamed: %s", function_name, e)
+    finally:
+        # Covers cancellation too: no cleanup outlives its stream
+        for task in cleanups:
+            task.cancel()
+    
+    if cleaned is None:
+        refined = await decompile_with_modal(raw_code, priority=priority)
+        return await cleanup_decompiled_code_async(refined, function_name)
+    return "\n\n".join(part.strip() for part in cleaned)
+
+
+class Backend(str, Enum):
+    """Stage-1 refactoring backend, in fallback priority order."""
+    GEMINI = "gemini"
+    MODAL = "modal"
+    LOCAL = "local"
+    MOCK = "mock"
+
+
+def select_backend(gemini_mode: bool = False) -> Backend:
+    """Pick the first available backend for the requested mode."""
+    if gemini_mode and gemini_available():
+        return Backend.GEMINI
+    if is_modal_available():
+        return Backend.MODAL
+    if llm4decompile_available():
+        return Backend.LOCAL
+    return Backend.MOCK
+
+
+async def _refactor_gemini(function_name: str, raw_code: str, context: Optional[str], priority: str) -> str:
+    # Short, simple functions use the fast model; the rest go to Gemini Pro
+    if is_simple_function(raw_code):
+        log.info("[*] Refactoring %s with %s (short function)...", function_name, GEMINI_REFACTOR_FAST_MODEL)
+        return await refactor_with_gemini_async(
+            raw_code, function_name, model=GEMINI_REFACTOR_FAST_MODEL, context=context
+        )
+    log.info("[*] Refactoring %s with Gemini Pro (logic/structure)...", function_name)
+    return await refactor_with_gemini_async(raw_code, function_name, context=context)
+
+
+async def _refine_modal(function_name: str, raw_code: str, context: Optional[str], priority: str) -> str:
+    log.info("[*] Processing %s with Modal (Cloud LLM4Decompile)...", function_name)
+    return await decompile_with_modal(raw_code, priority=priority)
+
+
+def _local_cache_key(code: str) -> str:
+    # Every local setting that changes the output, so toggling one misses
+    # instead of serving results produced under the old value
+    return llm_cache.make_key(
+        model=LOCAL_MODEL_ID,
+        quantized=LOCAL_QUANTIZED_MODEL_ID,
+        max_tokens=LOCAL_MAX_NEW_TOKENS,
+        max_input_tokens=LOCAL_MAX_INPUT_TOKENS,
+        repetition_penalty=LOCAL_REPETITION_PENALTY,
+        early_stop=LOCAL_EARLY_STOP,
+        fast_path=LOCAL_FAST_PATH,
+        code=code,
+    )
+
+
+async def _decompile_local(codes: List[str]) -> List[str]:
+    """
+    decompile_to_c_batch behind llm_cache (decoding is greedy, so the output
+    is deterministic). Only cache misses reach the model, and outputs that
+    fell back to the input (garbled or failed) are not cached.
+    """
+    keys = [_local_cache_key(code) for code in codes]
+    results = list(await asyncio.gather(*[llm_cache.get(key) for key in keys]))
+    misses = [i for i, cached in enumerate(results) if cached is None]
+    if misses:
+        # Local generation is CPU/GPU-bound; run it off the event loop
+        refined = await asyncio.to_thread(decompile_to_c_batch, [codes[i] for i in misses])
+        for i, code in zip(misses, refined):
+            results[i] = code
+            if code != codes[i]:
+                await llm_cache.set(keys[i], code)
+    return results
+
+
+# Single-function local refines arriving within this window are coalesced
+# into one decompile_to_c_batch call
+LOCAL_BATCH_WINDOW_MS = float(os.environ.get("LLM4DECOMPILE_BATCH_WINDOW_MS", "15"))
+
+
+class _LocalBatcher:
+    """Micro-batches concurrent local LLM4Decompile calls on one event loop."""
+    
+    def __init__(self):
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+    
+    async def submit(self, raw_code: str) -> str:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((raw_code, future))
+        # The first caller of a window schedules its flush
+        if len(self._pending) == 1:
+            asyncio.create_task(self._flush())
+        return await future
+    
+    async def _flush(self):
+        await asyncio.sleep(LOCAL_BATCH_WINDOW_MS / 1000)
+        batch, self._pending = self._pending, []
+        try:
+            codes = await _decompile_local([raw_code for raw_code, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), code in zip(batch, codes):
+            if not future.done():
+                future.set_result(code)
+
+
+_local_batchers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _LocalBatcher]" = weakref.WeakKeyDictionary()
+
+
+async def _refine_local(function_name: str, raw_code: str, context: Optional[str], priority: str) -> str:
+    log.info("[*] Processing %s with local LLM4Decompile...", function_name)
+    return await per_loop(_local_batchers, _LocalBatcher).submit(raw_code)
+
+
+async def _refine_mock(function_name: str, raw_code: str, context: Optional[str], priority: str) -> str:
+    log.warning("[!] LLM4Decompile not available, using mock transformation")
+    return mock_decompile_to_c(raw_code)
+
+
+_BACKENDS: Dict[Backend, Callable[[str, str, Optional[str], str], Awaitable[str]]] = {
+    Backend.GEMINI: _refactor_gemini,
+    Backend.MODAL: _refine_modal,
+    Backend.LOCAL: _refine_local,
+    Backend.MOCK: _refine_mock,
+}
+
 
 async def refactor_code(
     function_name: str,
     raw_code: str,
-    context_functions: Optional[Dict[str, str]] = None,
+    context: Optional[str] = None,
     gemini_mode: bool = False,
+    priority: str = PRIORITY_STANDARD,
 ) -> str:
     """
     Refactor decompiled code using LLM4Decompile (Modal) and/or Gemini.
@@ -41,66 +364,205 @@ async def refactor_code(
     Args:
         function_name: Name of the function being refactored
         raw_code: Raw decompiled C code from Ghidra
-        context_functions: Optional dict of other function signatures (unused for now)
+        context: Optional binary-wide signatures from build_signature_context()
         gemini_mode: If True, use Gemini ONLY. If False, use Modal + Gemini cleanup.
+        priority: PRIORITY_CRITICAL for entry points, else PRIORITY_STANDARD
         
     Returns:
         Refactored and cleaned C code
     """
     
-    # Gemini-only mode: Single pass refactoring with Gemini Pro
-    # Cleanup with Gemini Flash is done on-demand when user requests it
-    if gemini_mode:
-        if gemini_available():
-            # Gemini Pro - Fix logic and structure
-            print(f"[*] Refactoring {function_name} with Gemini Pro (logic/structure)...")
-            refactored = await refactor_with_gemini_async(raw_code, function_name)
-            print(f"[+] Gemini Pro refactoring completed: {function_name}")
-            # Note: Gemini Flash cleanup is now on-demand via /api/cleanup endpoint
-            return refactored
-        else:
-            print(f"[!] Gemini Mode requested but Gemini not available, falling back to Modal")
+    if is_trivial_function(raw_code):
+        log.info("[*] Skipping LLM for trivial function: %s", function_name)
+        return raw_code
     
-    # Default mode: Use Modal (cloud LLM4Decompile) + Gemini cleanup
-    if is_modal_available():
-        print(f"[*] Processing {function_name} with Modal (Cloud LLM4Decompile)...")
-        refactored = await decompile_with_modal(raw_code)
-        print(f"[+] Modal inference completed: {function_name}")
-        
-        # Step 2: Gemini cleanup (if available)
-        if gemini_available():
-            print(f"[*] Cleaning up {function_name} with Gemini...")
-            refactored = await cleanup_decompiled_code_async(refactored, function_name)
-            print(f"[+] Gemini cleanup completed: {function_name}")
-        
+    backend = select_backend(gemini_mode)
+    if gemini_mode and backend is not Backend.GEMINI:
+        log.warning("[!] Gemini Mode requested but Gemini not available, falling back to %s", backend.value)
+    
+    # Long functions: overlap Modal decoding with Gemini cleanup
+    if backend is Backend.MODAL and gemini_available() and len(raw_code) > STREAM_PIPELINE_MIN_CHARS:
+        log.info("[*] Processing %s with Modal + Gemini cleanup (streamed)...", function_name)
+        refactored = await _refine_and_cleanup_streaming(function_name, raw_code, priority)
+        log.info("[+] Modal + Gemini cleanup completed: %s", function_name)
         return refactored
     
-    # Fallback: Local LLM4Decompile + Gemini cleanup
-    print(f"[*] Processing {function_name} with local LLM4Decompile...")
+    refactored = await _BACKENDS[backend](function_name, raw_code, context, priority)
+    log.info("[+] %s refactoring completed: %s", backend.value, function_name)
     
-    # Step 1: LLM4Decompile refinement
-    if llm4decompile_available():
-        refactored = decompile_to_c(raw_code)
-        print(f"[+] LLM4Decompile completed: {function_name}")
-    else:
-        # Use mock transformation if LLM4Decompile not available
-        print(f"[!] LLM4Decompile not available, using mock transformation")
-        refactored = mock_decompile_to_c(raw_code)
+    # Gemini mode is single pass; Flash cleanup is on-demand via /api/cleanup
+    if backend is Backend.GEMINI:
+        return refactored
     
     # Step 2: Gemini cleanup (if available)
     if gemini_available():
-        print(f"[*] Cleaning up {function_name} with Gemini...")
+        log.info("[*] Cleaning up %s with Gemini...", function_name)
         refactored = await cleanup_decompiled_code_async(refactored, function_name)
-        print(f"[+] Gemini cleanup completed: {function_name}")
+        log.info("[+] Gemini cleanup completed: %s", function_name)
     else:
-        print(f"[!] Gemini not available, skipping cleanup step")
+        log.warning("[!] Gemini not available, skipping cleanup step")
     
     return refactored
 
 
+async def refactor_batch(
+    functions: Dict[str, str],
+    gemini_mode: bool = False,
+    on_complete: Optional[Callable[[str], Awaitable[None]]] = None,
+    priorities: Optional[Dict[str, str]] = None,
+) -> Dict[str, str]:
+    """
+    Refactor several functions, batching the Modal inference into one request
+    (or the local LLM4Decompile inference into padded generate batches).
+    With Gemini cleanup on, Modal functions longer than
+    STREAM_PIPELINE_MIN_CHARS are streamed one by one instead, overlapping
+    their cleanup with decoding.
+    
+    Gemini mode and the mock fallback have no batch path, so they go through
+    refactor_code() with at most REFACTOR_CONCURRENCY calls in flight.
+    
+    Args:
+        functions: Dict mapping function names to raw decompiled code
+        gemini_mode: If True, use Gemini ONLY. If False, use Modal + Gemini cleanup.
+        on_complete: Optional async callback awaited with each function name once it is done
+        priorities: Optional dict mapping function names to a priority label;
+            critical functions are dispatched ahead of standard ones
+        
+    Returns:
+        Dict mapping function names to refactored code
+    """
+    priorities = priorities or {}
+    results = {}
+    
+    # Thunks and empty stubs carry nothing for the model to improve
+    for name, code in functions.items():
+        if is_trivial_function(code):
+            log.info("[*] Skipping LLM for trivial function: %s", name)
+            results[name] = code
+            if on_complete:
+                await on_complete(name)
+    
+    # Duplicates ride along with their group's first function; a group is
+    # critical if any member is
+    groups = group_identical_functions({name: code for name, code in functions.items() if name not in results})
+    pending = {name: functions[name] for name in groups}
+    group_priorities = {
+        name: PRIORITY_CRITICAL if any(priorities.get(member) == PRIORITY_CRITICAL for member in members)
+        else PRIORITY_STANDARD
+        for name, members in groups.items()
+    }
+    
+    # Critical functions are dispatched first; results keep input order
+    dispatch_order = sorted(pending, key=lambda name: group_priorities[name] != PRIORITY_CRITICAL)
+    
+    async def _completed(name: str):
+        if on_complete:
+            for member in groups[name]:
+                await on_complete(member)
+    
+    backend = select_backend(gemini_mode)
+    if backend not in (Backend.MODAL, Backend.LOCAL):
+        context = build_signature_context(functions)
+        
+        async def _work(name: str) -> str:
+            try:
+                return await refactor_code(
+                    name,
+                    pending[name],
+                    context=context,
+                    gemini_mode=gemini_mode,
+                    priority=group_priorities[name],
+                )
+            finally:
+                await _completed(name)
+    else:
+        if not pending:
+            return {name: results[name] for name in functions}
+        
+        # Long functions stream through Modal with their cleanup overlapped
+        # (see _refine_and_cleanup_streaming); the rest share one batch
+        streamed = set()
+        if backend is Backend.MODAL and gemini_available():
+            streamed = {name for name, code in pending.items() if len(code) > STREAM_PIPELINE_MIN_CHARS}
+        batched = {name: code for name, code in pending.items() if name not in streamed}
+        
+        if backend is Backend.MODAL:
+            log.info("[*] Processing %s functions with Modal (%s batched, %s streamed)...",
+                     len(pending), len(batched), len(streamed))
+            refined = {}
+            if batched:
+                refined = await decompile_batch_with_modal(batched, priorities=group_priorities)
+                log.info("[+] Modal batch inference completed")
+        else:
+            log.info("[*] Processing %s functions with local LLM4Decompile (batched)...", len(pending))
+            codes = await _decompile_local([pending[name] for name in dispatch_order])
+            refined = dict(zip(dispatch_order, codes))
+            log.info("[+] Local LLM4Decompile batch completed")
+        
+        async def _work(name: str) -> str:
+            try:
+                if name in streamed:
+                    log.info("[*] Processing %s with Modal + Gemini cleanup (streamed)...", name)
+                    cleaned = await _refine_and_cleanup_streaming(name, pending[name], group_priorities[name])
+                    log.info("[+] Modal + Gemini cleanup completed: %s", name)
+                    return cleaned
+                if not gemini_available():
+                    return refined[name]
+                log.info("[*] Cleaning up %s with Gemini...", name)
+                cleaned = await cleanup_decompiled_code_async(refined[name], name)
+                log.info("[+] Gemini cleanup completed: %s", name)
+                return cleaned
+            finally:
+                await _completed(name)
+    
+    outcomes = await bounded_map(_work, dispatch_order)
+    for name, outcome in zip(dispatch_order, outcomes):
+        if isinstance(outcome, Exception):
+            log.warning("[!] Refactoring failed for %s: %s", name, outcome)
+            outcome = pending[name]  # Keep the original code on failure
+        results[name] = outcome
+    return _expand_groups(results, groups, functions)
+
+
+def _expand_groups(
+    results: Dict[str, str],
+    groups: Dict[str, List[str]],
+    functions: Dict[str, str],
+) -> Dict[str, str]:
+    """Copy each group's result to all its members, in input order."""
+    for name, members in groups.items():
+        for member in members:
+            results[member] = results[name]
+    return {name: results[name] for name in functions}
+
+
+async def refactor_all_functions_batch(functions: Dict[str, str]) -> Dict[str, str]:
+    """
+    Refactor all functions with Gemini through the provider's Batch API.
+    
+    Cheaper than per-function calls but completes asynchronously, so only
+    suitable for offline whole-binary refactors.
+    
+    Args:
+        functions: Dict mapping function names to raw decompiled code
+        
+    Returns:
+        Dict mapping function names to refactored code
+    """
+    results = {name: code for name, code in functions.items() if is_trivial_function(code)}
+    groups = group_identical_functions({name: code for name, code in functions.items() if name not in results})
+    if groups:
+        results.update(await refactor_batch_with_gemini_async(
+            {name: functions[name] for name in groups},
+            context=build_signature_context(functions),
+        ))
+    return _expand_groups(results, groups, functions)
+
+
 async def refactor_all_functions(
     functions: Dict[str, str],
     gemini_mode: bool = False,
+    use_batch_api: bool = False,
 ) -> Dict[str, str]:
     """
     Refactor all functions in a binary using Modal/LLM4Decompile and Gemini.
@@ -108,15 +570,28 @@ async def refactor_all_functions(
     Args:
         functions: Dict mapping function names to raw decompiled code
         gemini_mode: If True, use Gemini for refactoring instead of LLM4Decompile
+        use_batch_api: If True (caller accepts hours-long completion), Gemini
+            mode runs with more than BATCH_API_MIN_FUNCTIONS functions go
+            through refactor_all_functions_batch()
         
     Returns:
         Dict mapping function names to refactored code
     """
-    refactored = {}
+    if use_batch_api and gemini_mode and gemini_available() and len(functions) > BATCH_API_MIN_FUNCTIONS:
+        return await refactor_all_functions_batch(functions)
     
-    for name, code in functions.items():
-        refactored[name] = await refactor_code(
-            name, code, gemini_mode=gemini_mode
-        )
+    context = build_signature_context(functions)
+    groups = group_identical_functions(functions)
+    names = list(groups)
+    results = await bounded_map(
+        lambda name: refactor_code(name, functions[name], context=context, gemini_mode=gemini_mode),
+        names,
+    )
     
-    return refactored
+    refactored = {}
+    for name, result in zip(names, results):
+        if isinstance(result, Exception):
+            log.warning("[!] Refactoring failed for %s: %s", name, result)
+            result = functions[name]  # Keep the original code on failure
+        refactored[name] = result
+    return _expand_groups(refactored, groups, functions)
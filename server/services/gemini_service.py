@@ -8,38 +8,326 @@ Two-Pass Refactoring Pipeline:
 This replaces the previous LLM4Decompile model for faster, higher-quality results.
 """
 
+import asyncio
+import importlib.util
+import json
+import logging
 import os
 import re
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import Optional
-from google import genai
+
+from services import llm_cache
+from services.http_pool import close_http_client, get_http_client, per_loop
+
+# google-genai is optional: without it the service reports itself
+# unavailable and callers keep the original code. The SDK is large, so it is
+# only located here and imported when the first client is built.
+try:
+    GENAI_AVAILABLE = importlib.util.find_spec("google.genai") is not None
+except ModuleNotFoundError:
+    GENAI_AVAILABLE = False
+if not GENAI_AVAILABLE:
+    print("[!] google-genai not installed. Gemini refactoring disabled.")
+
+# Per-function progress goes through the queued "refactor" logger (see
+# main.py) so concurrent cleanups don't contend on a blocking stdout write
+log = logging.getLogger("refactor")
 
 # Configuration
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 
+# API host, for warming the shared connection pool at startup
+GEMINI_API_ORIGIN = "https://generativelanguage.googleapis.com"
+
 # Pass 1: Gemini 3 Pro for logic/structure refactoring
 GEMINI_REFACTOR_MODEL = "gemini-3-pro-preview"
 
+# Pass 1 for short, goto-free functions, which Flash handles as well as Pro
+GEMINI_REFACTOR_FAST_MODEL = os.environ.get("GEMINI_REFACTOR_FAST_MODEL", "gemini-2.0-flash")
+
 # Pass 2: Gemini Flash for variable naming/readability cleanup
 GEMINI_CLEANUP_MODEL = "gemini-2.0-flash"  # Using 2.0-flash (fast and stable)
 
-# Initialize Gemini client
-_client = None
+# Set GEMINI_CACHE_DISABLE=true to always call the API instead of reusing
+# memoized responses for identical requests
+GEMINI_CACHE_DISABLED = os.environ.get("GEMINI_CACHE_DISABLE", "").lower() in ("true", "1", "yes")
+
+# Max in-flight Gemini calls for the *_multiple_functions_async helpers
+GEMINI_CONCURRENCY = int(os.environ.get("GEMINI_CONCURRENCY", "8"))
+
+# Packed cleanup (several small functions per request, see
+# cleanup_batched_async); GEMINI_BATCH_CLEANUP=false sends one request per
+# function, for comparison
+GEMINI_BATCH_CLEANUP = os.environ.get("GEMINI_BATCH_CLEANUP", "true").lower() in ("true", "1", "yes")
+CLEANUP_BATCH_CHARS = int(os.environ.get("GEMINI_CLEANUP_BATCH_CHARS", "12000"))
+
+# Rename Ghidra's generic identifiers (local_10, param_1, uVar2, DAT_...) to
+# short placeholders before cleanup, leaving Gemini only the semantic naming
+GEMINI_PRERENAME = os.environ.get("GEMINI_PRERENAME", "false").lower() in ("true", "1", "yes")
+
+# Attempts (including the first) for rate-limited / 5xx / timed-out Gemini
+# calls, and the per-attempt timeout that turns a hung request into a retry
+GEMINI_RETRY_ATTEMPTS = int(os.environ.get("GEMINI_RETRY_ATTEMPTS", "5"))
+GEMINI_REQUEST_TIMEOUT_SECONDS = float(os.environ.get("GEMINI_REQUEST_TIMEOUT_SECONDS", "60"))
+
+# Client-side request budget so bursts stay under the project's quota
+# instead of bouncing off 429s (0 disables)
+GEMINI_REQUESTS_PER_MINUTE = int(os.environ.get("GEMINI_REQUESTS_PER_MINUTE", "500"))
+
+# Larger inputs keep their first TRUNCATE_HEAD_LINES and last
+# TRUNCATE_TAIL_LINES lines; past this size extra context stops improving
+# the output but still adds latency and token spend
+GEMINI_MAX_INPUT_TOKENS = int(os.environ.get("GEMINI_MAX_INPUT_TOKENS", "8000"))
+GEMINI_MALWARE_MAX_INPUT_TOKENS = int(os.environ.get("GEMINI_MALWARE_MAX_INPUT_TOKENS", "32000"))
+TRUNCATE_HEAD_LINES = 400
+TRUNCATE_TAIL_LINES = 50
+
+# Token budgets become character cutoffs through a chars-per-token ratio,
+# measured once with count_tokens on the first input big enough to matter
+# (Gemini models share a tokenizer); ~4 is typical for C until then
+TOKEN_RATIO_MIN_CHARS = 4096
+_chars_per_token = 4.0
+_token_ratio_measured = False
+
+# Streamed replies are abandoned (and the original code kept) when they grow
+# past this many characters or stall for this long between chunks
+GEMINI_MAX_OUTPUT_CHARS = int(os.environ.get("GEMINI_MAX_OUTPUT_CHARS", "48000"))
+GEMINI_STREAM_IDLE_SECONDS = float(os.environ.get("GEMINI_STREAM_IDLE_SECONDS", "30"))
+
+# Batch API polling (jobs complete asynchronously, within 24h)
+BATCH_POLL_INITIAL_SECONDS = 10
+BATCH_POLL_MAX_SECONDS = 300
+_BATCH_DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+# Explicit context caches for the static system prompts, created once per
+# process per (model, prompt) and reused until shortly before they expire
+PROMPT_CACHE_TTL_SECONDS = 3600
+_prompt_caches: dict[tuple[str, str], tuple[Optional[str], float]] = {}
+
+# Gemini clients, semaphores and locks are bound to an event loop, so each
+# running loop gets its own (see http_pool.per_loop); the sync API outside
+# any loop uses _sync_client
+_clients = weakref.WeakKeyDictionary()
+_semaphores = weakref.WeakKeyDictionary()
+_prompt_cache_locks = weakref.WeakKeyDictionary()
+_sync_client = None
+
+
+def _gemini_semaphore() -> asyncio.Semaphore:
+    """Limit on in-flight calls (GEMINI_CONCURRENCY) for the running loop."""
+    return per_loop(_semaphores, lambda: asyncio.Semaphore(GEMINI_CONCURRENCY))
+
+
+class _RateLimiter:
+    """Async token bucket: up to `rate` requests per `period` seconds, bursting to `rate`."""
+    
+    def __init__(self, rate: int, period: float = 60.0):
+        self.rate = rate
+        self.period = period
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._locks = weakref.WeakKeyDictionary()
+    
+    async def acquire(self):
+        """Wait for a request slot. Waiters are served in arrival order."""
+        if self.rate <= 0:
+            return
+        async with per_loop(self._locks, asyncio.Lock):
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate / self.period)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) * self.period / self.rate)
+
+
+_rate_limiter = _RateLimiter(GEMINI_REQUESTS_PER_MINUTE)
 
 
 def _get_client():
-    """Lazy-load the Gemini client."""
-    global _client
-    if _client is None:
-        api_key = GEMINI_API_KEY or os.environ.get("GEMINI_API_KEY")
-        if not api_key:
-            raise ValueError("GEMINI_API_KEY environment variable not set")
-        _client = genai.Client(api_key=api_key)
-    return _client
+    """
+    Lazy-load the Gemini client for the running event loop.
+    
+    client.aio runs on the loop's connection pool, so each loop gets its own
+    client; outside any loop a plain client serves the sync API.
+    """
+    global _sync_client
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        if _sync_client is None:
+            _sync_client = _new_client(async_pool=False)
+        return _sync_client
+    return per_loop(_clients, _new_client)
+
+
+def _new_client(async_pool: bool = True):
+    from google import genai
+    
+    api_key = GEMINI_API_KEY or os.environ.get("GEMINI_API_KEY")
+    if not api_key:
+        raise ValueError("GEMINI_API_KEY environment variable not set")
+    # Rate limits, 5xx and timeouts are retried with exponential backoff +
+    # jitter by the SDK
+    http_options = {
+        "timeout": int(GEMINI_REQUEST_TIMEOUT_SECONDS * 1000),  # milliseconds
+        "retry_options": {
+            "attempts": GEMINI_RETRY_ATTEMPTS,
+            "initial_delay": 1.0,
+            "max_delay": 30.0,
+            "http_status_codes": [408, 429, 500, 502, 503, 504],
+        },
+    }
+    if async_pool:
+        # Async calls share the loop's keep-alive pool
+        http_options["httpx_async_client"] = get_http_client()
+    return genai.Client(api_key=api_key, http_options=http_options)
 
 
 def is_available() -> bool:
-    """Check if Gemini service is available."""
-    return bool(GEMINI_API_KEY or os.environ.get("GEMINI_API_KEY"))
+    """Check if Gemini service is available (SDK installed and API key set)."""
+    return GENAI_AVAILABLE and bool(GEMINI_API_KEY or os.environ.get("GEMINI_API_KEY"))
+
+
+async def _get_prompt_cache(model: str, system_prompt: str) -> Optional[str]:
+    """
+    Return the name of a CachedContent holding `system_prompt` for `model`,
+    creating it on first use. Returns None if caching is not possible (e.g.
+    the prompt is below the model's minimum cacheable size); that is
+    remembered so the create call is not retried on every request.
+    """
+    key = (model, system_prompt)
+    async with per_loop(_prompt_cache_locks, asyncio.Lock):
+        entry = _prompt_caches.get(key)
+        if entry is not None and entry[1] > time.time():
+            return entry[0]
+        
+        try:
+            cache = await _get_client().aio.caches.create(
+                model=model,
+                config={
+                    "system_instruction": system_prompt,
+                    "ttl": f"{PROMPT_CACHE_TTL_SECONDS}s",
+                },
+            )
+        except Exception as e:
+            print(f"[!] Gemini prompt cache unavailable for {model}, sending prompt inline: {e}")
+            _prompt_caches[key] = (None, float("inf"))
+            return None
+        
+        print(f"[+] Cached system prompt for {model}: {cache.name}")
+        # Refresh a minute early so in-flight requests never hit an expired cache
+        _prompt_caches[key] = (cache.name, time.time() + PROMPT_CACHE_TTL_SECONDS - 60)
+        return cache.name
+
+
+def _invalidate_prompt_cache(model: str, system_prompt: str):
+    """Forget a CachedContent that the API no longer knows (deleted or expired early)."""
+    _prompt_caches.pop((model, system_prompt), None)
+
+
+async def warm_prompt_caches():
+    """Create the cleanup, refactor and malware prompt caches ahead of the first job."""
+    await asyncio.gather(
+        _get_prompt_cache(GEMINI_CLEANUP_MODEL, CLEANUP_SYSTEM_PROMPT),
+        _get_prompt_cache(GEMINI_REFACTOR_MODEL, REFACTOR_SYSTEM_PROMPT),
+        _get_prompt_cache(GEMINI_CLEANUP_MODEL, MALWARE_DETECTION_PROMPT),
+    )
+
+
+async def _generation_config(model: str, system_prompt: str, **settings) -> dict:
+    """Build a generate_content config, referencing the cached system prompt when available."""
+    cache_name = await _get_prompt_cache(model, system_prompt)
+    if cache_name:
+        return {"cached_content": cache_name, **settings}
+    return {"system_instruction": system_prompt, **settings}
+
+
+# Language tags Gemini puts after an opening fence or on a line of their own
+_LANGUAGE_TAGS = ("c++", "cpp", "c")
+
+
+async def _read_stream(stream) -> str:
+    """
+    Collect a generate_content_stream reply, raising if it grows past
+    GEMINI_MAX_OUTPUT_CHARS or goes GEMINI_STREAM_IDLE_SECONDS without a chunk.
+    """
+    parts = []
+    size = 0
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(stream.__anext__(), GEMINI_STREAM_IDLE_SECONDS)
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"Gemini stream idle for {GEMINI_STREAM_IDLE_SECONDS:g}s") from None
+            if chunk.text:
+                parts.append(chunk.text)
+                size += len(chunk.text)
+                if size > GEMINI_MAX_OUTPUT_CHARS:
+                    raise ValueError(f"Gemini reply exceeded {GEMINI_MAX_OUTPUT_CHARS} characters")
+    finally:
+        await stream.aclose()
+    return "".join(parts)
+
+
+async def _open_stream(model: str, system_prompt: str, user_prompt: str, **settings):
+    """
+    Start a generate_content_stream call with the system prompt served from
+    its prompt cache when available, recreating a vanished cache once.
+    """
+    from google.genai import errors as genai_errors
+    
+    recreated_cache = False
+    while True:
+        config = await _generation_config(model, system_prompt, **settings)
+        try:
+            return await _get_client().aio.models.generate_content_stream(
+                model=model,
+                contents=user_prompt,
+                config=config,
+            )
+        except genai_errors.ClientError as e:
+            # A vanished prompt cache answers 403/404: recreate it once
+            if recreated_cache or "cached_content" not in config or e.code not in (403, 404):
+                raise
+            print(f"[!] Gemini prompt cache {config['cached_content']} is gone, recreating it")
+            _invalidate_prompt_cache(model, system_prompt)
+            recreated_cache = True
+
+
+async def _generate_code(model: str, system_prompt: str, user_prompt: str, temperature: float) -> str:
+    """
+    Run a code-producing Gemini call and strip markdown artifacts.
+    
+    The reply is streamed so runaway or stalled generations can be cut off
+    early (see GEMINI_MAX_OUTPUT_CHARS / GEMINI_STREAM_IDLE_SECONDS); both
+    raise, and callers fall back to the original code. Results are memoized
+    in llm_cache, keyed by everything in the request, so re-analysing a
+    binary (or a duplicate function) skips the API call. The calls sample,
+    so this deliberately pins the first sample; set GEMINI_CACHE_DISABLE
+    to draw a fresh one.
+    """
+    cache_key = llm_cache.make_key(model=model, system=system_prompt, prompt=user_prompt, temperature=temperature)
+    if not GEMINI_CACHE_DISABLED:
+        cached = await llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
+    
+    await _rate_limiter.acquire()
+    stream = await _open_stream(model, system_prompt, user_prompt, temperature=temperature, max_output_tokens=16384)
+    code = _clean_markdown_artifacts(await _read_stream(stream))
+    
+    if not GEMINI_CACHE_DISABLED:
+        await llm_cache.set(cache_key, code)
+    return code
 
 
 def _clean_markdown_artifacts(code: str) -> str:
@@ -47,23 +335,86 @@ def _clean_markdown_artifacts(code: str) -> str:
     Remove markdown code fences and other artifacts from Gemini output.
     Handles various formats like ```c, ```cpp, ```c++, or just ``` or ++.
     """
-    result = code.strip()
+    code = code.strip()
     
-    # Remove opening code fence with optional language tag
-    # Handles: ```c, ```cpp, ```c++, ```, ```C, etc.
-    result = re.sub(r'^```(?:c(?:pp|\+\+)?|C(?:PP|\+\+)?)?\s*\n?', '', result, flags=re.IGNORECASE)
+    # Opening fence with an optional language tag: ```c / ```cpp / ```c++
+    if code.startswith("```"):
+        code = code[3:]
+        if code[:1].lower() == "c":
+            code = code[3:] if code[1:3].lower() in ("pp", "++") else code[1:]
+        code = code.lstrip()
     
-    # Remove closing code fence
-    result = re.sub(r'\n?```\s*$', '', result)
+    # Language tag on a line of its own
+    for tag in _LANGUAGE_TAGS:
+        if code[:len(tag)].lower() == tag:
+            rest = code[len(tag):]
+            after = rest.lstrip()
+            gap = rest[:len(rest) - len(after)]
+            if "\n" in gap:
+                code = rest[gap.rindex("\n") + 1:]
+                break
     
-    # Remove standalone language tags at the start (e.g., "c++" or "cpp" on first line)
-    result = re.sub(r'^(?:c\+\+|cpp|c)\s*\n', '', result, flags=re.IGNORECASE)
+    # Leading "++" left over from a split ```c++ fence
+    if code.startswith("++"):
+        code = code[2:].lstrip()
     
-    # Remove just "++" at the start of the file (common Gemini artifact)
-    result = re.sub(r'^\+\+\s*\n?', '', result)
+    # Closing fence
+    if code.endswith("```"):
+        code = code[:-3]
     
-    # Remove any leading/trailing whitespace
-    return result.strip()
+    return code.strip()
+
+
+# Ghidra auto-generated names / CRT stubs; code without any of these (and
+# short enough) has nothing for the cleanup pass to rename or explain
+_ARTIFACT_RE = re.compile(
+    r'\b(?:local_[0-9a-fA-F]+|param_\d+|[a-z]{1,2}Var\d+|DAT_[0-9a-fA-F]+|FUN_[0-9a-fA-F]+'
+    r'|__libc_start_main|__main|__do_global_ctors)\b'
+)
+CLEANUP_MIN_CHARS = 80
+
+# Body that only forwards to a named (non-FUN_) function:
+# `[return] strlen(param_1);`, optionally followed by `return;`
+_LIBRARY_WRAPPER_BODY = re.compile(
+    r'\s*(?:return\s+)?(?!FUN_|if\b|while\b|for\b|switch\b)[A-Za-z_]\w*\s*\([^;{}]*\)\s*;'
+    r'\s*(?:return\s*;)?\s*'
+)
+
+cleanup_stats = {"skipped": 0}
+
+
+def _is_trivial(code: str) -> bool:
+    """
+    Check if cleanup would have nothing to do: at most 3 lines, short with
+    no decompiler artifacts, or a plain library-call wrapper.
+    """
+    code = code.strip()
+    if code.count('\n') < 3:
+        return True
+    if len(code) < CLEANUP_MIN_CHARS and not _ARTIFACT_RE.search(code):
+        return True
+    body_start = code.find('{')
+    body_end = code.rfind('}')
+    return body_start != -1 and body_end > body_start and (
+        _LIBRARY_WRAPPER_BODY.fullmatch(code, body_start + 1, body_end) is not None
+    )
+
+
+def _needs_cleanup(code: str, function_name: Optional[str] = None) -> bool:
+    """
+    Return False (and count the skip) for trivial functions (see _is_trivial)
+    and for code over GEMINI_MAX_INPUT_TOKENS: cleanup output replaces the
+    code, so cleaning a truncated copy would drop its omitted middle.
+    """
+    if len(_prerename(code)) > _chars_for_tokens(GEMINI_MAX_INPUT_TOKENS):
+        cleanup_stats["skipped"] += 1
+        log.warning("[!] Skipping cleanup for oversize function %s, keeping it whole", function_name or '')
+        return False
+    if not _is_trivial(code):
+        return True
+    cleanup_stats["skipped"] += 1
+    log.info("[*] Skipping cleanup for trivial function %s (%s skipped so far)", function_name or '', cleanup_stats['skipped'])
+    return False
 
 
 # Carefully engineered prompt for decompiled code cleanup
@@ -105,6 +456,93 @@ If function names are generic (like `FUN_00101234`), suggest a better name as a
 ## Output Format:
 Return ONLY the cleaned C/C++ code. No markdown code fences, no explanations outside comments."""
 
+# Fixed user-turn instructions. Kept ahead of the per-function text so every
+# call shares one static prefix (system instruction + instructions), which is
+# what Gemini's implicit prompt caching keys on.
+CLEANUP_INSTRUCTIONS = """Transform the decompiled code below into HIGHLY READABLE code:
+
+REQUIREMENTS:
+1. RENAME ALL cryptic variables to descriptive names:
+   - local_X, param_X, uVarX, iVarX (or placeholders v_X, argX, uvalX, ivalX, data_X) → meaningful names based on usage
+   - Example: local_10 that holds a string → inputBuffer, local_8 used as counter → loopIndex
+2. ADD COMMENTS explaining what each function and code block does
+3. Add a summary comment at the top of each function
+4. Fix formatting and indentation
+
+"""
+
+
+# Ghidra's generic identifiers and the placeholders GEMINI_PRERENAME swaps in
+_GENERIC_NAMES = [
+    (re.compile(r'\blocal_([0-9a-fA-F]+)\b'), r'v_\1'),
+    (re.compile(r'\bparam_(\d+)\b'), r'arg\1'),
+    (re.compile(r'\b([ui])Var(\d+)\b'), r'\1val\2'),
+    (re.compile(r'\bDAT_([0-9a-fA-F]+)\b'), r'data_\1'),
+]
+
+
+def _prerename(code: str) -> str:
+    """Mechanically rename generic identifiers when GEMINI_PRERENAME is set."""
+    if GEMINI_PRERENAME:
+        for pattern, replacement in _GENERIC_NAMES:
+            code = pattern.sub(replacement, code)
+    return code
+
+
+def _chars_for_tokens(tokens: int) -> int:
+    return int(tokens * _chars_per_token)
+
+
+async def _measure_token_ratio(sample: str):
+    """Measure characters per token with count_tokens, once, from a sample of at least TOKEN_RATIO_MIN_CHARS."""
+    global _chars_per_token, _token_ratio_measured
+    if _token_ratio_measured or len(sample) < TOKEN_RATIO_MIN_CHARS:
+        return
+    _token_ratio_measured = True
+    sample = sample[:16 * TOKEN_RATIO_MIN_CHARS]
+    try:
+        response = await _get_client().aio.models.count_tokens(model=GEMINI_CLEANUP_MODEL, contents=sample)
+        if response.total_tokens:
+            _chars_per_token = len(sample) / response.total_tokens
+            print(f"[*] Measured {_chars_per_token:.2f} characters per Gemini token")
+    except Exception as e:
+        print(f"[!] Gemini token count failed, assuming {_chars_per_token} characters per token: {e}")
+
+
+def _truncate_input(code: str, function_name: Optional[str] = None) -> str:
+    """Cut oversize code (past GEMINI_MAX_INPUT_TOKENS) down to its head (signature first) and tail."""
+    max_chars = _chars_for_tokens(GEMINI_MAX_INPUT_TOKENS)
+    if len(code) <= max_chars:
+        return code
+    
+    lines = code.split('\n')
+    if len(lines) > TRUNCATE_HEAD_LINES + TRUNCATE_TAIL_LINES:
+        omitted = len(lines) - TRUNCATE_HEAD_LINES - TRUNCATE_TAIL_LINES
+        code = '\n'.join(
+            lines[:TRUNCATE_HEAD_LINES]
+            + [f"// ... truncated {omitted} lines ..."]
+            + lines[-TRUNCATE_TAIL_LINES:]
+        )
+    if len(code) > max_chars:
+        # Few, very long lines: fall back to a character cut
+        half = max_chars // 2
+        code = f"{code[:half]}\n// ... truncated {len(code) - 2 * half} characters ...\n{code[-half:]}"
+    
+    log.warning("[!] Truncated oversize input for %s to %s characters", function_name or 'function', len(code))
+    return code
+
+
+def _build_prompt(prefix: str, code: str, label: str, function_name: Optional[str] = None) -> str:
+    """
+    Assemble a user prompt in one allocation: the static `prefix` first (so
+    it stays cacheable), then the per-call function name and code
+    (truncated to GEMINI_MAX_INPUT_TOKENS).
+    """
+    code = _truncate_input(code, function_name)
+    if function_name:
+        return f"{prefix}{label}: {function_name}\n\nCODE:\n\n{code}"
+    return f"{prefix}CODE:\n\n{code}"
+
 
 def cleanup_decompiled_code(code: str, function_name: Optional[str] = None) -> str:
     """
@@ -118,34 +556,23 @@ def cleanup_decompiled_code(code: str, function_name: Optional[str] = None) -> s
         Cleaned up, human-readable code with renamed variables and comments
     """
     if not is_available():
-        print("[!] Gemini API key not configured, returning original code")
+        log.warning("[!] Gemini not configured, returning original code")
+        return code
+    if not _needs_cleanup(code, function_name):
         return code
     
     try:
         client = _get_client()
         
-        # Build the prompt with explicit instructions for aggressive cleanup
-        context = f"Primary function: {function_name}\n\n" if function_name else ""
-        user_prompt = f"""{context}Transform this decompiled code into HIGHLY READABLE code:
-
-REQUIREMENTS:
-1. RENAME ALL cryptic variables to descriptive names:
-   - local_X, param_X, uVarX, iVarX → meaningful names based on usage
-   - Example: local_10 that holds a string → inputBuffer, local_8 used as counter → loopIndex
-2. ADD COMMENTS explaining what each function and code block does
-3. Add a summary comment at the top of each function
-4. Fix formatting and indentation
-
-CODE TO CLEAN UP:
-
-{code}"""
+        user_prompt = _build_prompt(CLEANUP_INSTRUCTIONS, _prerename(code), "Primary function", function_name)
         
         # Make the API call using new google.genai SDK
         # Higher temperature (1.0) for more creative renaming and comments
         response = client.models.generate_content(
             model=GEMINI_CLEANUP_MODEL,
-            contents=CLEANUP_SYSTEM_PROMPT + "\n\n" + user_prompt,
+            contents=user_prompt,
             config={
+                "system_instruction": CLEANUP_SYSTEM_PROMPT,
                 "temperature": 1.0,
                 "max_output_tokens": 16384,
             }
@@ -159,7 +586,7 @@ CODE TO CLEAN UP:
         return cleaned_code.strip()
         
     except Exception as e:
-        print(f"[!] Gemini API error: {e}")
+        log.warning("[!] Gemini API error: %s", e)
         return code  # Return original on error
 
 
@@ -175,72 +602,87 @@ async def cleanup_decompiled_code_async(code: str, function_name: Optional[str]
         Cleaned up, human-readable code with renamed variables and comments
     """
     if not is_available():
-        print("[!] Gemini API key not configured, returning original code")
+        log.warning("[!] Gemini not configured, returning original code")
+        return code
+    await _measure_token_ratio(code)
+    if not _needs_cleanup(code, function_name):
         return code
     
     try:
-        client = _get_client()
-        
-        # Build the prompt with explicit instructions for aggressive cleanup
-        context = f"Primary function: {function_name}\n\n" if function_name else ""
-        user_prompt = f"""{context}Transform this decompiled code into HIGHLY READABLE code:
-
-REQUIREMENTS:
-1. RENAME ALL cryptic variables to descriptive names:
-   - local_X, param_X, uVarX, iVarX → meaningful names based on usage
-   - Example: local_10 that holds a string → inputBuffer, local_8 used as counter → loopIndex
-2. ADD COMMENTS explaining what each function and code block does
-3. Add a summary comment at the top of each function
-4. Fix formatting and indentation
-
-CODE TO CLEAN UP:
-
-{code}"""
+        user_prompt = _build_prompt(CLEANUP_INSTRUCTIONS, _prerename(code), "Primary function", function_name)
         
         # Make the API call using new google.genai SDK (async)
         # Higher temperature (1.0) for more creative renaming and comments
-        response = await client.aio.models.generate_content(
-            model=GEMINI_CLEANUP_MODEL,
-            contents=CLEANUP_SYSTEM_PROMPT + "\n\n" + user_prompt,
-            config={
-                "temperature": 1.0,
-                "max_output_tokens": 16384,
-            }
-        )
-        
-        cleaned_code = response.text.strip()
-        
-        # Remove any markdown code fences and artifacts
-        cleaned_code = _clean_markdown_artifacts(cleaned_code)
-        
-        return cleaned_code.strip()
+        return await _generate_code(GEMINI_CLEANUP_MODEL, CLEANUP_SYSTEM_PROMPT, user_prompt, temperature=1.0)
         
     except Exception as e:
-        print(f"[!] Gemini API error: {e}")
+        log.warning("[!] Gemini API error: %s", e)
         return code
 
 
-def cleanup_multiple_functions(functions: dict[str, str]) -> dict[str, str]:
+def cleanup_multiple_functions(functions: dict[str, str], mode: str = "async") -> dict[str, str]:
     """
     Clean up multiple decompiled functions.
     
+    Sync entry point for scripts. The async modes run on their own event
+    loop (on a worker thread if called from inside a running loop).
+    
     Args:
         functions: Dict mapping function names to decompiled code
+        mode: "async" (concurrent requests, the default), "batch" (Batch
+            API: half price, but can take hours) or "sync" (one request
+            at a time)
         
     Returns:
         Dict mapping function names to cleaned code
     """
+    if mode == "sync":
+        return _cleanup_multiple_functions_serial(functions)
+    if mode == "batch":
+        return _run_sync(cleanup_batch_with_gemini_async(functions))
+    if mode == "async":
+        return _run_sync(cleanup_multiple_functions_async(functions))
+    raise ValueError(f"Unknown cleanup mode: {mode}")
+
+
+def _run_sync(coro):
+    """
+    Run `coro` to completion on a fresh event loop (on a worker thread if
+    this thread already runs one), then drop that loop's clients and pools.
+    """
+    async def _main():
+        try:
+            return await coro
+        finally:
+            loop = asyncio.get_running_loop()
+            for registry in (_clients, _semaphores, _prompt_cache_locks, _rate_limiter._locks):
+                registry.pop(loop, None)
+            await close_http_client()
+    
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(_main())
+    
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, _main()).result()
+
+
+def _cleanup_multiple_functions_serial(functions: dict[str, str]) -> dict[str, str]:
+    """One sync request at a time (for debugging)."""
     cleaned = {}
     for name, code in functions.items():
-        print(f"[*] Cleaning up function: {name}")
+        log.info("[*] Cleaning up function: %s", name)
         cleaned[name] = cleanup_decompiled_code(code, name)
-        print(f"[+] Completed: {name}")
+        log.info("[+] Completed: %s", name)
     return cleaned
 
 
 async def cleanup_multiple_functions_async(functions: dict[str, str]) -> dict[str, str]:
     """
-    Async version - clean up multiple decompiled functions.
+    Async version - clean up multiple decompiled functions, up to
+    GEMINI_CONCURRENCY requests at a time. Unless GEMINI_BATCH_CLEANUP is
+    off, small functions share a request (see cleanup_batched_async).
     
     Args:
         functions: Dict mapping function names to decompiled code
@@ -248,12 +690,170 @@ async def cleanup_multiple_functions_async(functions: dict[str, str]) -> dict[st
     Returns:
         Dict mapping function names to cleaned code
     """
-    cleaned = {}
+    return await cleanup_batched_async(functions, CLEANUP_BATCH_CHARS if GEMINI_BATCH_CLEANUP else 0)
+
+
+# Packed cleanup: several small functions per request, each wrapped in a
+# <FUNC name="..."> block that the model echoes back around its output
+CLEANUP_BATCH_INSTRUCTIONS = CLEANUP_INSTRUCTIONS + """Each function below is wrapped in a <FUNC name="..."> block.
+Return EVERY function, cleaned, inside its own <FUNC name="..."> block with the same name.
+Output nothing outside the blocks.
+
+"""
+
+_FUNC_BLOCK = re.compile(r'<FUNC name="([^"]+)">\s*(.*?)\s*</FUNC>', re.DOTALL)
+
+
+def _canonical_body(code: str, name: str) -> str:
+    """Body with its own name masked and whitespace collapsed, so clones at other addresses compare equal."""
+    return " ".join(re.sub(rf'\b{re.escape(name)}\b', "\0", code).split())
+
+
+def _dedupe_bodies(functions: dict[str, str]) -> tuple[dict[str, str], dict[str, str]]:
+    """
+    Collapse function bodies that differ only in their own name or
+    whitespace (thunks, COMDAT duplicates, stubs emitted at several
+    addresses) so each is sent to Gemini once.
+    
+    Returns:
+        (unique, representative): one name per distinct body mapped to its
+        code, and every name mapped to the name whose result it shares
+    """
+    first_by_body: dict[str, str] = {}
+    representative = {
+        name: first_by_body.setdefault(_canonical_body(code, name), name)
+        for name, code in functions.items()
+    }
+    unique = {name: functions[name] for name in first_by_body.values()}
+    if len(unique) < len(functions):
+        print(f"[*] Deduplicated {len(functions) - len(unique)} identical function bodies")
+    return unique, representative
+
+
+def _fan_out(results: dict[str, str], representative: dict[str, str]) -> dict[str, str]:
+    """Give every name its representative's result, renamed back to that name."""
+    fanned = {}
+    for name, rep in representative.items():
+        result = results[rep]
+        if name != rep:
+            result = re.sub(rf'\b{re.escape(rep)}\b', lambda _: name, result)
+        fanned[name] = result
+    return fanned
+
+
+def _pack_batches(functions: dict[str, str], batch_chars: int) -> list[dict[str, str]]:
+    """Greedily pack functions, in order, into batches of about `batch_chars` code characters."""
+    batches: list[dict[str, str]] = []
+    current: dict[str, str] = {}
+    size = 0
     for name, code in functions.items():
-        print(f"[*] Cleaning up function: {name}")
-        cleaned[name] = await cleanup_decompiled_code_async(code, name)
-        print(f"[+] Completed: {name}")
-    return cleaned
+        if current and size + len(code) > batch_chars:
+            batches.append(current)
+            current, size = {}, 0
+        current[name] = code
+        size += len(code)
+    if current:
+        batches.append(current)
+    return batches
+
+
+async def cleanup_batched_async(functions: dict[str, str], batch_chars: int = CLEANUP_BATCH_CHARS) -> dict[str, str]:
+    """
+    Clean up multiple functions, packing small ones into shared requests.
+    Identical bodies are cleaned once and the result shared.
+    
+    Each request pays the round trip and the system/instruction tokens once
+    for the whole batch instead of once per function. Batches run up to
+    GEMINI_CONCURRENCY at a time. Functions missing from a batch reply (or
+    the whole batch, if the reply cannot be parsed) are retried one by one.
+    
+    Args:
+        functions: Dict mapping function names to decompiled code
+        batch_chars: Approximate code size per request (0 sends every
+            function on its own)
+        
+    Returns:
+        Dict mapping function names to cleaned code
+    """
+    async def _single(name: str, code: str) -> str:
+        async with _gemini_semaphore():
+            log.info("[*] Cleaning up function: %s", name)
+            cleaned = await cleanup_decompiled_code_async(code, name)
+            log.info("[+] Completed: %s", name)
+        return cleaned
+    
+    async def _batch(batch: dict[str, str]) -> dict[str, str]:
+        if len(batch) == 1:
+            [(name, code)] = batch.items()
+            return {name: await _single(name, code)}
+        
+        blocks = "\n\n".join(f'<FUNC name="{name}">\n{_prerename(code)}\n</FUNC>' for name, code in batch.items())
+        async with _gemini_semaphore():
+            log.info("[*] Cleaning up %s functions in one request", len(batch))
+            try:
+                text = await _generate_code(
+                    GEMINI_CLEANUP_MODEL,
+                    CLEANUP_SYSTEM_PROMPT,
+                    CLEANUP_BATCH_INSTRUCTIONS + blocks,
+                    temperature=1.0,
+                )
+            except Exception as e:
+                log.warning("[!] Batched cleanup failed: %s", e)
+                text = ""
+        
+        cleaned = {
+            name: _clean_markdown_artifacts(body)
+            for name, body in _FUNC_BLOCK.findall(text)
+            if name in batch and body.strip()
+        }
+        missing = [name for name in batch if name not in cleaned]
+        if missing:
+            log.warning("[!] %s functions missing from batched reply, cleaning individually", len(missing))
+            retried = await asyncio.gather(*[_single(name, batch[name]) for name in missing])
+            cleaned.update(zip(missing, retried))
+        else:
+            log.info("[+] Completed batch of %s functions", len(batch))
+        return cleaned
+    
+    unique, representative = _dedupe_bodies(functions)
+    
+    # Already-clean functions never enter a batch
+    results = {name: code for name, code in unique.items() if not _needs_cleanup(code, name)}
+    pending = {name: code for name, code in unique.items() if name not in results}
+    for cleaned in await asyncio.gather(*[_batch(batch) for batch in _pack_batches(pending, batch_chars)]):
+        results.update(cleaned)
+    return _fan_out(results, representative)
+
+
+async def cleanup_batch_with_gemini_async(functions: dict[str, str]) -> dict[str, str]:
+    """
+    Clean up many functions through the Gemini Batch API.
+    
+    Billed at roughly half the per-request price but finishes asynchronously
+    (up to 24h), so only for large, latency-tolerant jobs. Uses the same
+    prompt and settings as cleanup_decompiled_code_async.
+    
+    Args:
+        functions: Dict mapping function names to decompiled code
+        
+    Returns:
+        Dict mapping function names to cleaned code (original code for any
+        function whose request failed)
+    """
+    if not is_available():
+        print("[!] Gemini not configured, returning original code")
+        return dict(functions)
+    
+    unique, representative = _dedupe_bodies(functions)
+    prompts = {
+        name: _build_prompt(CLEANUP_INSTRUCTIONS, _prerename(code), "Primary function", name)
+        for name, code in unique.items()
+        if _needs_cleanup(code, name)
+    }
+    results = dict(unique)
+    if prompts:
+        results.update(await _run_batch_job(GEMINI_CLEANUP_MODEL, CLEANUP_SYSTEM_PROMPT, prompts, 1.0, unique))
+    return _fan_out(results, representative)
 
 
 # Prompt for full refactoring (replacing LLM4Decompile)
@@ -291,8 +891,27 @@ REFACTOR_SYSTEM_PROMPT = """You are an expert reverse engineer specializing in d
 This is decompiled code from Ghidra. Variable names like `local_XX`, `param_X`, `uVar`, `iVar` are auto-generated.
 The code may have overly explicit casts and pointer arithmetic - simplify only where safe to do so."""
 
+REFACTOR_INSTRUCTIONS = "Refactor the Ghidra decompiler output below into clean, readable C code.\n\n"
+
 
-async def refactor_with_gemini_async(code: str, function_name: Optional[str] = None) -> str:
+@lru_cache(maxsize=8)
+def _refactor_prefix(context: Optional[str]) -> str:
+    """
+    Instructions plus binary-wide context. The context is identical for every
+    function in a binary, so the prefix is built once and sits before the
+    per-call part.
+    """
+    if not context:
+        return REFACTOR_INSTRUCTIONS
+    return f"{REFACTOR_INSTRUCTIONS}Other functions in this binary:\n{context}\n\n"
+
+
+async def refactor_with_gemini_async(
+    code: str,
+    function_name: Optional[str] = None,
+    model: Optional[str] = None,
+    context: Optional[str] = None,
+) -> str:
     """
     Refactor decompiled code using Gemini (alternative to LLM4Decompile).
     
@@ -302,49 +921,33 @@ async def refactor_with_gemini_async(code: str, function_name: Optional[str] = N
     Args:
         code: Raw decompiled C/C++ code from Ghidra
         function_name: Optional function name for context
+        model: Model override (defaults to GEMINI_REFACTOR_MODEL)
+        context: Optional pre-joined signatures of the binary's functions
         
     Returns:
         Refactored, readable C code
     """
     if not is_available():
-        print("[!] Gemini API key not configured, returning original code")
+        log.warning("[!] Gemini not configured, returning original code")
         return code
     
     try:
-        client = _get_client()
-        
-        # Build the prompt
-        context = f"Function: {function_name}\n\n" if function_name else ""
-        user_prompt = f"""{context}Refactor this Ghidra decompiler output into clean, readable C code:
-
-{code}"""
+        await _measure_token_ratio(code)
+        user_prompt = _build_prompt(_refactor_prefix(context), code, "Function", function_name)
         
         # Make the API call using Gemini Pro for refactoring
         # Temperature 0.8 for logical changes while maintaining correctness
-        response = await client.aio.models.generate_content(
-            model=GEMINI_REFACTOR_MODEL,
-            contents=REFACTOR_SYSTEM_PROMPT + "\n\n" + user_prompt,
-            config={
-                "temperature": 0.8,
-                "max_output_tokens": 16384,
-            }
-        )
-        
-        refactored_code = response.text.strip()
-        
-        # Remove any markdown code fences and language tags
-        refactored_code = _clean_markdown_artifacts(refactored_code)
-        
-        return refactored_code.strip()
+        return await _generate_code(model or GEMINI_REFACTOR_MODEL, REFACTOR_SYSTEM_PROMPT, user_prompt, temperature=0.8)
         
     except Exception as e:
-        print(f"[!] Gemini API error: {e}")
+        log.warning("[!] Gemini API error: %s", e)
         return code
 
 
 async def refactor_multiple_functions_async(functions: dict[str, str]) -> dict[str, str]:
     """
-    Refactor multiple decompiled functions using Gemini.
+    Refactor multiple decompiled functions using Gemini, up to
+    GEMINI_CONCURRENCY at a time. Identical bodies are refactored once.
     
     Args:
         functions: Dict mapping function names to raw decompiled code
@@ -352,12 +955,103 @@ async def refactor_multiple_functions_async(functions: dict[str, str]) -> dict[s
     Returns:
         Dict mapping function names to refactored code
     """
-    refactored = {}
-    for name, code in functions.items():
-        print(f"[*] Refactoring function with Gemini: {name}")
-        refactored[name] = await refactor_with_gemini_async(code, name)
-        print(f"[+] Completed: {name}")
-    return refactored
+    async def _one(name: str, code: str) -> tuple[str, str]:
+        async with _gemini_semaphore():
+            log.info("[*] Refactoring function with Gemini: %s", name)
+            refactored = await refactor_with_gemini_async(code, name)
+            log.info("[+] Completed: %s", name)
+        return name, refactored
+    
+    unique, representative = _dedupe_bodies(functions)
+    results = dict(await asyncio.gather(*[_one(name, code) for name, code in unique.items()]))
+    return _fan_out(results, representative)
+
+
+async def refactor_batch_with_gemini_async(
+    functions: dict[str, str],
+    context: Optional[str] = None,
+) -> dict[str, str]:
+    """
+    Refactor many functions through the Gemini Batch API.
+    
+    Batch jobs are billed at roughly half the per-request price but finish
+    asynchronously (up to 24h), so this is only for offline whole-binary runs.
+    Uses the same prompt and settings as refactor_with_gemini_async.
+    
+    Args:
+        functions: Dict mapping function names to raw decompiled code
+        context: Optional pre-joined signatures of the binary's functions
+        
+    Returns:
+        Dict mapping function names to refactored code (original code for
+        any function whose request failed)
+    """
+    if not is_available():
+        print("[!] Gemini not configured, returning original code")
+        return dict(functions)
+    
+    prefix = _refactor_prefix(context)
+    prompts = {name: _build_prompt(prefix, code, "Function", name) for name, code in functions.items()}
+    return await _run_batch_job(GEMINI_REFACTOR_MODEL, REFACTOR_SYSTEM_PROMPT, prompts, 0.8, functions)
+
+
+async def _run_batch_job(
+    model: str,
+    system_prompt: str,
+    prompts: dict[str, str],
+    temperature: float,
+    originals: dict[str, str],
+) -> dict[str, str]:
+    """
+    Submit one inlined Batch API job (one request per prompt), poll it with
+    exponential backoff until it finishes, and collect the cleaned replies.
+    
+    Returns:
+        Dict mapping each prompt's name to the model output, or to
+        `originals[name]` for requests that failed
+    """
+    names = list(prompts)
+    requests = [
+        {
+            "contents": [{"role": "user", "parts": [{"text": prompts[name]}]}],
+            "config": {
+                "system_instruction": system_prompt,
+                "temperature": temperature,
+                "max_output_tokens": 16384,
+            },
+        }
+        for name in names
+    ]
+    
+    try:
+        client = _get_client()
+        job = await client.aio.batches.create(model=model, src=requests)
+        print(f"[*] Submitted Gemini batch job {job.name} ({len(names)} functions)")
+        
+        delay = BATCH_POLL_INITIAL_SECONDS
+        while job.state not in _BATCH_DONE_STATES:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, BATCH_POLL_MAX_SECONDS)
+            job = await client.aio.batches.get(name=job.name)
+        
+        if job.state != "JOB_STATE_SUCCEEDED":
+            print(f"[!] Gemini batch job {job.name} ended in {job.state}, returning original code")
+            return {name: originals[name] for name in names}
+        
+        # Inlined responses come back in request order
+        results = {}
+        for name, item in zip(names, job.dest.inlined_responses):
+            if item.response is not None and item.response.text:
+                results[name] = _clean_markdown_artifacts(item.response.text.strip())
+            else:
+                log.warning("[!] Gemini batch request failed for %s: %s", name, item.error)
+                results[name] = originals[name]
+        print(f"[+] Gemini batch job {job.name} completed")
+        return {name: results.get(name, originals[name]) for name in names}
+        
+    except Exception as e:
+        print(f"[!] Gemini batch API error: {e}")
+        return {name: originals[name] for name in names}
 
 
 # Malware detection prompt
@@ -392,6 +1086,22 @@ Respond with ONLY a JSON object (no markdown, no explanation):
 If the code is benign or you cannot determine malicious intent, set is_malware to false."""
 
 
+# Structured output: Gemini returns bare JSON matching this schema (no fences)
+MALWARE_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "is_malware": {"type": "BOOLEAN"},
+        "confidence": {"type": "STRING", "enum": ["high", "medium", "low"]},
+        "threats": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "explanation": {"type": "STRING"},
+    },
+    "required": ["is_malware", "confidence", "threats", "explanation"],
+}
+
+# Below this much code (a stub or two) there is nothing to judge
+MALWARE_MIN_CHARS = int(os.environ.get("GEMINI_MALWARE_MIN_CHARS", "200"))
+
+
 async def analyze_for_malware_async(combined_code: str) -> dict:
     """
     Analyze decompiled code for malware indicators using Gemini Flash.
@@ -403,41 +1113,52 @@ async def analyze_for_malware_async(combined_code: str) -> dict:
         Dict with: is_malware (bool), confidence (str), threats (list), explanation (str)
     """
     if not is_available():
-        print("[!] Gemini API key not configured, skipping malware analysis")
+        print("[!] Gemini not configured, skipping malware analysis")
         return {"is_malware": False, "confidence": "low", "threats": [], "explanation": "Analysis unavailable"}
     
+    if len(combined_code.strip()) < MALWARE_MIN_CHARS:
+        return {"is_malware": False, "confidence": "low", "threats": [], "explanation": "Too little code to analyze"}
+    
     try:
-        client = _get_client()
-        
         # Truncate very long code to stay within limits
-        max_chars = 50000
+        await _measure_token_ratio(combined_code)
+        max_chars = _chars_for_tokens(GEMINI_MALWARE_MAX_INPUT_TOKENS)
         if len(combined_code) > max_chars:
             combined_code = combined_code[:max_chars] + "\n// ... (truncated)"
         
-        user_prompt = f"""Analyze this decompiled code for malware:
-
-{combined_code}"""
+        user_prompt = f"Analyze this decompiled code for malware:\n\n{combined_code}"
         
-        response = await client.aio.models.generate_content(
-            model=GEMINI_CLEANUP_MODEL,  # Use Flash for speed
-            contents=MALWARE_DETECTION_PROMPT + "\n\n" + user_prompt,
-            config={
-                "temperature": 0.1,
-                "max_output_tokens": 1024,
-            }
+        # Low temperature, so the verdict for the same binary is reusable
+        cache_key = llm_cache.make_key(
+            model=GEMINI_CLEANUP_MODEL,
+            system=MALWARE_DETECTION_PROMPT,
+            prompt=user_prompt,
+            temperature=0.1,
         )
+        result_text = None if GEMINI_CACHE_DISABLED else await llm_cache.get(cache_key)
+        from_cache = result_text is not None
         
-        result_text = response.text.strip()
+        if not from_cache:
+            await _rate_limiter.acquire()
+            stream = await _open_stream(
+                GEMINI_CLEANUP_MODEL,  # Use Flash for speed
+                MALWARE_DETECTION_PROMPT,
+                user_prompt,
+                temperature=0.1,
+                max_output_tokens=1024,
+                response_mime_type="application/json",
+                response_schema=MALWARE_RESPONSE_SCHEMA,
+            )
+            
+            result_text = await _read_stream(stream)
         
         # Parse JSON response
-        import json
-        # Remove markdown code fences if present
-        result_text = re.sub(r'^```(?:json)?\n?', '', result_text)
-        result_text = re.sub(r'\n?```$', '', result_text)
-        
         try:
             result = json.loads(result_text)
             print(f"[*] Malware analysis result: is_malware={result.get('is_malware')}, confidence={result.get('confidence')}")
+            # Only well-formed verdicts are cached
+            if not from_cache and not GEMINI_CACHE_DISABLED:
+                await llm_cache.set(cache_key, result_text)
             return result
         except json.JSONDecodeError:
             print(f"[!] Failed to parse malware analysis response: {result_text[:200]}")
@@ -7,18 +7,51 @@ Requires:
 - Ghidra installed with GHIDRA_INSTALL_DIR environment variable set
 """
 
+import hashlib
+import importlib.util
+import json
+import logging
 import os
+import re
 import shutil
-from typing import Dict, Optional, Set
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, Optional, Set, Tuple
+
+# BLAKE3 (SIMD, multi-threaded) hashes binaries several times faster than
+# SHA-256; both expose the same update()/hexdigest() interface
+BLAKE3_AVAILABLE = False
+try:
+    from blake3 import blake3 as file_hasher
+    BLAKE3_AVAILABLE = True
+except ImportError:
+    from hashlib import sha256 as file_hasher
+
+# Per-function progress goes through the queued "decompile" logger (see main.py)
+log = logging.getLogger("decompile")
 
 # Check if Ghidra is properly configured
 GHIDRA_INSTALL_DIR = os.environ.get("GHIDRA_INSTALL_DIR")
 GHIDRA_AVAILABLE = False
 _ghidra_started = False
+_pyghidra = None
+
+# Functions are decompiled concurrently, one DecompInterface (and decompiler
+# process) per worker; JPype releases the GIL while the Java call runs
+DECOMPILE_WORKERS = int(os.environ.get("GHIDRA_DECOMPILE_WORKERS", str(os.cpu_count() or 1)))
 
-# Common library functions to SKIP (these are not user-written)
-LIBRARY_FUNCTIONS: Set[str] = {
-    # C standard library
+# Per-function decompile budget; a function that does not finish in time is
+# dropped from the results
+DECOMPILE_TIMEOUT_SECONDS = int(os.environ.get("GHIDRA_DECOMPILE_TIMEOUT_SECONDS", "30"))
+DECOMPILE_MAX_PAYLOAD_MB = int(os.environ.get("GHIDRA_DECOMPILE_MAX_PAYLOAD_MB", "50"))
+# Skip the decompiler's unreachable-code elimination pass (faster, slightly noisier output)
+FAST_DECOMPILE = os.environ.get("GHIDRA_FAST_DECOMPILE", "").lower() in ("true", "1", "yes")
+
+# Common library functions to SKIP (these are not user-written), by category
+# C standard library
+_CSTDLIB = frozenset({
     "malloc", "free", "calloc", "realloc",
     "printf", "fprintf", "sprintf", "snprintf", "vprintf", "vfprintf",
     "scanf", "fscanf", "sscanf",
@@ -34,7 +67,10 @@ LIBRARY_FUNCTIONS: Set[str] = {
     "toupper", "tolower",
     "time", "clock", "difftime", "mktime", "localtime", "gmtime",
     "qsort", "bsearch",
-    # Windows API
+})
+
+# Windows API
+_WIN32 = frozenset({
     "GetLastError", "SetLastError", "GetModuleHandle", "GetProcAddress",
     "LoadLibrary", "FreeLibrary", "GetModuleFileName",
     "CreateFile", "ReadFile", "WriteFile", "CloseHandle",
@@ -43,30 +79,45 @@ LIBRARY_FUNCTIONS: Set[str] = {
     "GetProcessHeap", "GetCurrentProcess", "GetCurrentThread",
     "ExitProcess", "TerminateProcess",
     "MessageBox", "MessageBoxA", "MessageBoxW",
-    # MSVC runtime
+})
+
+# MSVC runtime
+_MSVC = frozenset({
     "__security_check_cookie", "__security_init_cookie",
     "__GSHandlerCheck", "__CxxFrameHandler3", "__CxxFrameHandler4",
     "_initterm", "_initterm_e", "__acrt_iob_func",
-    "_cexit", "_c_exit", "_exit", "__p___argc", "__p___argv",
-    # Compiler-generated / linker stubs
+    "_cexit", "_c_exit", "__p___argc", "__p___argv",
+})
+
+# Compiler-generated / linker stubs
+_LINKER_STUBS = frozenset({
     "_start", "__libc_start_main", "__gmon_start__",
     "__cxa_atexit", "__cxa_finalize",
     "_fini", "_init",
-    # MinGW CRT (C Runtime) functions - NOT user code!
+})
+
+# MinGW CRT (C Runtime) functions - NOT user code!
+_MINGW = frozenset({
     "WinMainCRTStartup", "mainCRTStartup", "wmainCRTStartup", "wWinMainCRTStartup",
     "__tmainCRTStartup", "__wgetmainargs", "__getmainargs",
     "__main", "__do_global_dtors", "__do_global_ctors",
-    "atexit", "__gcc_register_frame", "__gcc_deregister_frame",
+    "__gcc_register_frame", "__gcc_deregister_frame",
     "mark_section_writable", "restore_modified_sections",
     "mingw_set_invalid_parameter_handler", "mingw_get_invalid_parameter_handler",
     "_matherr", "mingw_matherr", "__mingw_raise_matherr",
     "__mingw_GetSectionForAddress", "__mingw_GetSectionCount",
     "_pei386_runtime_relocator", "__mingw_init_ehandler",
     "_gnu_exception_handler", "__mingwInitEhandler",
-    # GCC exception handling
+})
+
+# GCC exception handling
+_GCC_EH = frozenset({
     "_Unwind_Resume", "_Unwind_RaiseException", "_Unwind_GetIP",
     "__gxx_personality_v0", "__cxa_begin_catch", "__cxa_end_catch",
     "__cxa_throw", "__cxa_rethrow", "__cxa_allocate_exception",
+})
+
+_STL_HELPERS = frozenset({
     # Common short helper/comparison functions (STL/operator overloads)
     "empty", "size", "length", "capacity", "begin", "end", "cbegin", "cend",
     "rbegin", "rend", "front", "back", "data", "clear", "erase", "insert",
@@ -94,15 +145,90 @@ LIBRARY_FUNCTIONS: Set[str] = {
     "emplace", "emplace_back", "emplace_front", "emplace_hint",
     "shrink_to_fit", "bucket_count", "load_factor", "max_load_factor",
     "hash_function", "key_eq", "key_comp", "value_comp",
-}
+})
+
+LIBRARY_FUNCTIONS: Set[str] = _CSTDLIB | _WIN32 | _MSVC | _LINKER_STUBS | _MINGW | _GCC_EH | _STL_HELPERS
+
+# is_user_function filter knobs (see its docstring), read once
+SKIP_FUN_FUNCTIONS = os.environ.get("SKIP_FUN_FUNCTIONS", "").lower() in ("true", "1", "yes")
+MIN_FUNCTION_SIZE = int(os.environ.get("MIN_FUNCTION_SIZE", "50"))
+
+# Casefolded once for the case-insensitive lookups in is_user_function;
+# every table compared against the casefolded name must be casefolded too
+_LIBRARY_FUNCTIONS_CF = frozenset(map(str.casefold, LIBRARY_FUNCTIONS))
+# Narrower table for ELF / Mach-O binaries, which never link the Windows
+# API, MSVC or MinGW runtimes (see library_functions_for)
+_NON_WINDOWS_LIBRARY_FUNCTIONS_CF = frozenset(
+    map(str.casefold, _CSTDLIB | _LINKER_STUBS | _GCC_EH | _STL_HELPERS)
+)
+
+# is_user_function's name tables, built once rather than per call
+_PRIORITY_NAMES = frozenset(map(str.casefold, ("main", "_main", "wmain", "_wmain", "winmain", "_winmain", "wwinmain")))
+_KEEP_UNDERSCORE_NAMES = frozenset(map(str.casefold, ("_main", "_winmain", "_start", "_wmain")))
+
+# Runtime functions by prefix (a tuple, so one str.startswith call checks them all)
+_RUNTIME_PREFIXES = (
+    # MSVC runtime
+    "__scrt_", "__acrt_", "__vcrt_", "__std_", "__crt_",
+    "_CRT_", "_RTC_", "__security_", "__report_", "__raise_",
+    "FID_conflict:", "_guard_", "__GSHandler", "__CxxFrame",
+    # MinGW runtime
+    "__mingw_", "_mingw_", "mingw_", "__gnu_",
+    "__do_global_", "__gcc_", "_Unwind_", "__gxx_",
+    "__cxa_", "_pei386_",
+    # GCC internals
+    "__register_frame", "__deregister_frame",
+)
+
+# CRT entry points, matched case-insensitively
+_CRT_PATTERNS_CF = tuple(sorted({p.casefold() for p in (
+    "crtStartup", "CRTStartup", "mainCRT", "WinMainCRT",
+    "tmainCRT", "wmainCRT", "dllmain", "DllMain",
+)}))
+
+# C++ STL / standard library template instantiations
+_STL_PATTERNS = (
+    "std::", "operator", "basic_string", "basic_ostream", "basic_istream",
+    "basic_ios", "basic_streambuf", "basic_filebuf", "basic_fstream",
+    "allocator<", "vector<", "list<", "map<", "set<", "unordered_",
+    "unique_ptr<", "shared_ptr<", "weak_ptr<", "make_unique", "make_shared",
+    "pair<", "tuple<", "optional<", "variant<", "any<",
+    "iterator<", "reverse_iterator", "back_insert_iterator",
+    "char_traits<", "collate<", "ctype<", "codecvt<",
+    "numpunct<", "moneypunct<", "time_get<", "time_put<",
+    "messages<", "money_get<", "money_put<", "num_get<", "num_put<",
+    "_Tidy_guard<", "_Alloc_", "_String_", "_Vector_", "_Tree_",
+    "locale::", "facet::", "ios_base::", "streambuf::",
+    # MSVC STL internals
+    "_Narrow_char_traits", "_Char_traits_base", "_String_alloc",
+    "_Compressed_pair", "_Vector_alloc", "_List_alloc",
+    # GNU C++ extensions
+    "__gnu_cxx::", "__gnu_cxx", "char_traits",
+    # Additional STL internal patterns
+    "__ptr_traits", "__alloc_traits", "__iterator_traits",
+    "pointer_to", "addressof", "construct_at", "destroy_at",
+    "allocator_traits", "uses_allocator",
+)
+
+# Each pattern table as one compiled alternation, so a single C-level scan
+# of the name tests every pattern
+_CRT_PATTERN_RE = re.compile("|".join(map(re.escape, _CRT_PATTERNS_CF)))
+_STL_PATTERN_RE = re.compile("|".join(map(re.escape, _STL_PATTERNS)))
+
+# _is_stdlib_code / _is_trivial_function patterns
+_STD_FUNCTION_NAME_RE = re.compile(r'\bstd::[a-zA-Z_][a-zA-Z0-9_<>:,\s]*\s*\(')
+_BLOCK_COMMENT_RE = re.compile(r'/\*.*?\*/', re.DOTALL)
+_LINE_COMMENT_RE = re.compile(r'//.*')
+# A body (from its opening brace) that is empty or only "return <name>;"
+_TRIVIAL_BODY_RE = re.compile(r'\{\s*(?:return\s+\w+\s*;?\s*)?\}\s*$', re.IGNORECASE)
 
 # Only try to use PyGhidra if GHIDRA_INSTALL_DIR is set
 if GHIDRA_INSTALL_DIR and os.path.exists(GHIDRA_INSTALL_DIR):
-    try:
-        import pyghidra
+    # Locate PyGhidra without importing it (and JPype) until first use
+    if importlib.util.find_spec("pyghidra") is not None:
         GHIDRA_AVAILABLE = True
         print(f"[+] Ghidra found at: {GHIDRA_INSTALL_DIR}")
-    except ImportError:
+    else:
         print("[!] PyGhidra not installed. Using mock decompiler for development.")
 else:
     if GHIDRA_INSTALL_DIR:
@@ -116,106 +242,176 @@ else:
 PROJECT_DIR = os.environ.get("GHIDRA_PROJECT_DIR", os.path.join(os.path.dirname(__file__), "..", "..", "ghidra_projects"))
 
 
+# Decompilation results keyed by the binary's content hash, so a repeat upload
+# skips Ghidra entirely. Least recently used entries are swept past the size cap.
+CACHE_DIR = os.environ.get("GHIDRA_CACHE_DIR", os.path.join(os.path.dirname(__file__), "..", "..", "ghidra_cache"))
+CACHE_DISABLED = os.environ.get("GHIDRA_CACHE_DISABLED", "").lower() in ("true", "1", "yes")
+CACHE_MAX_BYTES = int(os.environ.get("GHIDRA_CACHE_MAX_MB", "512")) * 1024 * 1024
+
+
+# Projects are deleted on one background thread so decompile_binary returns
+# without waiting on disk I/O; GHIDRA_SYNC_CLEANUP=1 deletes inline instead
+SYNC_PROJECT_CLEANUP = os.environ.get("GHIDRA_SYNC_CLEANUP", "").lower() in ("true", "1", "yes")
+_cleanup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ghidra-cleanup")
+
+
 def ensure_project_dir():
     """Ensure the project directory exists."""
     os.makedirs(PROJECT_DIR, exist_ok=True)
 
 
+def file_digest(file_path: str) -> str:
+    """Hex digest of a file's contents (memory-mapped with BLAKE3, else read in 1 MB chunks)."""
+    if BLAKE3_AVAILABLE:
+        digest = file_hasher(max_threads=file_hasher.AUTO)
+        digest.update_mmap(file_path)
+        return digest.hexdigest()
+    
+    digest = file_hasher()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Settings that change which functions come back (and how), folded into the
+# cache filename so changing one does not serve a stale entry
+_CACHE_CONFIG = hashlib.sha256(repr((
+    FAST_DECOMPILE, SKIP_FUN_FUNCTIONS, MIN_FUNCTION_SIZE,
+    DECOMPILE_TIMEOUT_SECONDS, DECOMPILE_MAX_PAYLOAD_MB,
+)).encode()).hexdigest()[:12]
+
+
+def _cache_path(digest: str) -> str:
+    return os.path.join(CACHE_DIR, f"{digest}-{_CACHE_CONFIG}.json")
+
+
+def _cache_read(digest: str) -> Optional[Dict[str, str]]:
+    """Load cached functions for a binary, marking the entry as recently used."""
+    path = _cache_path(digest)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            functions = json.load(f)
+        os.utime(path)
+        return functions
+    except (OSError, ValueError):
+        return None
+
+
+def _cache_write(digest: str, functions: Dict[str, str]):
+    """Store functions atomically (temp file + rename), then enforce the size cap."""
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        path = _cache_path(digest)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(functions, f)
+        os.replace(tmp, path)
+        _cache_sweep()
+    except OSError as e:
+        print(f"[!] Failed to cache decompilation: {e}")
+
+
+def _cache_sweep():
+    """Delete least recently used entries until the cache fits in CACHE_MAX_BYTES."""
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.endswith(".json"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def _get_pyghidra():
+    """Lazy-import PyGhidra."""
+    global _pyghidra
+    if _pyghidra is None:
+        import pyghidra
+        _pyghidra = pyghidra
+    return _pyghidra
+
+
 def start_ghidra():
     """Initialize PyGhidra JVM (only once)."""
     global _ghidra_started
     if GHIDRA_AVAILABLE and not _ghidra_started:
-        import pyghidra
+        pyghidra = _get_pyghidra()
         if not pyghidra.started():
             pyghidra.start(verbose=True)
             _ghidra_started = True
 
 
-def is_user_function(func, func_name: str) -> bool:
+def library_functions_for(program) -> frozenset:
     """
-    Determine if a function is likely written by the developer (not a library function).
+    Pick the casefolded library-name table for a program's executable format.
     
-    Returns True for user functions, False for library/runtime functions.
+    Args:
+        program: Ghidra Program being analyzed
+        
+    Returns:
+        The non-Windows table for ELF / Mach-O binaries, else the full table
+    """
+    exe_format = str(program.getExecutableFormat() or "")
+    if "ELF" in exe_format or "Mach-O" in exe_format:
+        return _NON_WINDOWS_LIBRARY_FUNCTIONS_CF
+    return _LIBRARY_FUNCTIONS_CF
+
+
+@lru_cache(maxsize=8192)
+def _is_user_function_name(func_name: str, library: frozenset = _LIBRARY_FUNCTIONS_CF) -> Optional[bool]:
+    """
+    Name-only part of is_user_function, memoized per (name, table).
     
-    Environment variables:
-    - SKIP_FUN_FUNCTIONS: Set to "true" to skip ALL FUN_* functions (faster for demos)
-    - MIN_FUNCTION_SIZE: Minimum bytes for FUN_* functions (default 50)
+    The same runtime/library names recur across binaries, so repeat
+    lookups skip the string scans and regex searches.
+    
+    Args:
+        func_name: Function name as reported by Ghidra
+        library: Casefolded library-name table (see library_functions_for)
+        
+    Returns:
+        True if the name is always kept (entry points), False if the name
+        alone rules it out, None if it still needs the body checks
     """
+    # Casefolded once and reused by every case-insensitive check below
+    func_cf = func_name.casefold()
+    
     # ALWAYS keep main, _main, wmain, WinMain - these are user entry points!
-    priority_names = ["main", "_main", "wmain", "_wmain", "winmain", "_winmain", "wwinmain"]
-    if func_name.lower() in priority_names:
+    if func_cf in _PRIORITY_NAMES:
         return True
     
-    # Skip external and thunk functions
-    if func.isExternal() or func.isThunk():
-        return False
-    
     # Optional: Skip ALL FUN_* functions for faster processing
-    skip_all_fun = os.environ.get("SKIP_FUN_FUNCTIONS", "").lower() in ("true", "1", "yes")
-    if skip_all_fun and func_name.startswith("FUN_"):
+    if SKIP_FUN_FUNCTIONS and func_name.startswith("FUN_"):
         return False
     
     # Skip known library function names
-    if func_name.lower() in {f.lower() for f in LIBRARY_FUNCTIONS}:
+    if func_cf in library:
         return False
     
     # Skip runtime functions by prefix patterns
-    runtime_prefixes = [
-        # MSVC runtime
-        "__scrt_", "__acrt_", "__vcrt_", "__std_", "__crt_",
-        "_CRT_", "_RTC_", "__security_", "__report_", "__raise_",
-        "FID_conflict:", "_guard_", "__GSHandler", "__CxxFrame",
-        # MinGW runtime
-        "__mingw_", "_mingw_", "mingw_", "__gnu_",
-        "__do_global_", "__gcc_", "_Unwind_", "__gxx_",
-        "__cxa_", "_pei386_",
-        # GCC internals
-        "__register_frame", "__deregister_frame",
-    ]
-    for prefix in runtime_prefixes:
-        if func_name.startswith(prefix):
-            return False
+    if func_name.startswith(_RUNTIME_PREFIXES):
+        return False
     
     # Skip CRT entry points (case-insensitive patterns)
-    crt_patterns = [
-        "crtStartup", "CRTStartup", "mainCRT", "WinMainCRT",
-        "tmainCRT", "wmainCRT", "dllmain", "DllMain",
-    ]
-    func_lower = func_name.lower()
-    for pattern in crt_patterns:
-        if pattern.lower() in func_lower:
-            return False
+    if _CRT_PATTERN_RE.search(func_cf):
+        return False
     
     # Skip functions starting with double underscore (compiler-generated)
     if func_name.startswith("__"):
         return False
     
     # Skip C++ STL / standard library template instantiations
-    stl_patterns = [
-        "std::", "operator", "basic_string", "basic_ostream", "basic_istream",
-        "basic_ios", "basic_streambuf", "basic_filebuf", "basic_fstream",
-        "allocator<", "vector<", "list<", "map<", "set<", "unordered_",
-        "unique_ptr<", "shared_ptr<", "weak_ptr<", "make_unique", "make_shared",
-        "pair<", "tuple<", "optional<", "variant<", "any<",
-        "iterator<", "reverse_iterator", "back_insert_iterator",
-        "char_traits<", "collate<", "ctype<", "codecvt<",
-        "numpunct<", "moneypunct<", "time_get<", "time_put<",
-        "messages<", "money_get<", "money_put<", "num_get<", "num_put<",
-        "_Tidy_guard<", "_Alloc_", "_String_", "_Vector_", "_Tree_",
-        "locale::", "facet::", "ios_base::", "streambuf::",
-        # MSVC STL internals
-        "_Narrow_char_traits", "_Char_traits_base", "_String_alloc",
-        "_Compressed_pair", "_Vector_alloc", "_List_alloc",
-        # GNU C++ extensions
-        "__gnu_cxx::", "__gnu_cxx", "char_traits",
-        # Additional STL internal patterns
-        "__ptr_traits", "__alloc_traits", "__iterator_traits",
-        "pointer_to", "addressof", "construct_at", "destroy_at",
-        "allocator_traits", "uses_allocator",
-    ]
-    for pattern in stl_patterns:
-        if pattern in func_name:
-            return False
+    if _STL_PATTERN_RE.search(func_name):
+        return False
     
     # Also check if function name starts with "std::" (may have comment header)
     if func_name.strip().startswith("std::"):
@@ -227,23 +423,46 @@ def is_user_function(func, func_name: str) -> bool:
     
     # Skip very short function names (1-2 chars) that are likely operators or helpers
     # But keep "main" etc.
-    if len(func_name) <= 2 and func_name.lower() not in ["main"]:
+    if len(func_name) <= 2 and func_cf != "main":
         return False
     
     # Skip functions starting with single underscore (usually compiler-generated)
     # But keep _main, _WinMain, _start
     if func_name.startswith("_"):
-        keep_names = ["_main", "_winmain", "_start", "_wmain"]
-        if func_name.lower() not in keep_names:
+        if func_cf not in _KEEP_UNDERSCORE_NAMES:
             return False
     
+    return None
+
+
+def is_user_function(func, func_name: str, library: frozenset = _LIBRARY_FUNCTIONS_CF) -> bool:
+    """
+    Determine if a function is likely written by the developer (not a library function).
+    
+    Returns True for user functions, False for library/runtime functions.
+    `library` is the casefolded library-name table, narrowed per binary
+    by library_functions_for.
+    
+    Environment variables:
+    - SKIP_FUN_FUNCTIONS: Set to "true" to skip ALL FUN_* functions (faster for demos)
+    - MIN_FUNCTION_SIZE: Minimum bytes for FUN_* functions (default 50)
+    """
+    # Name checks come first: they are pure Python (and cached), while every
+    # func.*() call below is a JPype round trip into the JVM
+    by_name = _is_user_function_name(func_name, library)
+    if by_name is not None:
+        return by_name
+    
+    # Skip external and thunk functions
+    if func.isExternal() or func.isThunk():
+        return False
+    
     # Skip FUN_ functions that are very short (likely stubs/library code)
     body = func.getBody()
     if body:
         num_addrs = body.getNumAddresses()
         # For FUN_* functions, require minimum size (default 50 bytes, configurable)
-        min_fun_size = int(os.environ.get("MIN_FUNCTION_SIZE", "50"))
-        if func_name.startswith("FUN_") and num_addrs < min_fun_size:
+        if func_name.startswith("FUN_") and num_addrs < MIN_FUNCTION_SIZE:
             return False
         # For named functions, require at least 10 bytes
         elif num_addrs < 10:
@@ -263,9 +482,8 @@ def _is_stdlib_code(c_code: str) -> bool:
     
     The function name may appear after a return type in the comment.
     """
-    import re
-    
-    lines = c_code.strip().split('\n')
+    # Only the header matters; maxsplit avoids splitting the whole body
+    lines = c_code.strip().split('\n', 5)[:5]
     if not lines:
         return False
     
@@ -279,7 +497,7 @@ def _is_stdlib_code(c_code: str) -> bool:
     # Pattern 1: std::func_name( - the function name is in std:: namespace
     # This catches: std::min<...>(...), std::__ptr_traits<...>::method(...)
     # The key is that std:: is followed by an identifier and then < or (
-    if re.search(r'\bstd::[a-zA-Z_][a-zA-Z0-9_<>:,\s]*\s*\(', header):
+    if _STD_FUNCTION_NAME_RE.search(header):
         # But exclude cases where std:: only appears inside parameter list
         # Find where the first ( is - everything before is return type + func name
         first_paren = header.find('(')
@@ -313,51 +531,19 @@ def _is_trivial_function(c_code: str) -> bool:
     Check if a function is trivial (just returns the parameter, empty, or single-line).
     These are usually compiler-generated stubs or wrappers.
     """
-    import re
-    
     # Remove comments and whitespace for analysis
-    code_stripped = re.sub(r'/\*.*?\*/', '', c_code, flags=re.DOTALL)
-    code_stripped = re.sub(r'//.*', '', code_stripped)
-    code_stripped = code_stripped.strip()
-    
-    # Count actual statements (lines with semicolons, excluding function signature)
-    lines = [l.strip() for l in code_stripped.split('\n') if l.strip()]
-    
-    # Remove function signature line(s)
-    body_started = False
-    body_lines = []
-    brace_count = 0
-    for line in lines:
-        if '{' in line:
-            body_started = True
-            brace_count += line.count('{')
-            brace_count -= line.count('}')
-            # If there's content after the brace, include it
-            after_brace = line.split('{', 1)[1].strip()
-            if after_brace and after_brace != '}':
-                body_lines.append(after_brace)
-        elif body_started:
-            brace_count += line.count('{')
-            brace_count -= line.count('}')
-            if brace_count > 0 or (brace_count == 0 and line != '}'):
-                body_lines.append(line)
-    
-    # Filter out empty lines and closing braces
-    meaningful_lines = [l for l in body_lines if l and l != '}' and l != '{']
-    
-    # If only one meaningful line and it's just "return param_X;", it's trivial
-    if len(meaningful_lines) <= 1:
-        if not meaningful_lines:
-            return True
-        line = meaningful_lines[0].lower()
-        # Pattern: "return param_1;" or "return something;"
-        if re.match(r'^return\s+\w+\s*;?$', line):
-            return True
+    code_stripped = _BLOCK_COMMENT_RE.sub('', c_code)
+    code_stripped = _LINE_COMMENT_RE.sub('', code_stripped)
     
-    return False
+    # Everything from the first brace on is the body; the signature never
+    # contains one
+    body_start = code_stripped.find('{')
+    if body_start < 0:
+        return True
+    return _TRIVIAL_BODY_RE.match(code_stripped, body_start) is not None
 
 
-def decompile_binary(file_path: str, job_id: str) -> Dict[str, str]:
+def decompile_binary(file_path: str, job_id: str, digest: Optional[str] = None) -> Dict[str, str]:
     """
     Decompile a binary file and return a mapping of function names to decompiled C code.
     Filters to only include user-written functions (not library code).
@@ -365,6 +551,8 @@ def decompile_binary(file_path: str, job_id: str) -> Dict[str, str]:
     Args:
         file_path: Path to the binary file to decompile
         job_id: Unique job identifier for project naming
+        digest: file_hasher digest of the file if the caller already computed it
+            (the upload handler hashes while streaming); hashed here otherwise
         
     Returns:
         Dictionary mapping function names to their decompiled C code
@@ -373,6 +561,15 @@ def decompile_binary(file_path: str, job_id: str) -> Dict[str, str]:
         print("[*] Using mock decompiler (Ghidra not configured)")
         return _mock_decompile(file_path)
     
+    if CACHE_DISABLED:
+        digest = None
+    else:
+        digest = digest or file_digest(file_path)
+        cached = _cache_read(digest)
+        if cached is not None:
+            print(f"[+] Decompilation cache hit ({len(cached)} functions)")
+            return cached
+    
     ensure_project_dir()
     
     try:
@@ -382,11 +579,10 @@ def decompile_binary(file_path: str, job_id: str) -> Dict[str, str]:
         print("[*] Falling back to mock decompiler")
         return _mock_decompile(file_path)
     
-    import pyghidra
-    # Import Ghidra classes after starting JVM
-    from ghidra.app.decompiler import DecompInterface
+    pyghidra = _get_pyghidra()
     
     functions = {}
+    failed_count = 0  # Functions that failed or timed out in the decompiler
     project_name = f"job_{job_id}"
     
     try:
@@ -406,53 +602,48 @@ def decompile_binary(file_path: str, job_id: str) -> Dict[str, str]:
                 print(f"[*] Running Ghidra auto-analysis...")
                 analysis_log = pyghidra.analyze(program, pyghidra.task_monitor(120))
                 
-                # Set up decompiler interface
-                decompiler = DecompInterface()
-                decompiler.openProgram(program)
-                
                 # Get all functions
                 func_manager = program.getFunctionManager()
                 func_iterator = func_manager.getFunctions(True)
+                library = library_functions_for(program)
                 
-                print(f"[*] Identifying user-written functions...")
-                user_functions = []
+                print(f"[*] Identifying and decompiling user-written functions ({DECOMPILE_WORKERS} workers)...")
+                user_count = 0
                 skipped_count = 0
                 
-                for func in func_iterator:
-                    func_name = func.getName()
-                    
-                    if is_user_function(func, func_name):
-                        user_functions.append((func, func_name))
-                    else:
-                        skipped_count += 1
+                # Each user function is queued for decompilation as soon as it
+                # is identified, so the filter pass overlaps with decompiling
+                def _user_functions():
+                    nonlocal user_count, skipped_count
+                    for func in func_iterator:
+                        func_name = func.getName()
+                        
+                        if is_user_function(func, func_name, library):
+                            user_count += 1
+                            yield func, func_name
+                        else:
+                            skipped_count += 1
                 
-                print(f"[+] Found {len(user_functions)} user functions (skipped {skipped_count} library functions)")
+                decompiled = _decompile_parallel(program, _user_functions(), DECOMPILE_WORKERS)
                 
-                # Decompile user functions
-                print(f"[*] Decompiling user functions...")
-                for func, func_name in user_functions:
-                    # Decompile the function with a 30-second timeout per function
-                    result = decompiler.decompileFunction(func, 30, pyghidra.task_monitor())
-                    
-                    if result.decompileCompleted():
-                        decomp_func = result.getDecompiledFunction()
-                        if decomp_func:
-                            c_code = decomp_func.getC()
-                            if c_code:
-                                # Post-filter: Skip if decompiled code contains std:: (template instantiation)
-                                if _is_stdlib_code(c_code):
-                                    print(f"[-] Skipping stdlib function: {func_name}")
-                                    skipped_count += 1
-                                    continue
-                                # Post-filter: Skip trivial functions (just return param)
-                                if _is_trivial_function(c_code):
-                                    print(f"[-] Skipping trivial function: {func_name}")
-                                    skipped_count += 1
-                                    continue
-                                functions[func_name] = c_code
-                                print(f"[+] Decompiled: {func_name}")
+                for func_name, c_code in decompiled:
+                    if c_code is None:
+                        failed_count += 1
+                    elif c_code:
+                        # Post-filter: Skip if decompiled code contains std:: (template instantiation)
+                        if _is_stdlib_code(c_code):
+                            log.info("[-] Skipping stdlib function: %s", func_name)
+                            skipped_count += 1
+                            continue
+                        # Post-filter: Skip trivial functions (just return param)
+                        if _is_trivial_function(c_code):
+                            log.info("[-] Skipping trivial function: %s", func_name)
+                            skipped_count += 1
+                            continue
+                        functions[func_name] = c_code
+                        log.info("[+] Decompiled: %s", func_name)
                 
-                decompiler.dispose()
+                print(f"[+] Found {user_count} user functions, kept {len(functions)} (skipped {skipped_count} library functions)")
                 
     except Exception as e:
         print(f"[!] Error during decompilation: {e}")
@@ -462,24 +653,84 @@ def decompile_binary(file_path: str, job_id: str) -> Dict[str, str]:
         # Clean up project directory
         project_path = os.path.join(PROJECT_DIR, project_name + ".gpr")
         project_folder = os.path.join(PROJECT_DIR, project_name + ".rep")
+        if SYNC_PROJECT_CLEANUP:
+            _cleanup_project(project_path, project_folder)
+        else:
+            _cleanup_executor.submit(_cleanup_project, project_path, project_folder)
+    
+    # A run that lost functions to failures or timeouts is not cached, so
+    # the next upload of the binary gets another try at them
+    if digest is not None and not failed_count:
+        _cache_write(digest, functions)
+    
+    return functions
+
+
+def _cleanup_project(project_path: str, project_folder: str):
+    """Delete a job's Ghidra project files."""
+    try:
         if os.path.exists(project_path):
             os.remove(project_path)
         if os.path.exists(project_folder):
             shutil.rmtree(project_folder)
-    
-    return functions
+    except OSError as e:
+        print(f"[!] Failed to clean up Ghidra project {project_path}: {e}")
 
 
-def _mock_decompile(file_path: str) -> Dict[str, str]:
+def _decompile_parallel(program, funcs: Iterable[Tuple[object, str]], workers: int) -> Iterator[Tuple[str, Optional[str]]]:
     """
-    Mock decompilation for development/testing without Ghidra.
-    Returns sample decompiled code that looks realistic.
+    Decompile `(func, name)` pairs on up to `workers` threads, each with its
+    own DecompInterface (an interface is not thread-safe), opened on the
+    thread's first function so small binaries don't start unused decompilers.
+    
+    Functions are submitted as `funcs` produces them, and results are yielded
+    as soon as they are ready (in input order), so the caller's
+    post-filtering overlaps with the remaining decompilation.
+    
+    Yields:
+        (name, decompiled C code) per function, in input order (code is
+        None where decompilation failed or timed out)
     """
-    filename = os.path.basename(file_path)
+    pyghidra = _get_pyghidra()
+    from ghidra.app.decompiler import DecompileOptions, DecompInterface
+    
+    options = DecompileOptions()
+    options.grabFromProgram(program)
+    options.setMaxPayloadMBytes(DECOMPILE_MAX_PAYLOAD_MB)
+    if FAST_DECOMPILE:
+        options.setEliminateUnreachable(False)
+    
+    local = threading.local()
+    opened = []
+    
+    def _decompile(func, name: str) -> Optional[str]:
+        decompiler = getattr(local, "decompiler", None)
+        if decompiler is None:
+            decompiler = local.decompiler = DecompInterface()
+            opened.append(decompiler)
+            decompiler.setOptions(options)
+            decompiler.setSimplificationStyle("decompile")
+            decompiler.openProgram(program)
+        result = decompiler.decompileFunction(func, DECOMPILE_TIMEOUT_SECONDS, pyghidra.task_monitor())
+        if not result.decompileCompleted():
+            log.warning("[!] Decompile failed for %s: %s", name, result.getErrorMessage() or "timed out")
+            return None
+        decomp_func = result.getDecompiledFunction()
+        return decomp_func.getC() if decomp_func else None
     
-    # Return mock decompiled code (simulating user-written functions only)
-    return {
-        "main": f'''int main(int argc, char **argv)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [(name, executor.submit(_decompile, func, name)) for func, name in funcs]
+            for name, future in futures:
+                yield name, future.result()
+    finally:
+        for decompiler in opened:
+            decompiler.dispose()
+
+
+# Mock decompiled code (simulating user-written functions only). Only main
+# depends on the input, so the other bodies are built once at import time.
+_MOCK_MAIN_TEMPLATE = '''int main(int argc, char **argv)
 {{
     int iVar1;
     undefined8 uVar2;
@@ -506,44 +757,57 @@ LAB_00401050:
     }}
     
     return iVar1;
-}}''',
-        "process_input": '''undefined8 process_input(char *param_1)
-{{
+}}'''
+
+_MOCK_FUNCTIONS = {
+    "process_input": '''undefined8 process_input(char *param_1)
+{
     size_t sVar1;
     void *pvVar2;
     undefined8 uVar3;
     
     sVar1 = strlen(param_1);
-    if (sVar1 == 0) {{
+    if (sVar1 == 0) {
         uVar3 = 0;
-    }}
-    else {{
+    }
+    else {
         pvVar2 = malloc(sVar1 + 1);
-        if (pvVar2 == (void *)0x0) {{
+        if (pvVar2 == (void *)0x0) {
             uVar3 = 0;
-        }}
-        else {{
+        }
+        else {
             strcpy((char *)pvVar2, param_1);
             uVar3 = (undefined8)pvVar2;
-        }}
-    }}
+        }
+    }
     return uVar3;
-}}''',
-        "calculate_result": '''long calculate_result(long param_1)
-{{
+}''',
+    "calculate_result": '''long calculate_result(long param_1)
+{
     long lVar1;
     int iVar2;
     long lVar3;
     
     lVar1 = 0;
-    if (param_1 != 0) {{
+    if (param_1 != 0) {
         lVar3 = 0;
-        do {{
+        do {
             iVar2 = *(int *)(param_1 + lVar3 * 4);
             lVar1 = lVar1 + (long)iVar2;
             lVar3 = lVar3 + 1;
-        }} while (lVar3 < 10);
-    }}
+        } while (lVar3 < 10);
+    }
     return lVar1;
-}}''',
+}''',
+}
+
+
+def _mock_decompile(file_path: str) -> Dict[str, str]:
+    """
+    Mock decompilation for development/testing without Ghidra.
+    Returns sample decompiled code that looks realistic.
+    """
+    return {
+        "main": _MOCK_MAIN_TEMPLATE.format(filename=os.path.basename(file_path)),
+        **_MOCK_FUNCTIONS,
     }
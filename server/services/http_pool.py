@@ -0,0 +1,96 @@
+"""
+Process-wide async HTTP connection pool.
+
+The Modal and Gemini clients share one httpx.AsyncClient so repeated calls
+reuse warm keep-alive connections (multiplexed over HTTP/2 when the h2
+package is installed) instead of paying a TCP+TLS handshake per request.
+
+Connections belong to the event loop that opened them, so there is one
+pool per running loop: the server's, plus one per asyncio.run() from sync
+callers. per_loop() gives other modules the same treatment for their
+clients, locks and semaphores.
+
+Timeouts are set per request by each caller.
+
+Usage:
+    from services.http_pool import get_http_client
+
+    response = await get_http_client().post(url, json=payload, timeout=120.0)
+"""
+
+import asyncio
+import importlib.util
+import os
+import weakref
+from typing import Any, Callable, TypeVar
+
+import httpx
+
+# httpx speaks HTTP/2 only with the h2 package installed
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "128"))
+KEEPALIVE_EXPIRY_SECONDS = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY_SECONDS", "300"))
+# Log every response's protocol version, to check that calls
+# share pooled (HTTP/2 multiplexed) connections
+HTTP_DEBUG = os.environ.get("HTTP_DEBUG", "").lower() in ("true", "1", "yes")
+
+T = TypeVar("T")
+
+# Entries disappear with their loop
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+
+
+def per_loop(registry: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Any]", factory: Callable[[], T]) -> T:
+    """Return `registry`'s object for the running event loop, creating it with `factory` on first use."""
+    loop = asyncio.get_running_loop()
+    value = registry.get(loop)
+    if value is None:
+        value = registry[loop] = factory()
+    return value
+
+
+async def _log_response(response: httpx.Response):
+    request = response.request
+    print(f"[*] {request.method} {request.url.host}{request.url.path} -> {response.status_code} {response.http_version}")
+
+
+def _new_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        http2=HTTP2_AVAILABLE,
+        limits=httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_CONNECTIONS // 2,
+            keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS,
+        ),
+        timeout=None,
+        event_hooks={"response": [_log_response]} if HTTP_DEBUG else None,
+    )
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Lazy-create the shared async HTTP client for the running event loop."""
+    return per_loop(_clients, _new_client)
+
+
+async def warm_up(*urls: str):
+    """
+    Open keep-alive connections to `urls` ahead of the first real request,
+    so it does not pay the TCP+TLS handshake. Failures are only logged.
+    """
+    client = get_http_client()
+    
+    async def _one(url: str):
+        try:
+            await client.head(url, timeout=10.0)
+        except httpx.HTTPError as e:
+            print(f"[!] Connection warm-up failed for {url}: {e}")
+    
+    await asyncio.gather(*[_one(url) for url in urls])
+
+
+async def close_http_client():
+    """Close the running loop's client (on app shutdown)."""
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
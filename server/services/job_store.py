@@ -0,0 +1,130 @@
+"""
+Job store for decompilation jobs.
+
+Jobs are kept in Redis when REDIS_URL is set, so every uvicorn worker sees
+the same jobs and finished jobs expire on their own after JOB_TTL_SECONDS.
+Without REDIS_URL (or without the redis package) jobs live in process memory,
+which only works with a single worker.
+
+Usage:
+    from services.job_store import create_job, get_job, update_job, append_log
+
+    await create_job(job_id, {"status": JobStatus.PENDING, "logs": [], ...})
+    await append_log(job_id, "[*] Starting...")
+    job = await get_job(job_id)
+"""
+
+import json
+import os
+import time
+from typing import Any, Dict, Optional
+
+REDIS_URL = os.environ.get("REDIS_URL")
+JOB_TTL_SECONDS = int(os.environ.get("JOB_TTL_SECONDS", "3600"))
+
+REDIS_AVAILABLE = False
+if REDIS_URL:
+    try:
+        import redis.asyncio as aioredis
+        REDIS_AVAILABLE = True
+        print(f"[+] Using Redis job store: {REDIS_URL}")
+    except ImportError:
+        print("[!] REDIS_URL set but redis not installed. Using in-memory job store.")
+
+_redis = None
+
+# In-memory fallback: job_id -> job dict (with "_expires_at" bookkeeping)
+_jobs: Dict[str, Dict[str, Any]] = {}
+
+
+def _get_redis():
+    """Lazy-load the Redis client."""
+    global _redis
+    if _redis is None:
+        _redis = aioredis.from_url(REDIS_URL, decode_responses=True)
+    return _redis
+
+
+def _job_key(job_id: str) -> str:
+    return f"job:{job_id}"
+
+
+def _logs_key(job_id: str) -> str:
+    return f"job:{job_id}:logs"
+
+
+def _evict_expired():
+    """Drop in-memory jobs whose TTL has passed."""
+    now = time.time()
+    expired = [job_id for job_id, job in _jobs.items() if job["_expires_at"] < now]
+    for job_id in expired:
+        del _jobs[job_id]
+
+
+async def create_job(job_id: str, job: Dict[str, Any]):
+    """Create a job. `job["logs"]` seeds the log list."""
+    if not REDIS_AVAILABLE:
+        _evict_expired()
+        _jobs[job_id] = {**job, "logs": list(job.get("logs", [])), "_expires_at": time.time() + JOB_TTL_SECONDS}
+        return
+
+    redis = _get_redis()
+    fields = {k: json.dumps(v) for k, v in job.items() if k != "logs"}
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(_job_key(job_id), mapping=fields)
+        pipe.expire(_job_key(job_id), JOB_TTL_SECONDS)
+        if job.get("logs"):
+            pipe.rpush(_logs_key(job_id), *job["logs"])
+            pipe.expire(_logs_key(job_id), JOB_TTL_SECONDS)
+        await pipe.execute()
+
+
+async def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """Return the job (including its logs), or None if it does not exist."""
+    if not REDIS_AVAILABLE:
+        job = _jobs.get(job_id)
+        if job is None or job["_expires_at"] < time.time():
+            return None
+        return job
+
+    redis = _get_redis()
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.hgetall(_job_key(job_id))
+        pipe.lrange(_logs_key(job_id), 0, -1)
+        fields, logs = await pipe.execute()
+    if not fields:
+        return None
+    job = {k: json.loads(v) for k, v in fields.items()}
+    job["logs"] = logs
+    return job
+
+
+async def update_job(job_id: str, **fields: Any):
+    """Set fields on an existing job. Unknown job IDs are ignored."""
+    if not REDIS_AVAILABLE:
+        if job_id in _jobs:
+            _jobs[job_id].update(fields)
+        return
+
+    redis = _get_redis()
+    if not await redis.exists(_job_key(job_id)):
+        return
+    await redis.hset(_job_key(job_id), mapping={k: json.dumps(v) for k, v in fields.items()})
+
+
+async def append_log(job_id: str, *messages: str):
+    """Append log lines (in one round trip) to an existing job. Unknown job IDs are ignored."""
+    if not messages:
+        return
+    if not REDIS_AVAILABLE:
+        if job_id in _jobs:
+            _jobs[job_id]["logs"].extend(messages)
+        return
+
+    redis = _get_redis()
+    if not await redis.exists(_job_key(job_id)):
+        return
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.rpush(_logs_key(job_id), *messages)
+        pipe.expire(_logs_key(job_id), JOB_TTL_SECONDS)
+        await pipe.execute()
@@ -0,0 +1,162 @@
+"""
+Response cache for deterministic LLM calls.
+
+Results are keyed by a hash (BLAKE3 if installed, else SHA-256) of everything that determines the output
+(model/endpoint, prompt settings, input code), so re-analysing a binary or
+hitting the same function twice skips the network round trip entirely.
+
+Entries live in Redis when REDIS_URL is set (shared across workers),
+otherwise in an in-process LRU. Both expire after LLM_CACHE_TTL_SECONDS.
+Without Redis, setting LLM_CACHE_DIR also persists entries to disk
+(gzipped, one file per key) so re-running on the same binary after a
+restart still hits the cache.
+
+Cache calls that are effectively deterministic (greedy / near-zero
+temperature), or sampled calls whose first sample is meant to be pinned:
+Gemini refactor/cleanup (temperature 0.8/1.0) are memoized on purpose so a
+re-analysed binary shows the same code as before. Such callers must offer
+an opt-out for fresh samples (GEMINI_CACHE_DISABLE).
+
+Usage:
+    from services import llm_cache
+
+    key = llm_cache.make_key(model=MODEL_ID, max_tokens=2048, code=code)
+    cached = await llm_cache.get(key)
+    if cached is None:
+        cached = await call_model(code)
+        await llm_cache.set(key, cached)
+"""
+
+import asyncio
+import gzip
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Optional, Tuple
+
+try:
+    from blake3 import blake3 as _hasher
+except ImportError:
+    from hashlib import sha256 as _hasher
+
+REDIS_URL = os.environ.get("REDIS_URL")
+CACHE_TTL_SECONDS = int(os.environ.get("LLM_CACHE_TTL_SECONDS", "86400"))
+CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "1024"))
+DISABLED_BY_ENV = os.environ.get("DISABLE_LLM_CACHE", "").lower() in ("true", "1", "yes")
+
+REDIS_AVAILABLE = False
+if REDIS_URL and not DISABLED_BY_ENV:
+    try:
+        import redis.asyncio as aioredis
+        REDIS_AVAILABLE = True
+    except ImportError:
+        pass
+
+# Disk tier for the in-process cache (Redis already outlives the process)
+CACHE_DIR = os.environ.get("LLM_CACHE_DIR")
+_disk_dir = Path(CACHE_DIR).expanduser() if CACHE_DIR and not REDIS_AVAILABLE and not DISABLED_BY_ENV else None
+
+_redis = None
+
+# In-process LRU: key -> (expires_at, value)
+_memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+stats = {"hits": 0, "misses": 0}
+
+
+def _get_redis():
+    """Lazy-load the Redis client."""
+    global _redis
+    if _redis is None:
+        _redis = aioredis.from_url(REDIS_URL, decode_responses=True)
+    return _redis
+
+
+def _disk_path(key: str) -> Path:
+    return _disk_dir / key[:2] / f"{key[2:]}.gz"
+
+
+def _disk_read(key: str) -> Optional[str]:
+    """Read an entry from disk; the file's mtime holds its expiry time."""
+    path = _disk_path(key)
+    try:
+        if path.stat().st_mtime < time.time():
+            path.unlink(missing_ok=True)
+            return None
+        return gzip.decompress(path.read_bytes()).decode("utf-8")
+    except (OSError, EOFError):
+        return None
+
+
+def _disk_write(key: str, value: str, expires_at: float):
+    """Write an entry atomically (temp file + rename) so readers never see partial data."""
+    path = _disk_path(key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    tmp.write_bytes(gzip.compress(value.encode("utf-8")))
+    os.utime(tmp, (expires_at, expires_at))
+    os.replace(tmp, path)
+
+
+def make_key(**parts: Any) -> str:
+    """Build a cache key from the inputs that determine the output."""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+    return _hasher(payload.encode("utf-8")).hexdigest()
+
+
+async def get(key: str) -> Optional[str]:
+    """Return the cached value for `key`, or None on a miss."""
+    if DISABLED_BY_ENV:
+        return None
+
+    value = None
+    if REDIS_AVAILABLE:
+        value = await _get_redis().get(f"llmcache:{key}")
+    else:
+        entry = _memory.get(key)
+        if entry is not None:
+            expires_at, cached = entry
+            if expires_at >= time.time():
+                _memory.move_to_end(key)
+                value = cached
+            else:
+                del _memory[key]
+
+        if value is None and _disk_dir is not None:
+            value = await asyncio.to_thread(_disk_read, key)
+            if value is not None:
+                _remember(key, value, CACHE_TTL_SECONDS)
+
+    if value is None:
+        stats["misses"] += 1
+    else:
+        stats["hits"] += 1
+    return value
+
+
+async def set(key: str, value: str, ttl: int = CACHE_TTL_SECONDS):
+    """Store `value` under `key` for `ttl` seconds."""
+    if DISABLED_BY_ENV:
+        return
+
+    if REDIS_AVAILABLE:
+        await _get_redis().set(f"llmcache:{key}", value, ex=ttl)
+        return
+
+    _remember(key, value, ttl)
+    if _disk_dir is not None:
+        try:
+            await asyncio.to_thread(_disk_write, key, value, time.time() + ttl)
+        except OSError as e:
+            print(f"[!] Failed to persist LLM cache entry: {e}")
+
+
+def _remember(key: str, value: str, ttl: int):
+    """Store in the in-process LRU, evicting the least recently used entries."""
+    _memory[key] = (time.time() + ttl, value)
+    _memory.move_to_end(key)
+    while len(_memory) > CACHE_MAX_ENTRIES:
+        _memory.popitem(last=False)
@@ -11,9 +11,14 @@ Model: LLM4Binary/llm4decompile-1.3b-v2
 - ~0.8GB with 4-bit quantization, ~2.6GB FP16
 """
 
+import importlib.util
 import os
 import re
-from typing import Optional, Tuple
+import shutil
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
 
 # Check if disabled via environment variable
 DISABLED_BY_ENV = os.environ.get("DISABLE_LLM4DECOMPILE", "").lower() in ("true", "1", "yes")
@@ -23,6 +28,16 @@ LLM4DECOMPILE_AVAILABLE = None  # None = not yet checked, True/False = checked
 BITSANDBYTES_AVAILABLE = False
 _model = None
 _tokenizer = None
+_draft_model = None
+_load_lock = threading.Lock()
+# Compiled path: preallocated StaticCache per batch size (see _static_cache).
+# The caches and captured CUDA graphs are shared, so one generate at a time.
+_static_caches = {}
+_compiled_generate_lock = threading.Lock()
+# Side stream for host-to-device input copies (see _to_device)
+_copy_stream = None
+# Formats decoded outputs while the next batch generates (see decompile_to_c_batch)
+_postprocess_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm4decompile-post")
 torch = None
 _initialized = False
 
@@ -50,6 +65,9 @@ def _lazy_init():
         # Check for CUDA
         if torch.cuda.is_available():
             print(f"[+] CUDA available: {torch.cuda.get_device_name(0)}")
+            # Let any FP32 matmuls/convolutions use TF32 tensor cores (Ampere+)
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
         else:
             print("[*] Running on CPU (slower inference)")
         
@@ -76,9 +94,74 @@ def _lazy_init():
         print(f"[!] Unexpected error loading LLM4Decompile: {e}")
         LLM4DECOMPILE_AVAILABLE = False
 
+# Load the model (and warm up generation) on a background thread at import,
+# so the first request doesn't pay the 30-60 s load. Off by default so CLI
+# tools importing this module don't load it.
+PRELOAD = os.environ.get("LLM4DECOMPILE_PRELOAD", "").lower() in ("true", "1", "yes")
+
 # Use the 1.3B Refine model - trained specifically on Ghidra pseudo-C
 MODEL_ID = "LLM4Binary/llm4decompile-1.3b-v2"
 
+# torch.compile the unquantized model (on CUDA in reduce-overhead mode: CUDA
+# graphs over a static KV cache; on CPU, Inductor's C++ kernels). Prompts are padded up to a few fixed lengths so the
+# compiled graphs are reused instead of recompiled for every input size.
+COMPILE_MODEL = os.environ.get("LLM4DECOMPILE_COMPILE", "").lower() in ("true", "1", "yes")
+_LENGTH_BUCKETS = (256, 512, 1024, 2048, 4096)
+# Inductor's compiled-kernel cache, kept on disk so restarts skip recompiling
+INDUCTOR_CACHE_DIR = os.environ.get(
+    "TORCHINDUCTOR_CACHE_DIR",
+    os.path.join(os.path.dirname(__file__), "..", "..", "inductor_cache"),
+)
+_compiled = False
+
+# Greedy decoding settings (also part of ai_service's result cache key)
+MAX_NEW_TOKENS = 2048
+REPETITION_PENALTY = 1.05  # Mild penalty to reduce loops
+
+# Stop each row as soon as its output loops on a line or closes the function
+# (see _EarlyStop) instead of decoding up to MAX_NEW_TOKENS
+EARLY_STOP = os.environ.get("LLM4DECOMPILE_EARLY_STOP", "true").lower() in ("true", "1", "yes")
+
+# Skip the model for functions with nothing left for it to clean up (see
+# _looks_like_clean_c); they only get mock_decompile_to_c's formatting
+FAST_PATH = os.environ.get("LLM4DECOMPILE_FAST_PATH", "true").lower() in ("true", "1", "yes")
+
+# Functions refined per generate call (see decompile_to_c_batch)
+BATCH_SIZE = int(os.environ.get("LLM4DECOMPILE_BATCH_SIZE", "4"))
+
+# Assisted decoding for single-function calls (exact under greedy decoding:
+# the 1.3B model verifies every proposed token). A small draft CausalLM that
+# shares the tokenizer proposes LLM4DECOMPILE_DRAFT_TOKENS tokens per step;
+# without one, candidates are looked up in the prompt, which works well here
+# since the output echoes many Ghidra tokens verbatim. 0 disables lookup.
+DRAFT_MODEL_ID = os.environ.get("LLM4DECOMPILE_DRAFT_MODEL", "")
+DRAFT_TOKENS = int(os.environ.get("LLM4DECOMPILE_DRAFT_TOKENS", "5"))
+PROMPT_LOOKUP_TOKENS = int(os.environ.get("LLM4DECOMPILE_PROMPT_LOOKUP_TOKENS", "10"))
+
+# Local safetensors copy of MODEL_ID, written after the first unquantized
+# load. Later processes load it memory-mapped, so workers share the weights
+# through the OS page cache and CUDA loads stream straight to the GPU.
+SNAPSHOT_DIR = os.environ.get(
+    "LLM4DECOMPILE_SNAPSHOT_DIR",
+    os.path.join(os.path.dirname(__file__), "..", "..", "llm4decompile_snapshot"),
+)
+
+# Pre-quantized INT4 (GPTQ or AWQ) checkpoint of MODEL_ID, e.g. a local dir
+# made once offline with gptqmodel/autoawq. Its quantization_config picks the
+# fused INT4 kernels (Marlin/ExLlamaV2/AWQ), which skip bitsandbytes' per-matmul
+# dequantize. CUDA only; the bitsandbytes/FP16 paths are the fallback.
+QUANTIZED_MODEL_ID = os.environ.get("LLM4DECOMPILE_QUANTIZED_MODEL", "")
+
+# CPU inference: bfloat16 on CPUs with native bf16 (AVX512-BF16 / AMX), which
+# halves the weight bandwidth of fp32 decode; LLM4DECOMPILE_CPU_BF16=false
+# keeps fp32. LLM4DECOMPILE_CPU_THREADS overrides torch's intra-op thread count.
+CPU_BF16 = os.environ.get("LLM4DECOMPILE_CPU_BF16", "true").lower() in ("true", "1", "yes")
+CPU_THREADS = int(os.environ.get("LLM4DECOMPILE_CPU_THREADS", "0"))
+
+# FlashAttention-2 kernels, when the optional flash-attn package is installed
+# (pip install flash-attn --no-build-isolation)
+FLASH_ATTN_AVAILABLE = importlib.util.find_spec("flash_attn") is not None
+
 
 def is_available() -> bool:
     """Check if LLM4Decompile is available. Triggers lazy init if needed."""
@@ -87,13 +170,80 @@ def is_available() -> bool:
     return LLM4DECOMPILE_AVAILABLE and not DISABLED_BY_ENV
 
 
+def _attn_implementation() -> str:
+    """
+    Pick the fused attention kernel for from_pretrained.
+    
+    FlashAttention-2 needs the flash-attn package and an Ampere or newer GPU
+    (its kernels are half-precision only, which every CUDA load path here
+    uses), and is left out of the torch.compile static-cache path;
+    everything else, CPU included, uses PyTorch's built-in
+    scaled_dot_product_attention.
+    """
+    if (
+        FLASH_ATTN_AVAILABLE
+        and torch.cuda.is_available()
+        and torch.cuda.get_device_capability()[0] >= 8
+        and not COMPILE_MODEL
+    ):
+        return "flash_attention_2"
+    return "sdpa"
+
+
+def _model_source() -> str:
+    """The local safetensors snapshot if one was written, else MODEL_ID."""
+    for weights in ("model.safetensors", "model.safetensors.index.json"):
+        if os.path.isfile(os.path.join(SNAPSHOT_DIR, weights)):
+            return SNAPSHOT_DIR
+    return MODEL_ID
+
+
+def _save_snapshot(model, tokenizer):
+    """
+    Save the loaded (unquantized) model as safetensors into SNAPSHOT_DIR.
+    Written to a temp dir and renamed into place, so a crash mid-write never
+    leaves a partial snapshot behind. Failures are only logged.
+    """
+    tmp_dir = f"{SNAPSHOT_DIR}.tmp{os.getpid()}"
+    try:
+        print(f"[*] Saving safetensors snapshot to {SNAPSHOT_DIR}...")
+        model.save_pretrained(tmp_dir, safe_serialization=True)
+        tokenizer.save_pretrained(tmp_dir)
+        os.replace(tmp_dir, SNAPSHOT_DIR)
+    except Exception as e:
+        print(f"[!] Could not save model snapshot: {e}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _cpu_dtype():
+    """bfloat16 if enabled and the CPU runs it natively (oneDNN check), else float32."""
+    if CPU_BF16:
+        try:
+            if torch.ops.mkldnn._is_mkldnn_bf16_supported():
+                return torch.bfloat16
+        except (AttributeError, RuntimeError):
+            pass
+    return torch.float32
+
+
 def get_model() -> Tuple[Optional[object], Optional[object]]:
     """
     Lazy-load the LLM4Decompile 1.3B model.
-    Uses 4-bit quantization if bitsandbytes is available, otherwise FP16.
+    Uses the LLM4DECOMPILE_QUANTIZED_MODEL checkpoint if set, else 4-bit
+    quantization if bitsandbytes is available, otherwise FP16.
     Returns (model, tokenizer) tuple.
     """
-    global _model, _tokenizer
+    if _model is None:
+        # One load at a time: callers arriving mid-load (e.g. during the
+        # LLM4DECOMPILE_PRELOAD warmup) wait for it rather than loading twice
+        with _load_lock:
+            return _load_model()
+    return _model, _tokenizer
+
+
+def _load_model() -> Tuple[Optional[object], Optional[object]]:
+    """get_model's loader; call with _load_lock held."""
+    global _model, _tokenizer, _draft_model, _compiled
     
     if not is_available():
         print("[!] LLM4Decompile not available")
@@ -103,24 +253,50 @@ def get_model() -> Tuple[Optional[object], Optional[object]]:
         from transformers import AutoTokenizer, AutoModelForCausalLM
         
         try:
-            if BITSANDBYTES_AVAILABLE and torch.cuda.is_available():
+            attn_implementation = _attn_implementation()
+            print(f"[*] Attention implementation: {attn_implementation}")
+            
+            prequantized = False
+            if QUANTIZED_MODEL_ID and torch.cuda.is_available():
+                print(f"[*] Loading LLM4Decompile 1.3B (pre-quantized INT4: {QUANTIZED_MODEL_ID})...")
+                try:
+                    _model = AutoModelForCausalLM.from_pretrained(
+                        QUANTIZED_MODEL_ID,
+                        device_map="auto",
+                        attn_implementation=attn_implementation,
+                        low_cpu_mem_usage=True,
+                        trust_remote_code=True,
+                    )
+                    _tokenizer = AutoTokenizer.from_pretrained(MODEL_ID)
+                    prequantized = True
+                except Exception as e:
+                    print(f"[!] Failed to load pre-quantized checkpoint, falling back: {e}")
+                    _model = None
+            
+            source = _model_source()
+            if prequantized:
+                print("[+] Using the checkpoint's fused INT4 kernels")
+            elif BITSANDBYTES_AVAILABLE and torch.cuda.is_available():
                 # 4-bit quantization for memory efficiency (~0.8GB)
                 from transformers import BitsAndBytesConfig
                 print(f"[*] Loading LLM4Decompile 1.3B (4-bit quantized)...")
                 print(f"[*] This may take 30-60 seconds on first load...")
                 
+                # Ampere+ runs the dequantized matmuls on bf16 tensor cores
+                compute_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
                 bnb_config = BitsAndBytesConfig(
                     load_in_4bit=True,
-                    bnb_4bit_compute_dtype=torch.float16,
+                    bnb_4bit_compute_dtype=compute_dtype,
                     bnb_4bit_quant_type="nf4",
                     bnb_4bit_use_double_quant=True,
                 )
                 
-                _tokenizer = AutoTokenizer.from_pretrained(MODEL_ID)
+                _tokenizer = AutoTokenizer.from_pretrained(source)
                 _model = AutoModelForCausalLM.from_pretrained(
-                    MODEL_ID,
+                    source,
                     quantization_config=bnb_config,
                     device_map="auto",
+                    attn_implementation=attn_implementation,
                     low_cpu_mem_usage=True,
                     trust_remote_code=True,
                 )
@@ -129,29 +305,69 @@ def get_model() -> Tuple[Optional[object], Optional[object]]:
                 print(f"[*] Loading LLM4Decompile 1.3B (FP16)...")
                 print(f"[*] This may take 30-60 seconds on first load...")
                 
-                _tokenizer = AutoTokenizer.from_pretrained(MODEL_ID)
+                _tokenizer = AutoTokenizer.from_pretrained(source)
                 
                 # Use GPU if available, otherwise CPU
                 if torch.cuda.is_available():
                     _model = AutoModelForCausalLM.from_pretrained(
-                        MODEL_ID,
+                        source,
                         dtype=torch.float16,
                         device_map="auto",
+                        attn_implementation=attn_implementation,
                         low_cpu_mem_usage=True,
                         trust_remote_code=True,
                     )
                 else:
-                    # CPU inference - use float32 for stability
+                    # CPU inference - bf16 where native, else float32 for stability
+                    cpu_dtype = _cpu_dtype()
+                    print(f"[*] CPU dtype: {cpu_dtype}")
+                    # One request decodes at a time: wide intra-op GEMMs, no inter-op pool
+                    if CPU_THREADS > 0:
+                        torch.set_num_threads(CPU_THREADS)
+                    try:
+                        torch.set_num_interop_threads(1)
+                    except RuntimeError:
+                        pass  # Only settable before any inter-op work has run
                     _model = AutoModelForCausalLM.from_pretrained(
-                        MODEL_ID,
-                        dtype=torch.float32,
+                        source,
+                        dtype=cpu_dtype,
+                        attn_implementation=attn_implementation,
                         low_cpu_mem_usage=True,
                         trust_remote_code=True,
                     )
+                
+                if source == MODEL_ID:
+                    _save_snapshot(_model, _tokenizer)
             
             # Set pad token if not set
             if _tokenizer.pad_token is None:
                 _tokenizer.pad_token = _tokenizer.eos_token
+            # Pad on the left so generation continues from the real prompt end
+            _tokenizer.padding_side = "left"
+            
+            # 4-bit (bitsandbytes / INT4) kernels do not compile
+            on_cuda = torch.cuda.is_available()
+            if COMPILE_MODEL and not prequantized and not (on_cuda and BITSANDBYTES_AVAILABLE):
+                # CUDA graphs (reduce-overhead) are GPU-only; on CPU Inductor
+                # emits vectorized (AVX-512 / AMX) C++ kernels
+                mode = "reduce-overhead" if on_cuda else "default"
+                print(f"[*] Compiling LLM4Decompile with torch.compile ({mode})...")
+                # Inductor reads this when it first compiles
+                os.environ["TORCHINDUCTOR_CACHE_DIR"] = INDUCTOR_CACHE_DIR
+                # Bucketed padding keeps shapes fixed, so no dynamic-shape graphs
+                _model.forward = torch.compile(_model.forward, mode=mode, fullgraph=False, dynamic=False)
+                _compiled = True
+            
+            if DRAFT_MODEL_ID:
+                print(f"[*] Loading draft model {DRAFT_MODEL_ID} for assisted decoding...")
+                try:
+                    _draft_model = AutoModelForCausalLM.from_pretrained(
+                        DRAFT_MODEL_ID,
+                        dtype=_model.dtype,
+                        low_cpu_mem_usage=True,
+                    ).to(_model.device)
+                except Exception as e:
+                    print(f"[!] Failed to load draft model, using prompt lookup: {e}")
             
             device = next(_model.parameters()).device
             print(f"[+] LLM4Decompile 1.3B model loaded successfully")
@@ -166,6 +382,46 @@ def get_model() -> Tuple[Optional[object], Optional[object]]:
     return _model, _tokenizer
 
 
+# LLM4Decompile Refine model prompt format
+_PROMPT_PREFIX = "# This is the Ghidra pseudo-C:\n"
+_PROMPT_SUFFIX = "\n# What is the source code?\n"
+_TRUNCATION_NOTE = "\n// ... (input truncated)"
+MAX_INPUT_TOKENS = 4096
+
+
+def _encode_prompt(tokenizer, ghidra_pseudo_c: str) -> List[int]:
+    """
+    Token ids of the Refine prompt for one function. Over MAX_INPUT_TOKENS,
+    the pseudo-C is cut at the token level and the instruction suffix is
+    kept intact (truncating the joined prompt would cut the suffix off).
+    """
+    ids = tokenizer(_PROMPT_PREFIX + ghidra_pseudo_c + _PROMPT_SUFFIX).input_ids
+    if len(ids) <= MAX_INPUT_TOKENS:
+        return ids
+    
+    prefix = tokenizer(_PROMPT_PREFIX).input_ids
+    suffix = tokenizer(_TRUNCATION_NOTE + _PROMPT_SUFFIX, add_special_tokens=False).input_ids
+    body = tokenizer(ghidra_pseudo_c, add_special_tokens=False).input_ids
+    keep = MAX_INPUT_TOKENS - len(prefix) - len(suffix)
+    print(f"[*] Input truncated from {len(body)} to {keep} tokens")
+    return prefix + body[:keep] + suffix
+
+
+def _tokenize(tokenizer, pseudo_codes: List[str]):
+    """
+    Build the left-padded generate inputs for a batch of functions. When the
+    model is compiled, pad up to the next _LENGTH_BUCKETS size so input
+    shapes repeat.
+    """
+    encoded = {"input_ids": [_encode_prompt(tokenizer, code) for code in pseudo_codes]}
+    if not _compiled:
+        return tokenizer.pad(encoded, padding=True, return_tensors="pt")
+    
+    longest = max(map(len, encoded["input_ids"]))
+    bucket = next(size for size in _LENGTH_BUCKETS if size >= longest)
+    return tokenizer.pad(encoded, padding="max_length", max_length=bucket, return_tensors="pt")
+
+
 def decompile_to_c(ghidra_pseudo_c: str) -> str:
     """
     Refine Ghidra pseudo-C into clean C code using LLM4Decompile.
@@ -184,66 +440,347 @@ def decompile_to_c(ghidra_pseudo_c: str) -> str:
     Returns:
         Refined C code (or original if model unavailable)
     """
+    return decompile_to_c_batch([ghidra_pseudo_c])[0]
+
+
+def decompile_to_c_batch(pseudo_codes: List[str]) -> List[str]:
+    """
+    Refine several functions, LLM4DECOMPILE_BATCH_SIZE at a time, each
+    group in a single left-padded generate call. Decoding is memory-bandwidth
+    bound, so a batch costs little more than one sequence. Functions that
+    already look like clean C skip the model (LLM4DECOMPILE_FAST_PATH).
+    
+    Args:
+        pseudo_codes: Raw Ghidra pseudo-C, one entry per function
+        
+    Returns:
+        Refined C code per input, in order (the original code for any
+        function whose output was garbled or whose batch failed)
+    """
+    results = [None] * len(pseudo_codes)
+    if FAST_PATH:
+        for i, code in enumerate(pseudo_codes):
+            if _looks_like_clean_c(code):
+                results[i] = mock_decompile_to_c(code)
+    to_generate = [i for i, result in enumerate(results) if result is None]
+    if not to_generate:
+        return results
+    
     model, tokenizer = get_model()
     
     if model is None or tokenizer is None:
         print("[!] LLM4Decompile not available, returning original code")
-        return ghidra_pseudo_c
+        return [pseudo_codes[i] if result is None else result for i, result in enumerate(results)]
     
-    try:
-        # Truncate very long inputs to prevent slow inference
-        max_input_chars = 100000  # ~8000 tokens 
-        truncated_input = ghidra_pseudo_c
-        if len(ghidra_pseudo_c) > max_input_chars:
-            truncated_input = ghidra_pseudo_c[:max_input_chars] + "\n// ... (input truncated)"
-            print(f"[*] Input truncated from {len(ghidra_pseudo_c)} to {max_input_chars} chars")
+    # Each group's post-processing (pure-Python regex work) runs on
+    # _postprocess_executor while the next group generates
+    pending = []
+    for start in range(0, len(to_generate), BATCH_SIZE):
+        batch = [pseudo_codes[i] for i in to_generate[start:start + BATCH_SIZE]]
+        try:
+            texts = _generate_batch(model, tokenizer, batch)
+        except Exception as e:
+            print(f"[!] Error during LLM4Decompile inference: {e}")
+            import traceback
+            traceback.print_exc()
+            pending.append((batch, None))
+            continue
+        pending.append((batch, _postprocess_executor.submit(_postprocess, batch, texts)))
+    
+    refined = []
+    for batch, future in pending:
+        try:
+            refined.extend(batch if future is None else future.result())
+        except Exception as e:
+            print(f"[!] Error post-processing LLM4Decompile output: {e}")
+            refined.extend(batch)
+    for i, code in zip(to_generate, refined):
+        results[i] = code
+    return results
+
+
+class _EarlyStop:
+    """
+    Per-row stop test during generation; also usable as a transformers
+    stopping criterion. A row is done once its output repeats the same line
+    four times in a row (the first test in _detect_and_truncate_repetition,
+    which would cut that tail anyway) or closes the function with a bare "}"
+    at column 0 that brings the brace depth back to 0.
+    """
+    
+    def __init__(self, tokenizer, prompt_length: int, batch_size: int):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.done = [False] * batch_size
+        self._checked = prompt_length  # Tokens already looked at
+        self._scanned = [0] * batch_size  # Output chars already split into lines
+        self._last_line = [None] * batch_size
+        self._repeats = [0] * batch_size
+        self._depth = [0] * batch_size
+        self._opened = [False] * batch_size
+    
+    def __call__(self, input_ids, scores=None, **kwargs):
+        length = input_ids.shape[1]
+        for row in range(input_ids.shape[0]):
+            if self.done[row]:
+                continue
+            # Lines only complete at a newline; skip the full decode until one arrives
+            if '\n' not in self.tokenizer.decode(input_ids[row, self._checked:length]):
+                continue
+            text = self.tokenizer.decode(input_ids[row, self.prompt_length:], skip_special_tokens=True)
+            end = text.rfind('\n')
+            for line in text[self._scanned[row]:end].split('\n'):
+                if self._scan_line(row, line):
+                    self.done[row] = True
+                    break
+            self._scanned[row] = end + 1
+        self._checked = length
+        return torch.tensor(self.done, device=input_ids.device)
+    
+    def _scan_line(self, row: int, line: str) -> bool:
+        stripped = line.strip()
+        if stripped:
+            if stripped == self._last_line[row]:
+                self._repeats[row] += 1
+                if self._repeats[row] >= 3:
+                    return True
+            else:
+                self._repeats[row] = 0
+                self._last_line[row] = stripped
         
-        # LLM4Decompile Refine model prompt format
-        prompt = f"# This is the Ghidra pseudo-C:\n{truncated_input}\n# What is the source code?\n"
+        self._depth[row] += line.count('{') - line.count('}')
+        if self._depth[row] > 0:
+            self._opened[row] = True
+        return self._opened[row] and self._depth[row] <= 0 and line.rstrip() == '}'
+
+
+def _greedy_decode(model, inputs, max_new_tokens: int, repetition_penalty: float, eos_token_id: int, stop=None):
+    """
+    Greedy decoding over an explicit KV cache: one prefill forward over the
+    (left-padded) prompts, then one single-token forward per step. Same
+    result as generate(do_sample=False, repetition_penalty=...) without its
+    per-token logits-processor and stopping-criteria bookkeeping.
+    
+    Args:
+        model: Causal LM from get_model
+        inputs: Tokenizer output with input_ids and attention_mask
+        max_new_tokens: Generation cap per row
+        repetition_penalty: generate-style penalty over prompt + output ids
+        eos_token_id: Stop token, also used to pad rows that finished early
+        stop: Optional _EarlyStop, called with the ids so far after each step
         
-        inputs = tokenizer(
-            prompt, 
-            return_tensors="pt",
-            truncation=True,
-            max_length=4096,
-        ).to(model.device)
+    Returns:
+        Generated token ids, shape (batch, steps)
+    """
+    input_ids = inputs.input_ids
+    attention_mask = inputs.attention_mask
+    # Left padding: positions count real tokens only
+    position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+    
+    # Prefill
+    out = model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids, use_cache=True)
+    past = out.past_key_values
+    logits = out.logits[:, -1, :].float()
+    
+    seen = input_ids
+    finished = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+    generated = []
+    
+    # Decode
+    for _ in range(max_new_tokens):
+        if repetition_penalty != 1.0:
+            score = torch.gather(logits, 1, seen)
+            score = torch.where(score < 0, score * repetition_penalty, score / repetition_penalty)
+            logits = logits.scatter(1, seen, score)
         
-        print(f"[*] Input tokens: {inputs.input_ids.shape[1]}")
+        next_token = logits.argmax(-1).masked_fill(finished, eos_token_id)
+        generated.append(next_token)
+        seen = torch.cat([seen, next_token[:, None]], dim=-1)
+        finished |= next_token == eos_token_id
+        if stop is not None:
+            finished |= stop(seen)
+        if finished.all():
+            break
         
-        with torch.no_grad():
-            outputs = model.generate(
-                **inputs,
-                max_new_tokens=2048,
-                do_sample=False,  # Greedy decoding - model is trained for this
-                repetition_penalty=1.05,  # Mild penalty to reduce loops
-                pad_token_id=tokenizer.eos_token_id,
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones((attention_mask.shape[0], 1))], dim=-1)
+        position_ids = position_ids[:, -1:] + 1
+        out = model(
+            input_ids=next_token[:, None],
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past,
+            use_cache=True,
+        )
+        past = out.past_key_values
+        logits = out.logits[:, -1, :].float()
+    
+    return torch.stack(generated, dim=1)
+
+
+def _static_cache(model, batch_size: int):
+    """
+    Preallocated StaticCache for the compiled path, reused across calls. Its
+    length is fixed at the largest prompt bucket plus MAX_NEW_TOKENS, so the
+    decode step has the same shapes (and replays the same captured CUDA
+    graph) for every prompt length. Call with _compiled_generate_lock held.
+    """
+    from transformers import StaticCache
+    
+    cache = _static_caches.get(batch_size)
+    if cache is None:
+        cache = _static_caches[batch_size] = StaticCache(
+            config=model.config,
+            max_batch_size=batch_size,
+            max_cache_len=_LENGTH_BUCKETS[-1] + MAX_NEW_TOKENS,
+            device=model.device,
+            dtype=model.dtype,
+        )
+    else:
+        cache.reset()
+    return cache
+
+
+def _to_device(inputs, device):
+    """
+    Move tokenizer output to the model's device. On CUDA the tensors are
+    pinned and copied with non_blocking=True on a side stream, so the copy
+    overlaps host-side work; the compute stream waits on it before prefill.
+    """
+    global _copy_stream
+    
+    if device.type != "cuda":
+        return inputs.to(device)
+    
+    if _copy_stream is None:
+        _copy_stream = torch.cuda.Stream(device)
+    compute_stream = torch.cuda.current_stream(device)
+    with torch.cuda.stream(_copy_stream):
+        for key, value in inputs.items():
+            moved = value.pin_memory().to(device, non_blocking=True)
+            # Allocated on the copy stream but used on the compute stream
+            moved.record_stream(compute_stream)
+            inputs[key] = moved
+    compute_stream.wait_stream(_copy_stream)
+    return inputs
+
+
+def _assisted_kwargs() -> dict:
+    """generate() arguments for assisted decoding, or {} when it is off."""
+    if _draft_model is not None:
+        return {"assistant_model": _draft_model, "num_assistant_tokens": DRAFT_TOKENS}
+    if PROMPT_LOOKUP_TOKENS > 0:
+        return {"prompt_lookup_num_tokens": PROMPT_LOOKUP_TOKENS}
+    return {}
+
+
+def _generate_batch(model, tokenizer, pseudo_codes: List[str]) -> List[str]:
+    inputs = _to_device(_tokenize(tokenizer, pseudo_codes), model.device)
+    
+    print(f"[*] Input tokens: {inputs.input_ids.shape[1]} x {len(pseudo_codes)}")
+    
+    # generate only supports assisted decoding for a single sequence
+    assisted = _assisted_kwargs() if len(pseudo_codes) == 1 and not _compiled else {}
+    stop = _EarlyStop(tokenizer, inputs.input_ids.shape[1], len(pseudo_codes)) if EARLY_STOP else None
+    
+    # inference_mode also skips autograd's view tracking and version counters
+    with torch.inference_mode():
+        if _compiled or assisted:
+            # The compiled graphs are built around a static cache, and
+            # assisted decoding lives in generate
+            from transformers import StoppingCriteriaList
+            
+            def _generate(**cache):
+                return model.generate(
+                    **inputs,
+                    **assisted,
+                    **cache,
+                    stopping_criteria=StoppingCriteriaList([stop] if stop else []),
+                    max_new_tokens=MAX_NEW_TOKENS,
+                    do_sample=False,  # Greedy decoding - model is trained for this
+                    repetition_penalty=REPETITION_PENALTY,
+                    pad_token_id=tokenizer.eos_token_id,
+                    eos_token_id=tokenizer.eos_token_id,
+                )
+            
+            if _compiled:
+                with _compiled_generate_lock:
+                    outputs = _generate(past_key_values=_static_cache(model, len(pseudo_codes)))
+            else:
+                outputs = _generate()
+            # Keep only the new tokens (skip the left-padded prompt)
+            new_tokens = outputs[:, inputs.input_ids.shape[1]:]
+        else:
+            new_tokens = _greedy_decode(
+                model,
+                inputs,
+                max_new_tokens=MAX_NEW_TOKENS,
+                repetition_penalty=REPETITION_PENALTY,
                 eos_token_id=tokenizer.eos_token_id,
+                stop=stop,
             )
-        
-        # Decode only the new tokens (skip the prompt)
-        prompt_length = inputs.input_ids.shape[1]
-        result = tokenizer.decode(
-            outputs[0][prompt_length:], 
-            skip_special_tokens=True
-        )
-        
-        print(f"[*] Output tokens: {len(outputs[0]) - prompt_length}")
-        
+    
+    texts = tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+    
+    print(f"[*] Output tokens: {new_tokens.shape[1]}")
+    return texts
+
+
+def _postprocess(pseudo_codes: List[str], texts: List[str]) -> List[str]:
+    """Format each decoded output, falling back to the input where it is garbled."""
+    refined = []
+    for ghidra_pseudo_c, result in zip(pseudo_codes, texts):
         # Post-process to fix formatting (LLM sometimes outputs minified code)
         formatted = _format_c_code(result.strip())
         
         # Sanity check: detect garbled/hallucinated output
         if _is_garbled_output(formatted):
             print("[!] LLM output appears garbled, returning original Ghidra code")
-            return ghidra_pseudo_c
-        
-        return formatted
-        
-    except Exception as e:
-        print(f"[!] Error during LLM4Decompile inference: {e}")
-        import traceback
-        traceback.print_exc()
-        return ghidra_pseudo_c
+            formatted = ghidra_pseudo_c
+        refined.append(formatted)
+    return refined
+
+
+# Ghidra-generated names, types and casts the model is there to clean up
+_GHIDRA_ARTIFACT_RE = re.compile(
+    r'undefined|longlong|\(void \*\)0x0|[=!]= 0x0\b'
+    r'|\b(?:param|local|[a-z]{1,3}Stack)_\w+'
+    r'|\b[a-z]{1,3}Var\d+'
+    r'|\b(?:FUN|DAT|LAB|PTR|SUB|UNK|thunk_FUN)_[0-9a-fA-F]+'
+    r'|\b(?:CONCAT|SUB|ZEXT|SEXT)\d+\(|\(code \*\)'
+)
+
+
+def _looks_like_clean_c(code: str) -> bool:
+    """
+    True if the pseudo-C has no Ghidra artifacts, balanced braces and no
+    over-long lines, i.e. the 1.3B model would have nothing to improve.
+    """
+    return (
+        _GHIDRA_ARTIFACT_RE.search(code) is None
+        and code.count('{') == code.count('}')
+        and _LONG_LINE_RE.search(code) is None
+    )
+
+
+# _is_garbled_output tables
+_SPECIAL_CHARS_TABLE = str.maketrans('', '', '@\\^`~|')
+_GARBAGE_PATTERNS = (
+    '\\x',  # Hex escapes in non-string context
+    '@ptrfun',  # Hallucinated syntax
+    '@ptrcast',
+    '@VERSIONSTRING',
+    '/scratch/',  # Hallucinated file paths
+    '\\uFFFD',  # Unicode replacement char
+    '!!!',  # Triple exclamation (nonsense)
+    '???',  # Triple question (nonsense)
+    '([[[',  # Malformed brackets
+    ']]])',
+    '{{{{',  # Excessive braces
+    '}}}}',
+)
+_GARBAGE_PATTERNS_BY_LOWER = {pattern.lower(): pattern for pattern in _GARBAGE_PATTERNS}
+_GARBAGE_RE = re.compile("|".join(map(re.escape, _GARBAGE_PATTERNS)), re.IGNORECASE)
+_LONG_LINE_RE = re.compile(r'[^\n]{501}')
 
 
 def _is_garbled_output(code: str) -> bool:
@@ -254,37 +791,22 @@ def _is_garbled_output(code: str) -> bool:
     if not code or len(code) < 10:
         return True
     
-    # Check for excessive special characters (sign of hallucination)
-    special_chars = sum(1 for c in code if c in '@\\^`~|')
+    # Check for excessive special characters (sign of hallucination);
+    # translate deletes them in C, the length difference is their count
+    special_chars = len(code) - len(code.translate(_SPECIAL_CHARS_TABLE))
     if special_chars > len(code) * 0.05:  # More than 5% special chars
         return True
     
     # Check for broken escape sequences or garbage patterns
-    garbage_patterns = [
-        '\\x',  # Hex escapes in non-string context
-        '@ptrfun',  # Hallucinated syntax
-        '@ptrcast',
-        '@VERSIONSTRING',
-        '/scratch/',  # Hallucinated file paths
-        '\\uFFFD',  # Unicode replacement char
-        '!!!',  # Triple exclamation (nonsense)
-        '???',  # Triple question (nonsense)
-        '([[[',  # Malformed brackets
-        ']]])',
-        '{{{{',  # Excessive braces
-        '}}}}',
-    ]
-    
-    code_lower = code.lower()
-    for pattern in garbage_patterns:
-        if pattern.lower() in code_lower:
-            print(f"[!] Detected garbage pattern: {pattern}")
-            return True
-    
-    # Check for extremely long lines (sign of broken formatting)
-    for line in code.split('\n'):
-        if len(line) > 500:  # No reasonable C line is this long
-            return True
+    match = _GARBAGE_RE.search(code)
+    if match:
+        print(f"[!] Detected garbage pattern: {_GARBAGE_PATTERNS_BY_LOWER[match.group(0).lower()]}")
+        return True
+    
+    # Check for extremely long lines (sign of broken formatting):
+    # no reasonable C line is over 500 chars
+    if _LONG_LINE_RE.search(code):
+        return True
     
     # Check for balanced braces (basic syntax check)
     open_braces = code.count('{')
@@ -296,6 +818,17 @@ def _is_garbled_output(code: str) -> bool:
     return False
 
 
+# _format_c_code / _detect_and_truncate_repetition patterns, compiled once
+_SEMI_OR_FOR_RE = re.compile(r'for\s*\([^)]+\)|;(?!\s*\n)')
+_OPEN_BRACE_RE = re.compile(r'\{(?!\s*\n)')
+_CLOSE_BRACE_BEFORE_RE = re.compile(r'(?<!\n)\s*\}')
+_CLOSE_BRACE_AFTER_RE = re.compile(r'\}(?!\s*else)(?!\s*\n)(?!\s*$)')
+_MULTI_NEWLINE_RE = re.compile(r'\n{3,}')
+_VAR_DECL_RE = re.compile(r'std::string\s+(\w+)\s*\(')
+# Indent prefixes by depth, built once instead of per line
+_INDENT = tuple('    ' * depth for depth in range(64))
+
+
 def _detect_and_truncate_repetition(code: str) -> str:
     """
     Detect repetition loops in LLM output and truncate them.
@@ -305,91 +838,86 @@ def _detect_and_truncate_repetition(code: str) -> str:
     if len(lines) < 10:
         return code
     
-    truncate_at = None
+    # All four strategies run in a single pass over the lines; each keeps the
+    # line where it first fires (None if it never does). They are applied in
+    # priority order below, so only the first one's firing ends the pass early.
     
     # Strategy 1: Look for repeated line patterns (same line > 3 times in a row)
+    repeat_at = None
     consecutive_repeats = 0
     last_line = None
     
+    # Strategy 2: Detect variable name inflation pattern
+    # e.g., str_body, str_bod, str_bo, str_b OR str_bodyt, str_bodytt, str_bodyttt
+    inflation_at = None
+    inflation_count = 0
+    prev_name = None
+    var_lines = deque(maxlen=6)  # Lines of the last 6 std::string declarations
+    
+    # Strategy 3: Too many std::string declarations (sign of hallucination)
+    string_decl_at = None
+    string_decl_count = 0
+    
+    # Strategy 4: Look for total frequency (same meaningful line appears many times)
+    frequency_at = None
+    seen_lines = {}  # line -> (occurrences, index of the second one)
+    
     for i, line in enumerate(lines):
         stripped = line.strip()
-        if not stripped:
-            continue
         
-        if stripped == last_line:
-            consecutive_repeats += 1
-            if consecutive_repeats >= 3:
-                truncate_at = i - consecutive_repeats
-                break
-        else:
-            consecutive_repeats = 0
-            last_line = stripped
-    
-    # Strategy 2: Detect variable name inflation pattern
-    # e.g., str_body, str_bod, str_bo, str_b OR str_bodyt, str_bodytt, str_bodyttt
-    if truncate_at is None:
-        import re
-        var_decl_pattern = re.compile(r'std::string\s+(\w+)\s*\(')
-        var_names = []
-        var_lines = []
+        if stripped:
+            if stripped == last_line:
+                consecutive_repeats += 1
+                if consecutive_repeats >= 3:
+                    repeat_at = i - consecutive_repeats
+                    break
+            else:
+                consecutive_repeats = 0
+                last_line = stripped
         
-        for i, line in enumerate(lines):
-            match = var_decl_pattern.search(line)
-            if match:
-                var_names.append(match.group(1))
+        if 'std::string' in line:
+            string_decl_count += 1
+            if string_decl_count == 11:  # After 10, start truncating
+                string_decl_at = i
+            
+            match = _VAR_DECL_RE.search(line)
+            if match and inflation_at is None:
+                curr = match.group(1)
                 var_lines.append(i)
-        
-        # Look for inflation: names getting longer by single chars
-        if len(var_names) > 5:
-            inflation_count = 0
-            for j in range(1, len(var_names)):
-                prev = var_names[j-1]
-                curr = var_names[j]
-                # Check if curr is prev + one char, or prev is curr + one char
-                if (len(curr) == len(prev) + 1 and curr.startswith(prev)) or \
-                   (len(prev) == len(curr) + 1 and prev.startswith(curr)):
+                # Names getting longer (or shorter) by single chars
+                if prev_name is not None and (
+                    (len(curr) == len(prev_name) + 1 and curr.startswith(prev_name)) or
+                    (len(prev_name) == len(curr) + 1 and prev_name.startswith(curr))
+                ):
                     inflation_count += 1
                     if inflation_count >= 5:  # 5+ inflating names in a row
-                        # Find where this pattern started
-                        start_idx = j - inflation_count
-                        if start_idx >= 0:
-                            truncate_at = var_lines[start_idx]
-                            print(f"[!] Detected variable inflation loop at line {truncate_at}")
-                            break
+                        # Where this pattern started
+                        inflation_at = var_lines[0]
                 else:
                     inflation_count = 0
+                prev_name = curr
+        
+        # (lines under 15 chars, like braces and return;, are never counted)
+        if frequency_at is None and len(stripped) >= 15:
+            occurrences, second_at = seen_lines.get(stripped, (0, None))
+            occurrences += 1
+            if occurrences == 2:
+                second_at = i
+            elif occurrences >= 4:
+                frequency_at = second_at
+            seen_lines[stripped] = (occurrences, second_at)
     
-    # Strategy 3: Too many std::string declarations (sign of hallucination)
-    if truncate_at is None:
-        string_decl_count = sum(1 for line in lines if 'std::string' in line)
-        if string_decl_count > 15:  # More than 15 string declarations is suspicious
-            # Find where the declarations become excessive
-            count = 0
-            for i, line in enumerate(lines):
-                if 'std::string' in line:
-                    count += 1
-                    if count > 10:  # After 10, start truncating
-                        truncate_at = i
-                        print(f"[!] Detected excessive string declarations ({string_decl_count} total)")
-                        break
-    
-    # Strategy 4: Look for total frequency (same meaningful line appears many times)
-    if truncate_at is None:
-        seen_lines = {}
-        for i, line in enumerate(lines):
-            stripped = line.strip()
-            if not stripped or stripped in ('{', '}', ';', 'return;', 'break;'):
-                continue
-            if len(stripped) < 15:
-                continue
-            
-            if stripped in seen_lines:
-                seen_lines[stripped].append(i)
-                if len(seen_lines[stripped]) >= 4:
-                    truncate_at = seen_lines[stripped][1]
-                    break
-            else:
-                seen_lines[stripped] = [i]
+    truncate_at = None
+    if repeat_at is not None:
+        truncate_at = repeat_at
+    elif inflation_at is not None:
+        truncate_at = inflation_at
+        print(f"[!] Detected variable inflation loop at line {truncate_at}")
+    elif string_decl_count > 15:  # More than 15 string declarations is suspicious
+        truncate_at = string_decl_at
+        print(f"[!] Detected excessive string declarations ({string_decl_count} total)")
+    elif frequency_at is not None:
+        truncate_at = frequency_at
     
     if truncate_at and truncate_at > 5:
         truncated = '\n'.join(lines[:truncate_at])
@@ -415,30 +943,21 @@ def _format_c_code(code: str) -> str:
     
     result = code
     
-    # Add newlines after semicolons (but not in for loops)
-    # First protect for loops
-    for_loops = re.findall(r'for\s*\([^)]+\)', result)
-    for i, loop in enumerate(for_loops):
-        result = result.replace(loop, f'__FOR_LOOP_{i}__')
-    
-    # Add newline after semicolons
-    result = re.sub(r';(?!\s*\n)', ';\n', result)
-    
-    # Restore for loops
-    for i, loop in enumerate(for_loops):
-        result = result.replace(f'__FOR_LOOP_{i}__', loop)
+    # Add newlines after semicolons (but not in for loops): a for header
+    # matches as a whole and is kept as is
+    result = _SEMI_OR_FOR_RE.sub(lambda m: m.group(0) if m.group(0)[0] == 'f' else ';\n', result)
     
     # Add newline after opening braces
-    result = re.sub(r'\{(?!\s*\n)', '{\n', result)
+    result = _OPEN_BRACE_RE.sub('{\n', result)
     
     # Add newline before closing braces
-    result = re.sub(r'(?<!\n)\s*\}', '\n}', result)
+    result = _CLOSE_BRACE_BEFORE_RE.sub('\n}', result)
     
     # Add newline after closing braces (but not before else/else if)
-    result = re.sub(r'\}(?!\s*else)(?!\s*\n)(?!\s*$)', '}\n', result)
+    result = _CLOSE_BRACE_AFTER_RE.sub('}\n', result)
     
     # Fix multiple newlines
-    result = re.sub(r'\n{3,}', '\n\n', result)
+    result = _MULTI_NEWLINE_RE.sub('\n\n', result)
     
     # Basic indentation - count braces
     lines = result.split('\n')
@@ -456,7 +975,7 @@ def _format_c_code(code: str) -> str:
             indent = max(0, indent - 1)
         
         # Add indentation
-        formatted_lines.append('    ' * indent + stripped)
+        formatted_lines.append((_INDENT[indent] if indent < len(_INDENT) else '    ' * indent) + stripped)
         
         # Increase indent after opening brace
         if stripped.endswith('{'):
@@ -465,26 +984,59 @@ def _format_c_code(code: str) -> str:
     return '\n'.join(formatted_lines)
 
 
+# Mock transformations: Ghidra-specific types and null pointers
+_MOCK_REPLACEMENTS = {
+    "undefined8": "uint64_t",
+    "undefined4": "uint32_t",
+    "undefined2": "uint16_t",
+    "undefined1": "uint8_t",
+    "undefined": "uint8_t",
+    "ulonglong": "uint64_t",
+    "longlong": "int64_t",
+    "(void *)0x0": "NULL",
+    "== 0x0": "== NULL",
+    "!= 0x0": "!= NULL",
+}
+# Single pass; longest alternatives first so "undefined8" wins over "undefined".
+# The lookahead keeps "== 0x0" from matching inside "== 0x0040".
+_MOCK_PATTERN = re.compile(
+    "(?:" + "|".join(re.escape(k) for k in sorted(_MOCK_REPLACEMENTS, key=len, reverse=True)) + r")(?!\w)"
+)
+
+
 def mock_decompile_to_c(pseudo_code: str) -> str:
     """
     Mock decompilation for testing without the actual model.
     Performs basic transformations to simulate LLM4Decompile output.
     """
-    result = pseudo_code
-    
-    # Basic type fixes (Ghidra-specific types)
-    result = result.replace("undefined8", "uint64_t")
-    result = result.replace("undefined4", "uint32_t")
-    result = result.replace("undefined2", "uint16_t")
-    result = result.replace("undefined1", "uint8_t")
-    result = result.replace("undefined", "uint8_t")
-    result = result.replace("longlong", "int64_t")
-    result = result.replace("ulonglong", "uint64_t")
-    
-    # Basic pointer fixes
-    result = result.replace("(void *)0x0", "NULL")
-    result = result.replace("== 0x0", "== NULL")
-    result = result.replace("!= 0x0", "!= NULL")
+    result = _MOCK_PATTERN.sub(lambda m: _MOCK_REPLACEMENTS[m.group(0)], pseudo_code)
     
     # Apply formatting
     return _format_c_code(result)
+
+
+def _preload():
+    """Load the model, then run a 1-token generate to warm up CUDA / compiled kernels."""
+    model, tokenizer = get_model()
+    if model is None:
+        return
+    try:
+        inputs = _tokenize(tokenizer, ["int main(){return 0;}"]).to(model.device)
+        with torch.inference_mode():
+            if _compiled:
+                with _compiled_generate_lock:
+                    model.generate(
+                        **inputs,
+                        max_new_tokens=1,
+                        pad_token_id=tokenizer.eos_token_id,
+                        past_key_values=_static_cache(model, 1),
+                    )
+            else:
+                model.generate(**inputs, max_new_tokens=1, pad_token_id=tokenizer.eos_token_id)
+        print("[+] LLM4Decompile warmed up")
+    except Exception as e:
+        print(f"[!] LLM4Decompile warmup failed: {e}")
+
+
+if PRELOAD and not DISABLED_BY_ENV:
+    threading.Thread(target=_preload, name="llm4decompile-preload", daemon=True).start()
@@ -12,20 +12,145 @@ Usage:
         refined_code = await decompile_with_modal(ghidra_pseudo_c)
 """
 
+import asyncio
+import json
 import os
+import time
+import weakref
 import httpx
-from typing import Optional
+from typing import AsyncIterator, Dict, Optional
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+from services import llm_cache, semantic_cache
+from services.http_pool import get_http_client, per_loop
+
+# orjson encodes/decodes the large code strings in request and response
+# bodies several times faster than the stdlib json module
+ORJSON_AVAILABLE = False
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    pass
 
 # Modal endpoint URL - deployed LLM4Decompile model
 MODAL_ENDPOINT_URL = os.environ.get(
     "MODAL_ENDPOINT_URL",
     "https://lukas-li-album--llm4decompile-llm4decompile-decompile.modal.run"
 )
+MODAL_BATCH_URL = os.environ.get(
+    "MODAL_BATCH_URL",
+    "https://lukas-li-album--llm4decompile-llm4decompile-decompile-batch.modal.run"
+)
 MODAL_HEALTH_URL = os.environ.get(
     "MODAL_HEALTH_URL", 
     "https://lukas-li-album--llm4decompile-llm4decompile-health.modal.run"
 )
 
+# Retries for transient failures (rate limits, 5xx, dropped connections).
+# Timeouts are not retried: a cold start already used the full timeout.
+RETRY_ATTEMPTS = int(os.environ.get("MODAL_RETRY_ATTEMPTS", "3"))
+TRANSIENT_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# A batch request gets the single-request timeout (which covers a cold start)
+# plus this much per function, up to MODAL_BATCH_TIMEOUT_MAX_SECONDS; past
+# that the batch falls back to per-function requests
+BATCH_TIMEOUT_PER_FUNCTION_SECONDS = float(os.environ.get("MODAL_BATCH_TIMEOUT_PER_FUNCTION_SECONDS", "15"))
+BATCH_TIMEOUT_MAX_SECONDS = float(os.environ.get("MODAL_BATCH_TIMEOUT_MAX_SECONDS", "300"))
+
+# Circuit breaker: after this many consecutive failed calls, skip Modal for
+# the recovery window (callers get the Ghidra code back at once), then let a
+# single probe request through to test whether it is back
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("MODAL_BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RECOVERY_SECONDS = float(os.environ.get("MODAL_BREAKER_RECOVERY_SECONDS", "60"))
+
+# Opt-in: send a 1-token request at startup, then every
+# MODAL_KEEPALIVE_SECONDS (0 = only once), so a container is already up for
+# the first real request. Keeps GPU time billed while the server is idle.
+MODAL_WARMUP = os.environ.get("MODAL_WARMUP", "").lower() in ("true", "1", "yes")
+MODAL_KEEPALIVE_SECONDS = float(os.environ.get("MODAL_KEEPALIVE_SECONDS", "240"))
+
+# A health check result is reused for this long, so polling it does not cost
+# a round-trip to Modal each time
+HEALTH_TTL_SECONDS = float(os.environ.get("MODAL_HEALTH_TTL_SECONDS", "10"))
+
+# Request priority labels - critical requests (main/entry) are scheduled first
+PRIORITY_CRITICAL = "critical"
+PRIORITY_STANDARD = "standard"
+
+
+def _dumps(payload: dict) -> bytes:
+    """Serialize a JSON request body."""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+
+def _loads(body: bytes):
+    """Parse a JSON response body."""
+    return orjson.loads(body) if ORJSON_AVAILABLE else json.loads(body)
+
+
+def _error_text(body: bytes) -> str:
+    """First 500 bytes of an error response body, without decoding the rest."""
+    return body[:500].decode("utf-8", errors="replace") or "Unknown error"
+
+
+class TransientEndpointError(Exception):
+    """Retryable HTTP status from a Modal endpoint."""
+
+
+def _is_transient(exc: BaseException) -> bool:
+    return isinstance(exc, (TransientEndpointError, httpx.ConnectError, httpx.RemoteProtocolError))
+
+
+class _CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker (closed -> open -> half-open).
+    
+    Only used from the event loop, so no locking is needed.
+    """
+    
+    def __init__(self, name: str, failure_threshold: int, recovery_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_seconds = recovery_seconds
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probe_started: Optional[float] = None
+    
+    def allow(self) -> bool:
+        """Whether a call may go through; in half-open state only one probe at a time."""
+        if self._opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self._opened_at < self.recovery_seconds:
+            return False
+        # A probe that never reported back (e.g. cancelled) expires too
+        if self._probe_started is not None and now - self._probe_started < self.recovery_seconds:
+            return False
+        self._probe_started = now
+        return True
+    
+    def record_success(self):
+        if self._opened_at is not None:
+            print(f"[+] {self.name} circuit closed")
+        self._failures = 0
+        self._opened_at = None
+        self._probe_started = None
+    
+    def record_failure(self):
+        self._failures += 1
+        self._probe_started = None
+        if self._opened_at is not None or self._failures >= self.failure_threshold:
+            if self._opened_at is None:
+                print(f"[!] {self.name} circuit open after {self._failures} failures, "
+                      f"skipping it for {self.recovery_seconds:.0f}s")
+            self._opened_at = time.monotonic()
+
+
+_modal_breaker = _CircuitBreaker("Modal", BREAKER_FAILURE_THRESHOLD, BREAKER_RECOVERY_SECONDS)
+
 
 class ModalDecompileClient:
     """
@@ -38,6 +163,7 @@ class ModalDecompileClient:
         self,
         endpoint_url: Optional[str] = None,
         health_url: Optional[str] = None,
+        batch_url: Optional[str] = None,
         timeout: float = 120.0,
     ):
         """
@@ -46,23 +172,47 @@ class ModalDecompileClient:
         Args:
             endpoint_url: Modal endpoint URL for decompile requests
             health_url: Modal health check URL
+            batch_url: Modal endpoint URL for batched decompile requests
             timeout: Request timeout in seconds (default 120s for cold starts)
         """
         self.endpoint_url = endpoint_url or MODAL_ENDPOINT_URL
         self.health_url = health_url or MODAL_HEALTH_URL
+        self.batch_url = batch_url or MODAL_BATCH_URL
         self.timeout = timeout
-        self._http_client: Optional[httpx.AsyncClient] = None
+        self._last_health = (float("-inf"), False)  # (checked_at, healthy)
     
     async def _get_client(self) -> httpx.AsyncClient:
-        """Get or create async HTTP client."""
-        if self._http_client is None:
-            self._http_client = httpx.AsyncClient(timeout=self.timeout)
-        return self._http_client
+        """Get the shared keep-alive HTTP client (timeouts are set per request)."""
+        return get_http_client()
+    
+    async def _post(self, url: str, payload: dict, timeout: float) -> httpx.Response:
+        """POST with full-jitter exponential backoff on transient failures."""
+        client = await self._get_client()
+        body = _dumps(payload)  # Serialized once, reused by every attempt
+        async for attempt in AsyncRetrying(
+            stop=stop_after_attempt(RETRY_ATTEMPTS),
+            wait=wait_random_exponential(multiplier=1, max=30),
+            retry=retry_if_exception(_is_transient),
+            reraise=True,
+        ):
+            with attempt:
+                response = await client.post(
+                    url,
+                    content=body,
+                    headers={"Content-Type": "application/json"},
+                    timeout=timeout,
+                )
+                if response.status_code in TRANSIENT_STATUS_CODES:
+                    raise TransientEndpointError(
+                        f"Modal endpoint error: {response.status_code} - {_error_text(response.content)}"
+                    )
+        return response
     
     async def decompile(
         self,
         ghidra_code: str,
         max_tokens: int = 2048,
+        priority: str = PRIORITY_STANDARD,
     ) -> str:
         """
         Refine Ghidra pseudo-C into clean C code using the Modal-deployed model.
@@ -70,29 +220,25 @@ class ModalDecompileClient:
         Args:
             ghidra_code: Raw Ghidra pseudo-C code
             max_tokens: Maximum tokens to generate (optional, for future use)
+            priority: PRIORITY_CRITICAL or PRIORITY_STANDARD
             
         Returns:
             Refined C code
         """
-        client = await self._get_client()
-        
         payload = {
             "ghidra_code": ghidra_code,
             "max_tokens": max_tokens,
+            "priority": priority,
         }
         
         try:
-            response = await client.post(
-                self.endpoint_url,
-                json=payload,
-                headers={"Content-Type": "application/json"},
-            )
+            response = await self._post(self.endpoint_url, payload, self.timeout)
             
             if response.status_code != 200:
-                error_text = response.text[:500] if response.text else "Unknown error"
+                error_text = _error_text(response.content)
                 raise Exception(f"Modal endpoint error: {response.status_code} - {error_text}")
             
-            result = response.json()
+            result = _loads(response.content)
             return result.get("refined_code", ghidra_code)
             
         except httpx.TimeoutException:
@@ -100,29 +246,147 @@ class ModalDecompileClient:
         except httpx.ConnectError as e:
             raise Exception(f"Failed to connect to Modal endpoint: {e}")
     
+    async def decompile_stream(
+        self,
+        ghidra_code: str,
+        max_tokens: int = 2048,
+        priority: str = PRIORITY_STANDARD,
+    ) -> AsyncIterator[str]:
+        """
+        Like decompile(), but yields the refined code line by line as it is generated.
+        
+        Endpoints without streaming support answer with JSON; the refined
+        code is then yielded in one piece.
+        
+        Args:
+            ghidra_code: Raw Ghidra pseudo-C code
+            max_tokens: Maximum tokens to generate
+            priority: PRIORITY_CRITICAL or PRIORITY_STANDARD
+            
+        Yields:
+            Chunks of refined C code
+        """
+        client = await self._get_client()
+        
+        payload = {
+            "ghidra_code": ghidra_code,
+            "max_tokens": max_tokens,
+            "priority": priority,
+            "stream": True,
+        }
+        
+        try:
+            async with client.stream(
+                "POST",
+                self.endpoint_url,
+                content=_dumps(payload),
+                headers={"Content-Type": "application/json"},
+                timeout=self.timeout,
+            ) as response:
+                if response.status_code != 200:
+                    error_text = _error_text(await response.aread())
+                    raise Exception(f"Modal endpoint error: {response.status_code} - {error_text}")
+                
+                if response.headers.get("content-type", "").startswith("application/json"):
+                    result = _loads(await response.aread())
+                    yield result.get("refined_code", ghidra_code)
+                    return
+                
+                async for chunk in response.aiter_text():
+                    yield chunk
+                    
+        except httpx.TimeoutException:
+            raise Exception("Modal endpoint timed out (cold start may take up to 60s)")
+        except httpx.ConnectError as e:
+            raise Exception(f"Failed to connect to Modal endpoint: {e}")
+    
+    async def decompile_batch(
+        self,
+        functions: Dict[str, str],
+        max_tokens: int = 2048,
+        priorities: Optional[Dict[str, str]] = None,
+    ) -> Dict[str, str]:
+        """
+        Refine several functions with a single request to the batch endpoint.
+        
+        Args:
+            functions: Dict mapping function names to Ghidra pseudo-C code
+            max_tokens: Maximum tokens to generate per function
+            priorities: Optional dict mapping function names to a priority label
+            
+        Returns:
+            Dict mapping function names to refined C code
+        """
+        payload = {
+            "functions": [
+                {
+                    "name": name,
+                    "ghidra_code": code,
+                    "priority": (priorities or {}).get(name, PRIORITY_STANDARD),
+                }
+                for name, code in functions.items()
+            ],
+            "max_tokens": max_tokens,
+        }
+        
+        # The whole batch runs in one request, so extend the timeout with it
+        timeout = min(
+            self.timeout + BATCH_TIMEOUT_PER_FUNCTION_SECONDS * len(functions),
+            max(self.timeout, BATCH_TIMEOUT_MAX_SECONDS),
+        )
+        
+        try:
+            response = await self._post(self.batch_url, payload, timeout)
+            
+            if response.status_code != 200:
+                error_text = _error_text(response.content)
+                raise Exception(f"Modal batch endpoint error: {response.status_code} - {error_text}")
+            
+            result = _loads(response.content)
+            if "error" in result:
+                raise Exception(f"Modal batch endpoint error: {result['error']}")
+            
+            refined = {}
+            for item in result.get("results", []):
+                name = item.get("name")
+                if name in functions:
+                    refined[name] = item.get("refined_code", functions[name])
+            return refined
+            
+        except httpx.TimeoutException:
+            raise Exception("Modal batch endpoint timed out")
+        except httpx.ConnectError as e:
+            raise Exception(f"Failed to connect to Modal batch endpoint: {e}")
+    
     async def health_check(self) -> bool:
-        """Check if the Modal endpoint is healthy."""
+        """Check if the Modal endpoint is healthy (cached for HEALTH_TTL_SECONDS)."""
+        checked_at, healthy = self._last_health
+        if time.monotonic() - checked_at < HEALTH_TTL_SECONDS:
+            return healthy
+        
+        healthy = False
         try:
             client = await self._get_client()
             response = await client.get(self.health_url, timeout=30.0)
             if response.status_code == 200:
-                data = response.json()
-                return data.get("status") == "healthy"
-            return False
+                data = _loads(response.content)
+                healthy = data.get("status") == "healthy"
         except Exception as e:
             print(f"[!] Modal health check failed: {e}")
-            return False
+        
+        self._last_health = (time.monotonic(), healthy)
+        return healthy
     
     async def close(self):
-        """Close the HTTP client."""
-        if self._http_client:
-            await self._http_client.aclose()
-            self._http_client = None
+        """No-op: the HTTP client is shared (see http_pool.close_http_client)."""
 
 
 # Singleton instance for use in the app
 _modal_client: Optional[ModalDecompileClient] = None
 
+# Per event loop: cache key -> task refining that input
+_in_flight: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Task]]" = weakref.WeakKeyDictionary()
+
 
 def get_modal_client() -> ModalDecompileClient:
     """Get or create the Modal client singleton."""
@@ -146,27 +410,212 @@ def is_modal_available() -> bool:
     return bool(MODAL_ENDPOINT_URL)
 
 
-async def decompile_with_modal(ghidra_code: str, max_tokens: int = 2048) -> str:
+async def keep_warm():
+    """Warm the Modal container and keep it from idling out (see MODAL_WARMUP)."""
+    client = get_modal_client()
+    while True:
+        try:
+            await client.decompile("int f(void) { return 0; }", max_tokens=1)
+            print("[+] Modal container warm")
+        except Exception as e:
+            print(f"[!] Modal warm-up failed: {e}")
+        if MODAL_KEEPALIVE_SECONDS <= 0:
+            return
+        await asyncio.sleep(MODAL_KEEPALIVE_SECONDS)
+
+
+def _cache_key(client: ModalDecompileClient, ghidra_code: str, max_tokens: int) -> str:
+    """Cache key for a Modal refinement (same model behind single and batch URLs)."""
+    return llm_cache.make_key(endpoint=client.endpoint_url, max_tokens=max_tokens, code=ghidra_code)
+
+
+async def decompile_with_modal(
+    ghidra_code: str,
+    max_tokens: int = 2048,
+    priority: str = PRIORITY_STANDARD,
+) -> str:
     """
     Convenience function to decompile using Modal.
     
-    Falls back to returning original code if Modal inference fails.
+    Falls back to returning original code if Modal inference fails, or
+    without calling it while the circuit breaker is open. Successful
+    results are cached by input (the model runs near-greedy), with an
+    opt-in tier that also matches functions differing only in Ghidra's
+    auto-names. Concurrent calls for the same input share one refinement.
     
     Args:
         ghidra_code: Raw Ghidra pseudo-C code
         max_tokens: Maximum tokens to generate
+        priority: PRIORITY_CRITICAL or PRIORITY_STANDARD
         
     Returns:
         Refined C code, or original code if inference fails
     """
     client = get_modal_client()
     
+    cache_key = _cache_key(client, ghidra_code, max_tokens)
+    cached = await llm_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    in_flight = per_loop(_in_flight, dict)
+    task = in_flight.get(cache_key)
+    if task is None:
+        task = asyncio.ensure_future(_refine_uncached(client, ghidra_code, max_tokens, priority, cache_key))
+        in_flight[cache_key] = task
+        task.add_done_callback(lambda _: in_flight.pop(cache_key, None))
+    # Shielded so one caller giving up does not cancel it for the others
+    return await asyncio.shield(task)
+
+
+async def _refine_uncached(
+    client: ModalDecompileClient,
+    ghidra_code: str,
+    max_tokens: int,
+    priority: str,
+    cache_key: str,
+) -> str:
+    """decompile_with_modal() past the exact-match cache."""
+    cached = semantic_cache.lookup(ghidra_code, endpoint=client.endpoint_url, max_tokens=max_tokens)
+    if cached is not None:
+        return cached
+    
+    if not _modal_breaker.allow():
+        return ghidra_code
+    
     try:
-        return await client.decompile(ghidra_code, max_tokens)
+        refined = await client.decompile(ghidra_code, max_tokens, priority)
     except Exception as e:
+        _modal_breaker.record_failure()
         print(f"[!] Modal inference failed: {e}")
         # Return original code on failure instead of crashing
         return ghidra_code
+    _modal_breaker.record_success()
+    
+    await llm_cache.set(cache_key, refined)
+    semantic_cache.add(ghidra_code, refined, endpoint=client.endpoint_url, max_tokens=max_tokens)
+    return refined
+
+
+async def stream_decompile_with_modal(
+    ghidra_code: str,
+    max_tokens: int = 2048,
+    priority: str = PRIORITY_STANDARD,
+) -> AsyncIterator[str]:
+    """
+    Streaming counterpart of decompile_with_modal().
+    
+    A cached result is yielded whole; a fresh one is cached once the stream
+    completes. If Modal fails before producing output (or the circuit breaker
+    is open), the original code is yielded instead; a failure after output
+    has been yielded is re-raised, so the caller can discard the partial code.
+    
+    Args:
+        ghidra_code: Raw Ghidra pseudo-C code
+        max_tokens: Maximum tokens to generate
+        priority: PRIORITY_CRITICAL or PRIORITY_STANDARD
+        
+    Yields:
+        Chunks of refined C code
+    """
+    client = get_modal_client()
+    
+    cache_key = _cache_key(client, ghidra_code, max_tokens)
+    cached = await llm_cache.get(cache_key)
+    if cached is not None:
+        yield cached
+        return
+    
+    if not _modal_breaker.allow():
+        yield ghidra_code
+        return
+    
+    parts = []
+    try:
+        async for chunk in client.decompile_stream(ghidra_code, max_tokens, priority):
+            parts.append(chunk)
+            yield chunk
+    except Exception as e:
+        _modal_breaker.record_failure()
+        print(f"[!] Modal streaming inference failed: {e}")
+        if parts:
+            raise
+        yield ghidra_code
+        return
+    _modal_breaker.record_success()
+    
+    await llm_cache.set(cache_key, "".join(parts))
+
+
+async def decompile_batch_with_modal(
+    functions: Dict[str, str],
+    max_tokens: int = 2048,
+    concurrency: int = 4,
+    priorities: Optional[Dict[str, str]] = None,
+) -> Dict[str, str]:
+    """
+    Convenience function to decompile several functions in one Modal request.
+    
+    Falls back to concurrent per-function requests if the batch endpoint
+    fails, and to the original code for any function that still could not
+    be refined.
+    
+    Args:
+        functions: Dict mapping function names to Ghidra pseudo-C code
+        max_tokens: Maximum tokens to generate per function
+        concurrency: Max in-flight per-function requests on fallback
+        priorities: Optional dict mapping function names to a priority label
+        
+    Returns:
+        Dict mapping function names to refined C code
+    """
+    client = get_modal_client()
+    
+    refined = {}
+    for name, code in functions.items():
+        cached = await llm_cache.get(_cache_key(client, code, max_tokens))
+        if cached is not None:
+            refined[name] = cached
+    
+    uncached = {}
+    for name, code in functions.items():
+        if name in refined:
+            continue
+        cached = semantic_cache.lookup(code, endpoint=client.endpoint_url, max_tokens=max_tokens)
+        if cached is not None:
+            refined[name] = cached
+        else:
+            uncached[name] = code
+    
+    if uncached and _modal_breaker.allow():
+        try:
+            batch_results = await client.decompile_batch(uncached, max_tokens, priorities)
+            _modal_breaker.record_success()
+            for name, code in batch_results.items():
+                await llm_cache.set(_cache_key(client, uncached[name], max_tokens), code)
+                semantic_cache.add(uncached[name], code, endpoint=client.endpoint_url, max_tokens=max_tokens)
+            refined.update(batch_results)
+        except Exception as e:
+            _modal_breaker.record_failure()
+            print(f"[!] Modal batch inference failed, falling back to per-function: {e}")
+    
+    priorities = priorities or {}
+    missing = [name for name in functions if name not in refined]
+    # Critical functions take the semaphore first
+    missing.sort(key=lambda name: priorities.get(name) != PRIORITY_CRITICAL)
+    if missing:
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def _one(name: str) -> str:
+            async with semaphore:
+                return await decompile_with_modal(
+                    functions[name], max_tokens, priorities.get(name, PRIORITY_STANDARD)
+                )
+        
+        results = await asyncio.gather(*[_one(name) for name in missing])
+        refined.update(zip(missing, results))
+    
+    return {name: refined[name] for name in functions}
 
 
 async def check_modal_health() -> dict:
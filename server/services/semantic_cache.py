@@ -0,0 +1,125 @@
+"""
+Second cache tier for functions that only differ in Ghidra's auto-generated names.
+
+The exact cache (llm_cache) misses functions that only differ in Ghidra's
+auto-generated names, e.g. the same statically linked libc routine showing
+up as FUN_00401234/iVar1 in one binary and FUN_00402abc/iVar2 in another.
+This tier keys results by the code with those names normalized away, and
+only reuses a result when the normalized text matches exactly. The cached
+output's auto-names are then mapped back onto the requesting function's
+own names (occurrence by occurrence), so calls and globals keep pointing at
+the right FUN_/DAT_ symbols.
+
+Off unless ENABLE_SEMANTIC_CACHE is set. Entries are kept in-process, keyed
+by the endpoint and max_tokens as well as the normalized code; the oldest
+are evicted past SEMANTIC_CACHE_MAX_ENTRIES, and entries expire after
+LLM_CACHE_TTL_SECONDS.
+
+Usage:
+    from services import semantic_cache
+
+    cached = semantic_cache.lookup(code, endpoint=url, max_tokens=2048)
+    if cached is None:
+        cached = await call_model(code)
+        semantic_cache.add(code, cached, endpoint=url, max_tokens=2048)
+"""
+
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from services import llm_cache
+
+CACHE_TTL_SECONDS = int(os.environ.get("LLM_CACHE_TTL_SECONDS", "86400"))
+MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", "10000"))
+ENABLED_BY_ENV = os.environ.get("ENABLE_SEMANTIC_CACHE", "").lower() in ("true", "1", "yes")
+
+# Ghidra auto-names whose address/counter suffix varies between binaries
+_ADDRESS_NAMES = re.compile(r'\b(FUN|LAB|DAT|PTR|UNK|thunk_FUN|switchD|caseD)_[0-9a-fA-F]+\b')
+_COUNTER_NAMES = re.compile(r'\b([a-z]{1,2}Var|local_|param_|in_stack_)[0-9a-fA-F]+\b')
+_AUTO_NAMES = re.compile(f"{_ADDRESS_NAMES.pattern}|{_COUNTER_NAMES.pattern}")
+
+# key -> (expires_at, auto-names of the cached input in order, value)
+_entries: "OrderedDict[str, Tuple[float, List[str], str]]" = OrderedDict()
+
+stats = {"hits": 0, "misses": 0}
+
+
+def is_enabled() -> bool:
+    """Check if the tier is switched on (ENABLE_SEMANTIC_CACHE)."""
+    return ENABLED_BY_ENV
+
+
+def normalize_code(code: str) -> str:
+    """Strip address/counter suffixes from Ghidra auto-generated names."""
+    code = _ADDRESS_NAMES.sub(r'\1_', code)
+    return _COUNTER_NAMES.sub(r'\1', code)
+
+
+def _auto_names(code: str) -> List[str]:
+    """Every auto-generated name occurrence in `code`, in order."""
+    return [m.group(0) for m in _AUTO_NAMES.finditer(code)]
+
+
+def _key(code: str, key_parts: Dict[str, Any]) -> str:
+    return llm_cache.make_key(tier="normalized", code=normalize_code(code), **key_parts)
+
+
+def _rename(value: str, cached_names: List[str], names: List[str]) -> Optional[str]:
+    """
+    Map the cached input's auto-names onto the requesting input's in `value`.
+
+    Returns:
+        The renamed value, or None if the names do not correspond one-to-one
+    """
+    if len(cached_names) != len(names):
+        return None
+    mapping: Dict[str, str] = {}
+    for old, new in zip(cached_names, names):
+        if mapping.setdefault(old, new) != new:
+            return None
+    if len(set(mapping.values())) != len(mapping):
+        return None
+    return _AUTO_NAMES.sub(lambda m: mapping.get(m.group(0), m.group(0)), value)
+
+
+def lookup(code: str, **key_parts: Any) -> Optional[str]:
+    """
+    Return the cached result for code that normalizes to the same text as
+    `code`, renamed to `code`'s auto-names, or None.
+
+    Args:
+        code: Ghidra pseudo-C being refined
+        **key_parts: Everything else that determines the output (endpoint, max_tokens, ...)
+    """
+    if not ENABLED_BY_ENV:
+        return None
+    key = _key(code, key_parts)
+    entry = _entries.get(key)
+    if entry is not None and entry[0] < time.time():
+        del _entries[key]
+        entry = None
+
+    value = None
+    if entry is not None:
+        _entries.move_to_end(key)
+        value = _rename(entry[2], entry[1], _auto_names(code))
+
+    if value is None:
+        stats["misses"] += 1
+    else:
+        stats["hits"] += 1
+    return value
+
+
+def add(code: str, value: str, ttl: int = CACHE_TTL_SECONDS, **key_parts: Any):
+    """Store the result `value` for `code`, evicting the oldest entries past MAX_ENTRIES."""
+    if not ENABLED_BY_ENV:
+        return
+    key = _key(code, key_parts)
+    _entries[key] = (time.time() + ttl, _auto_names(code), value)
+    _entries.move_to_end(key)
+    while len(_entries) > MAX_ENTRIES:
+        _entries.popitem(last=False)
@@ -10,50 +10,257 @@ Endpoints:
 - GET /health - Health check for Vertex AI
 """
 
+import asyncio
+import json
 import os
+import threading
 import time
-from typing import Optional, List, Dict, Any
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import AsyncIterator, Optional, List, Dict, Any, Tuple, Union
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 import logging
 
+# orjson serializes the generated code in responses faster than stdlib json
+ORJSON_AVAILABLE = False
+DefaultResponse = JSONResponse
+try:
+    import orjson
+    from fastapi.responses import ORJSONResponse as DefaultResponse
+    ORJSON_AVAILABLE = True
+except ImportError:
+    pass
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Global model instance
 _llm = None
+# Token ids of PROMPT_PREFIX (with BOS) and PROMPT_SUFFIX, set on model load
+_prefix_tokens: List[int] = []
+_suffix_tokens: List[int] = []
+
+MODEL_PATH = os.environ.get("MODEL_PATH", "/models/model.gguf")
+# Preferred quantization: <model>-<quant>.gguf next to MODEL_PATH is loaded
+# instead when present (see quantize_model.py). 4/5-bit K-quants decode
+# ~1.5-2x faster than F16 with little quality loss. Empty = MODEL_PATH as is.
+MODEL_QUANT = os.environ.get("MODEL_QUANT", "Q4_K_M")
+N_CTX = int(os.environ.get("N_CTX", "4096"))
+# Server-side limit on generated tokens, whatever the client asks for, so
+# one long-tail request cannot hold the inference thread for minutes
+MAX_TOKENS_CAP = int(os.environ.get("MAX_TOKENS_CAP", "2048"))
+# Ghidra code is truncated to what fits in the context next to the prompt
+# template and the request's (clamped) max_tokens; at worst this many tokens
+# (128 reserved for the template)
+MAX_INPUT_TOKENS = N_CTX - MAX_TOKENS_CAP - 128
+if MAX_TOKENS_CAP < 1 or MAX_INPUT_TOKENS < 1:
+    raise ValueError(
+        f"N_CTX ({N_CTX}) must exceed MAX_TOKENS_CAP ({MAX_TOKENS_CAP}) + 128, "
+        "and MAX_TOKENS_CAP must be positive"
+    )
+# Optional in-RAM cache of KV states for whole prompts seen before (e.g. a
+# function re-requested after a client timeout). Saving a state copies the
+# KV cache after every completion, so it is off by default.
+PROMPT_CACHE_MB = int(os.environ.get("LLAMA_PROMPT_CACHE_MB", "0"))
+# Largest gzip request body accepted, both compressed and decompressed
+MAX_BODY_BYTES = int(os.environ.get("MAX_BODY_MB", "8")) * 1024 * 1024
+
+# LLM4Decompile prompt template
+PROMPT_PREFIX = "# This is the Ghidra pseudo-C:\n"
+PROMPT_SUFFIX = "\n# What is the source code?\n"
+
+# llama.cpp evaluates one sequence at a time per Llama instance, so all
+# completions run on one dedicated thread. Concurrent requests queue there
+# in arrival order while the event loop stays free for new requests and
+# health checks.
+_inference_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llama-inference")
+
+
+def resolve_model_path() -> str:
+    """MODEL_PATH, or its MODEL_QUANT variant if that file exists."""
+    if MODEL_QUANT:
+        root, ext = os.path.splitext(MODEL_PATH)
+        quantized = f"{root}-{MODEL_QUANT.lower()}{ext}"
+        if os.path.exists(quantized):
+            return quantized
+    return MODEL_PATH
 
 
 def get_model():
     """Lazy-load the GGUF model."""
-    global _llm
+    global _llm, _prefix_tokens, _suffix_tokens
     if _llm is None:
-        from llama_cpp import Llama
+        from llama_cpp import Llama, LlamaRAMCache
         
-        model_path = os.environ.get("MODEL_PATH", "/models/model.gguf")
+        model_path = resolve_model_path()
         n_gpu_layers = int(os.environ.get("N_GPU_LAYERS", "-1"))  # -1 = all layers on GPU
-        n_ctx = int(os.environ.get("N_CTX", "4096"))
         n_batch = int(os.environ.get("N_BATCH", "512"))
         
         logger.info(f"Loading GGUF model from {model_path}")
-        logger.info(f"GPU layers: {n_gpu_layers}, Context: {n_ctx}, Batch: {n_batch}")
+        logger.info(f"GPU layers: {n_gpu_layers}, Context: {N_CTX}, Batch: {n_batch}")
         
         start = time.time()
         _llm = Llama(
             model_path=model_path,
             n_gpu_layers=n_gpu_layers,
-            n_ctx=n_ctx,
+            n_ctx=N_CTX,
             n_batch=n_batch,
             verbose=True,
         )
         logger.info(f"Model loaded in {time.time() - start:.2f}s")
+        
+        if PROMPT_CACHE_MB > 0:
+            _llm.set_cache(LlamaRAMCache(capacity_bytes=PROMPT_CACHE_MB << 20))
+        _prefix_tokens = _llm.tokenize(PROMPT_PREFIX.encode("utf-8"))
+        _suffix_tokens = _llm.tokenize(PROMPT_SUFFIX.encode("utf-8"), add_bos=False)
+        # Llama reuses the KV entries of the longest token prefix shared with
+        # the previous prompt, so evaluating the static preamble now means
+        # the first request only prefills its own code
+        _llm.eval(_prefix_tokens)
     
     return _llm
 
 
+def clamp_max_tokens(max_tokens: int) -> int:
+    """Client-requested max_tokens, limited to 1..MAX_TOKENS_CAP."""
+    return max(1, min(int(max_tokens), MAX_TOKENS_CAP))
+
+
+def build_decompile_prompt(model, ghidra_code: str, max_tokens: int) -> List[int]:
+    """
+    Build the LLM4Decompile prompt as token ids, truncating `ghidra_code` so
+    the prompt plus `max_tokens` (already clamped) fit in N_CTX.
+    
+    Only the code is tokenized per request; the template's tokens are
+    precomputed, and llama.cpp takes the ids as is instead of re-tokenizing
+    a prompt string.
+    """
+    budget = N_CTX - max_tokens - len(_prefix_tokens) - len(_suffix_tokens)
+    tokens = model.tokenize(ghidra_code.encode("utf-8"), add_bos=False)
+    if len(tokens) > budget:
+        logger.info(f"Truncating input from {len(tokens)} to {budget} tokens")
+        del tokens[budget:]
+    return _prefix_tokens + tokens + _suffix_tokens
+
+
+async def run_completion(model, prompt: Union[str, List[int]], **kwargs) -> Dict[str, Any]:
+    """Run `model(prompt, **kwargs)` on the inference thread and await the result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_inference_executor, partial(model, prompt, **kwargs))
+
+
+def _complete_all(model, jobs: List[Tuple[List[int], int]], **kwargs) -> List[Tuple[Dict[str, Any], float]]:
+    """Run (prompt, max_tokens) completions back to back; returns (output, time in ms) for each."""
+    results = []
+    for prompt, max_tokens in jobs:
+        start = time.time()
+        output = model(prompt, max_tokens=max_tokens, **kwargs)
+        results.append((output, (time.time() - start) * 1000))
+    return results
+
+
+async def stream_completion(model, prompt: Union[str, List[int]], **kwargs) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Streaming counterpart of run_completion(): yields completion chunks as
+    they are generated.
+    
+    The whole generation holds the inference thread (llama.cpp cannot
+    interleave sequences); it stops early if the client goes away.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    done = object()
+    stop = threading.Event()
+    
+    def _produce():
+        try:
+            for chunk in model(prompt, stream=True, **kwargs):
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, chunk)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+    
+    future = loop.run_in_executor(_inference_executor, _produce)
+    try:
+        while (chunk := await queue.get()) is not done:
+            yield chunk
+        await future  # Re-raise generation errors
+    finally:
+        stop.set()
+
+
+def _sse(data: Any) -> str:
+    """Format one server-sent event."""
+    if not isinstance(data, str):
+        data = orjson.dumps(data).decode() if ORJSON_AVAILABLE else json.dumps(data)
+    return f"data: {data}\n\n"
+
+
+class GzipRequestMiddleware:
+    """
+    Decompress request bodies sent with Content-Encoding: gzip.
+    
+    Bodies over MAX_BODY_BYTES (compressed or decompressed) get a 413, so a
+    small gzip bomb cannot exhaust memory.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not any(
+            name == b"content-encoding" and value.lower() == b"gzip" for name, value in scope["headers"]
+        ):
+            await self.app(scope, receive, send)
+            return
+        
+        body = bytearray()
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if len(body) > MAX_BODY_BYTES:
+                await JSONResponse({"detail": "Request body too large"}, status_code=413)(scope, receive, send)
+                return
+            if not message.get("more_body", False):
+                break
+        
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)  # gzip container
+        try:
+            body = decompressor.decompress(body, MAX_BODY_BYTES)
+        except zlib.error:
+            body = None
+        if body is not None and (decompressor.unconsumed_tail or decompressor.unused_data):
+            await JSONResponse({"detail": "Request body too large"}, status_code=413)(scope, receive, send)
+            return
+        if body is None or not decompressor.eof:
+            await JSONResponse({"detail": "Invalid gzip request body"}, status_code=400)(scope, receive, send)
+            return
+        
+        headers = [
+            (name, value) for name, value in scope["headers"]
+            if name not in (b"content-encoding", b"content-length")
+        ]
+        headers.append((b"content-length", str(len(body)).encode()))
+        
+        delivered = False
+        
+        async def receive_decompressed():
+            nonlocal delivered
+            if delivered:
+                return await receive()
+            delivered = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        
+        await self.app(dict(scope, headers=headers), receive_decompressed, send)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Load model on startup."""
@@ -66,6 +273,7 @@ async def lifespan(app: FastAPI):
         # Don't raise - let health check fail instead
     yield
     logger.info("Shutting down...")
+    _inference_executor.shutdown(wait=False, cancel_futures=True)
 
 
 app = FastAPI(
@@ -73,7 +281,10 @@ app = FastAPI(
     description="Vertex AI compatible GGUF inference server",
     version="1.0.0",
     lifespan=lifespan,
+    default_response_class=DefaultResponse,
 )
+# Ghidra code is highly compressible, so clients may gzip request bodies
+app.add_middleware(GzipRequestMiddleware)
 
 
 # ============================================================================
@@ -96,6 +307,7 @@ class DecompileRequest(BaseModel):
     ghidra_code: str = Field(..., description="Ghidra pseudo-C code to refine")
     max_tokens: int = Field(2048, description="Maximum tokens to generate")
     temperature: float = Field(0.0, description="Sampling temperature (0 = greedy)")
+    stream: bool = Field(False, description="Stream the code as server-sent events")
     
 
 class DecompileResponse(BaseModel):
@@ -111,6 +323,7 @@ class CompletionRequest(BaseModel):
     max_tokens: int = 2048
     temperature: float = 0.0
     stop: Optional[List[str]] = None
+    stream: bool = False
 
 
 class CompletionResponse(BaseModel):
@@ -169,39 +382,46 @@ async def predict(request: PredictRequest):
     except Exception as e:
         raise HTTPException(status_code=503, detail=f"Model not loaded: {e}")
     
-    predictions = []
+    predictions: List[Optional[Dict[str, Any]]] = [None] * len(request.instances)
     params = request.parameters or {}
     temperature = params.get("temperature", 0.0)
     
-    for instance in request.instances:
+    # (prompt, max_tokens) -> indices of the instances it answers. Greedy
+    # decoding is deterministic, so duplicate instances are generated once.
+    jobs: Dict[tuple, List[int]] = {}
+    for i, instance in enumerate(request.instances):
         ghidra_code = instance.get("ghidra_code", instance.get("prompt", ""))
-        max_tokens = instance.get("max_tokens", params.get("max_tokens", 2048))
+        max_tokens = clamp_max_tokens(instance.get("max_tokens", params.get("max_tokens", 2048)))
         
         if not ghidra_code:
-            predictions.append({"error": "Missing ghidra_code or prompt"})
+            predictions[i] = {"error": "Missing ghidra_code or prompt"}
             continue
         
         # Build prompt in LLM4Decompile format
-        prompt = f"# This is the Ghidra pseudo-C:\n{ghidra_code}\n# What is the source code?\n"
-        
-        start = time.time()
-        output = model(
-            prompt,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            stop=["# This is", "\n\n\n"],
-            echo=False,
-        )
-        inference_time = (time.time() - start) * 1000
-        
-        refined_code = output["choices"][0]["text"].strip()
-        tokens_used = output["usage"]["total_tokens"]
-        
-        predictions.append({
-            "refined_code": refined_code,
-            "tokens_used": tokens_used,
-            "inference_time_ms": inference_time,
-        })
+        key = (tuple(build_decompile_prompt(model, ghidra_code, max_tokens)), max_tokens)
+        if temperature != 0:
+            key += (i,)
+        jobs.setdefault(key, []).append(i)
+    
+    # The whole request is one job on the inference thread, so its instances
+    # run back to back instead of queueing separately behind other requests
+    loop = asyncio.get_running_loop()
+    outputs = await loop.run_in_executor(_inference_executor, partial(
+        _complete_all,
+        model,
+        [(list(key[0]), key[1]) for key in jobs],
+        temperature=temperature,
+        stop=["# This is", "\n\n\n"],
+        echo=False,
+    ))
+    
+    for indices, (output, inference_time) in zip(jobs.values(), outputs):
+        for i in indices:
+            predictions[i] = {
+                "refined_code": output["choices"][0]["text"].strip(),
+                "tokens_used": output["usage"]["total_tokens"],
+                "inference_time_ms": inference_time,
+            }
     
     return PredictResponse(predictions=predictions)
 
@@ -211,7 +431,8 @@ async def decompile(request: DecompileRequest):
     """
     Direct decompilation endpoint (simpler than /predict).
     
-    Processes Ghidra pseudo-C and returns refined C code.
+    Processes Ghidra pseudo-C and returns refined C code. With stream=true
+    the code arrives as server-sent events {"text": ...}, ending with [DONE].
     """
     try:
         model = get_model()
@@ -219,14 +440,27 @@ async def decompile(request: DecompileRequest):
         raise HTTPException(status_code=503, detail=f"Model not loaded: {e}")
     
     # Build prompt in LLM4Decompile format
-    prompt = f"# This is the Ghidra pseudo-C:\n{request.ghidra_code}\n# What is the source code?\n"
+    max_tokens = clamp_max_tokens(request.max_tokens)
+    prompt = build_decompile_prompt(model, request.ghidra_code, max_tokens)
+    stop = ["# This is", "\n\n\n"]
+    
+    if request.stream:
+        async def events():
+            async for chunk in stream_completion(
+                model, prompt, max_tokens=max_tokens, temperature=request.temperature, stop=stop,
+            ):
+                yield _sse({"text": chunk["choices"][0]["text"]})
+            yield _sse("[DONE]")
+        
+        return StreamingResponse(events(), media_type="text/event-stream")
     
     start = time.time()
-    output = model(
+    output = await run_completion(
+        model,
         prompt,
-        max_tokens=request.max_tokens,
+        max_tokens=max_tokens,
         temperature=request.temperature,
-        stop=["# This is", "\n\n\n"],
+        stop=stop,
         echo=False,
     )
     inference_time = (time.time() - start) * 1000
@@ -247,26 +481,35 @@ async def completions(request: CompletionRequest):
     OpenAI-compatible completions endpoint.
     
     Useful for testing with standard tools or if you want to use
-    the model for other tasks beyond decompilation.
+    the model for other tasks beyond decompilation. With stream=true the
+    completion chunks arrive as server-sent events, ending with [DONE].
     """
     try:
         model = get_model()
     except Exception as e:
         raise HTTPException(status_code=503, detail=f"Model not loaded: {e}")
     
-    start = time.time()
-    output = model(
-        request.prompt,
-        max_tokens=request.max_tokens,
-        temperature=request.temperature,
-        stop=request.stop,
-        echo=False,
-    )
+    kwargs = {
+        "max_tokens": clamp_max_tokens(request.max_tokens),
+        "temperature": request.temperature,
+        "stop": request.stop,
+        "echo": False,
+    }
+    
+    if request.stream:
+        async def events():
+            async for chunk in stream_completion(model, request.prompt, **kwargs):
+                yield _sse(chunk)
+            yield _sse("[DONE]")
+        
+        return StreamingResponse(events(), media_type="text/event-stream")
+    
+    output = await run_completion(model, request.prompt, **kwargs)
     
     return CompletionResponse(
         id=f"cmpl-{int(time.time()*1000)}",
         created=int(time.time()),
-        model=os.environ.get("MODEL_PATH", "gguf-model"),
+        model=resolve_model_path(),
         choices=[{
             "text": output["choices"][0]["text"],
             "index": 0,
@@ -0,0 +1,63 @@
+"""
+Quantize a GGUF model (e.g. an F16 LLM4Decompile conversion) for the server.
+
+Writes <model>-<type>.gguf next to the input, which is the file the server
+loads in place of MODEL_PATH when MODEL_QUANT names that type.
+
+Usage:
+    python quantize_model.py /models/model.gguf              # -> model-q4_k_m.gguf
+    python quantize_model.py /models/model.gguf --type Q5_K_S
+"""
+
+import argparse
+import ctypes
+import os
+import sys
+
+import llama_cpp
+
+
+def quantize(input_path: str, quant_type: str = "Q4_K_M") -> str:
+    """
+    Quantize `input_path` with llama.cpp's quantizer.
+    
+    Args:
+        input_path: Source GGUF model (F16/F32 or a higher-precision quant)
+        quant_type: llama.cpp quantization type, e.g. Q4_K_M, Q5_K_S, Q8_0
+        
+    Returns:
+        Path of the quantized model
+    """
+    ftype = getattr(llama_cpp, f"LLAMA_FTYPE_MOSTLY_{quant_type.upper()}", None)
+    if ftype is None:
+        raise ValueError(f"Unknown quantization type: {quant_type}")
+    
+    root, ext = os.path.splitext(input_path)
+    output_path = f"{root}-{quant_type.lower()}{ext}"
+    
+    params = llama_cpp.llama_model_quantize_default_params()
+    params.ftype = ftype
+    params.nthread = os.cpu_count() or 1
+    
+    print(f"[*] Quantizing {input_path} -> {output_path} ({quant_type.upper()})")
+    result = llama_cpp.llama_model_quantize(
+        input_path.encode("utf-8"), output_path.encode("utf-8"), ctypes.byref(params)
+    )
+    if result != 0:
+        raise RuntimeError(f"llama_model_quantize failed with code {result}")
+    
+    print(f"[+] Wrote {output_path} ({os.path.getsize(output_path) / 2**20:.0f} MB)")
+    return output_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input_path", help="GGUF model to quantize")
+    parser.add_argument("--type", default=os.environ.get("MODEL_QUANT") or "Q4_K_M", help="Quantization type (default Q4_K_M)")
+    args = parser.parse_args()
+    
+    try:
+        quantize(args.input_path, args.type)
+    except (ValueError, RuntimeError) as e:
+        print(f"[!] {e}")
+        sys.exit(1)